@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+"""
+Throughput benchmark for the catalog loading pipeline.
+
+Writes synthetic catalogs in the formats the catalog modules read (NDK, centennial,
+ISC CSV, W-phase and Choy text files), then times each stage of a load separately:
+
+  parse  - reading the catalog with the module's getEvents()
+  add    - QuakeML.addEvents() (required fields, tensor math, near-event index)
+  render - QuakeML.renderXML() for every event
+  push   - QuakeML.pushBatch() through pdlstub.py standing in for ProductClient, started
+           for each file or (with -p) running as a polling EIDSInputWedge
+
+Each catalog is loaded in its own process, so the peak RSS reported after each stage
+belongs to that load alone.  Results are written as JSON.
+"""
+
+#stdlib imports
+import sys
+import os.path
+import datetime
+import argparse
+import random
+import math
+import json
+import time
+import resource
+import subprocess
+import platform
+import importlib
+
+#local imports
+import comquakeml
+
+#catalog format: (module,product type,magnitude method,file writer function name)
+FORMATS = {'ndk':('ndk',comquakeml.TENSOR,comquakeml.DEFAULT_MOMENT_METHOD,'writeNDK'),
+           'centennial':('centennial',comquakeml.ORIGIN,comquakeml.DEFAULT_MOMENT_METHOD,'writeCentennial'),
+           'isc':('isc',comquakeml.ORIGIN,comquakeml.DEFAULT_MOMENT_METHOD,'writeISC'),
+           'wphase':('wphase',comquakeml.TENSOR,'Mww','writeWphase'),
+           'choy':('choy',comquakeml.FOCAL,'Me','writeChoy')}
+STAGES = ['parse','add','render','push']
+DEFAULT_SIZES = [10000,100000]
+START_TIME = datetime.datetime(1976,1,1)
+BEGIN = datetime.datetime(1000,1,1)
+END = datetime.datetime(3000,1,1)
+
+CONFIG = """[OUTPUT]
+folder = %(workdir)s/output
+
+[PDL]
+folder = %(workdir)s
+keyfile = stubkey
+realtimeconfig = stubconfig.ini
+catalogconfig = stubconfig.ini
+client = %(python)s %(stub)s%(stubargs)s
+"""
+POLLCONFIG = """polldir = %(workdir)s/poll
+pollinterval = 50
+"""
+
+def generateEvents(nevents,seed=0):
+    """
+    Generate random hypocenters, magnitudes and moment tensors, in time order.
+    Events are at least a second apart, as most of the formats use the time (to the second) as the event ID.
+    @param nevents: Number of events.
+    @param seed: Random number seed.
+    @return: Generator of dictionaries with time,lat,lon,depth (km),mag,exponent, m (six tensor
+    components, scaled by 10**exponent dyne-cm), strike,dip,rake and strike2,dip2,rake2.
+    """
+    rand = random.Random(seed)
+    etime = START_TIME
+    for i in range(0,nevents):
+        etime = etime + datetime.timedelta(seconds=rand.randint(1,300),microseconds=rand.randint(0,99)*10000)
+        mag = round(rand.uniform(4.5,8.5),1)
+        strike = rand.randint(0,359)
+        dip = rand.randint(1,89)
+        rake = rand.randint(-179,180)
+        event = {'time':etime,'lat':rand.uniform(-89.0,89.0),'lon':rand.uniform(-179.9,179.9),
+                 'depth':rand.uniform(0.0,700.0),'mag':mag,'exponent':rand.randint(23,28),
+                 'm':[rand.uniform(-9.9,9.9) for j in range(0,6)],
+                 'strike':strike,'dip':dip,'rake':rake,
+                 'strike2':(strike+90) % 360,'dip2':90-dip,'rake2':-rake}
+        yield event
+
+def writeNDK(filename,events):
+    f = open(filename,'wt')
+    for event in events:
+        etime = event['time']
+        tstr = etime.strftime('%Y/%m/%d %H:%M:%S') + '.%i' % (etime.microsecond/100000)
+        m = event['m']
+        f.write('PDE  %s %6.2f %7.2f %5.1f%4.1f%4.1f %-24s\n' % (tstr,event['lat'],event['lon'],event['depth'],
+                                                              event['mag'],event['mag'],'SYNTHETIC REGION'))
+        f.write('%-16s B:%3i%5i%4i S:%3i%5i%4i M:%3i%5i%4i CMT: 1 TRIHD:%5.1f\n' % (etime.strftime('C%Y%m%d%H%MA'),
+                                                                                  10,20,40,30,60,50,40,80,125,
+                                                                                  event['mag']))
+        f.write('CENTROID:%9.1f%5.1f%6.2f%5.2f%8.2f%5.2f%6.1f%5.1f FREE S-20140101000000\n' % (1.5,0.1,event['lat'],0.02,
+                                                                                           event['lon'],0.02,
+                                                                                           event['depth'],0.5))
+        f.write('%2i%s\n' % (event['exponent'],''.join(['%7.3f%6.3f' % (c,0.01) for c in m])))
+        moment = math.sqrt(sum([c**2 for c in m]))
+        f.write('V10%8.3f%3i%4i%8.3f%3i%4i%8.3f%3i%4i %7.3f%4i%3i%5i%4i%3i%5i\n' % (moment,10,20,0.1,30,40,-moment,50,60,
+                                                                                   moment,
+                                                                                   event['strike'],event['dip'],event['rake'],
+                                                                                   event['strike2'],event['dip2'],event['rake2']))
+    f.close()
+
+def writeCentennial(filename,events):
+    f = open(filename,'wt')
+    for event in events:
+        etime = event['time']
+        seconds = etime.second + etime.microsecond/1e6
+        f.write('ABE  A %-4s%4i%3i%3i %3i%3i%6.2f %8.3f%8.3f%6.1f%4i%4i%4.1f %-2s%-5s %4.1f %-2s %-5s\n' %
+                ('ISC',etime.year,etime.month,etime.day,etime.hour,etime.minute,seconds,
+                 event['lat'],event['lon'],event['depth'],100,25,event['mag'],'Mw','ABE1',event['mag']-0.2,'Ms','AN2'))
+    f.close()
+
+def writeISC(filename,events):
+    f = open(filename,'wt')
+    f.write('# synthetic ISC-GEM catalog\n')
+    for event in events:
+        parts = [event['time'].strftime('%Y-%m-%d %H:%M:%S.%f')[:-4],'%.3f' % event['lat'],'%.3f' % event['lon'],
+                 '12.5','8.1','45.0','B','%.1f' % event['depth'],'5.2','B','%.2f' % event['mag'],'0.20','A']
+        parts += ['']*10
+        parts.append(event['time'].strftime('%Y%m%d%H%M%S'))
+        f.write(','.join(parts)+'\n')
+    f.close()
+
+def writeWphase(filename,events):
+    f = open(filename,'wt')
+    f.write('id date time gcmtmag mag nbody gap ts hd lat lon depth mrr mtt mpp mrt mrp mtp\n')
+    for event in events:
+        scale = math.pow(10.0,event['exponent'])
+        tensor = ' '.join(['%.4e' % (c*scale) for c in event['m']])
+        f.write('%s %s %.1f %.1f %i %.1f %.1f %.1f %.3f %.3f %.1f %s\n' % (event['time'].strftime('us%Y%m%d%H%M%S'),
+                                                                        event['time'].strftime('%Y-%m-%d %H:%M:%S'),
+                                                                        event['mag'],event['mag'],120,45.0,12.0,6.0,
+                                                                        event['lat'],event['lon'],event['depth'],tensor))
+    f.close()
+
+def writeChoy(filename,events):
+    f = open(filename,'wt')
+    f.write('date time lat lon depth strike1 dip1 rake1 strike2 dip2 rake2 energy\n')
+    for event in events:
+        etime = event['time']
+        energy = math.pow(10.0,1.5*event['mag']+4.4)
+        f.write('%s %s.%02i %.3f %.3f %.1f %i %i %i %i %i %i %.3e\n' % (etime.strftime('%Y%m%d'),etime.strftime('%H%M%S'),
+                                                                     etime.microsecond/10000,
+                                                                     event['lat'],event['lon'],event['depth'],
+                                                                     event['strike'],event['dip'],event['rake'],
+                                                                     event['strike2'],event['dip2'],event['rake2'],
+                                                                     energy))
+    f.close()
+
+def getCatalog(fmt,nevents,workdir):
+    """
+    Write a synthetic catalog, unless one of that size has been written already.
+    @param fmt: One of the keys of FORMATS.
+    @param nevents: Number of events.
+    @param workdir: Folder to write the catalog in.
+    @return: Catalog file name.
+    """
+    filename = os.path.join(workdir,'%s_%i.txt' % (fmt,nevents))
+    if not os.path.isfile(filename):
+        writer = globals()[FORMATS[fmt][3]]
+        writer(filename,generateEvents(nevents))
+    return filename
+
+def writeConfig(workdir,stubargs='',poll=False):
+    """
+    Write a config file that sends products to pdlstub.py.
+    @param workdir: Folder for the config file, QuakeML output and PDL stand-in files.
+    @param stubargs: Extra pdlstub.py arguments (--stub-delay, etc.)
+    @param poll: True to send files through a polling stand-in (see pdlsender.DirectorySender).
+    @return: Config file name.
+    """
+    homedir = os.path.dirname(os.path.abspath(__file__))
+    if len(stubargs):
+        stubargs = ' ' + stubargs
+    configfile = os.path.join(workdir,'config.ini')
+    f = open(configfile,'wt')
+    f.write(CONFIG % {'workdir':workdir,'python':sys.executable,
+                      'stub':os.path.join(homedir,'pdlstub.py'),'stubargs':stubargs})
+    if poll:
+        f.write(POLLCONFIG % {'workdir':workdir})
+    f.close()
+    return configfile
+
+def getPeakRSS():
+    #in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def runStages(fmt,catalog,configfile,stages,nprocs=1):
+    """
+    Load a catalog, timing each stage.
+    @param fmt: One of the keys of FORMATS.
+    @param catalog: Catalog file name.
+    @param configfile: Config file from writeConfig().
+    @param stages: List of stages to time (the ones before the last are run regardless).
+    @param nprocs: Number of processes to render with.
+    @return: List of dictionaries with stage,events,seconds,events_per_sec and peak_rss_kb.
+    """
+    modname,ptype,method,writer = FORMATS[fmt]
+    module = importlib.import_module(modname)
+    quake = comquakeml.QuakeML(ptype,'benchmark_%s' % fmt,method=method,catalog='us',contributor='us',
+                               triggersource='us',configfile=configfile)
+    quake.clearOutput()
+    results = []
+    lastidx = max([STAGES.index(stage) for stage in stages])
+    events = []
+    filenames = []
+    for stage in STAGES[0:lastidx+1]:
+        t1 = time.time()
+        if stage == 'parse':
+            events = list(module.getEvents([catalog],startDate=BEGIN,endDate=END))
+            nevents = len(events)
+        elif stage == 'add':
+            quake.addEvents(events)
+            events = None
+            nevents = len(quake.EventList)
+        elif stage == 'render':
+            if nprocs > 1:
+                filenames = quake.renderEvents(quake.EventList,nprocs=nprocs)
+            else:
+                filenames = [quake.renderXML(event) for event,origins,nearevents in quake.generateEvents()]
+            nevents = len(filenames)
+        elif stage == 'push':
+            pushresults = quake.pushBatch(filenames)
+            nfailed = len([res for res in pushresults if not res[0]])
+            if nfailed:
+                raise Exception('%i of %i pushes to the PDL stub failed.' % (nfailed,len(pushresults)))
+            nevents = len(pushresults)
+        elapsed = time.time() - t1
+        if stage not in stages:
+            continue
+        rate = None
+        if elapsed > 0:
+            rate = nevents/elapsed
+        results.append({'stage':stage,'events':nevents,'seconds':elapsed,
+                        'events_per_sec':rate,'peak_rss_kb':getPeakRSS()})
+    quake.sender.close()
+    return results
+
+def main(args):
+    if args.worker:
+        fmt,catalog,configfile = args.worker
+        results = runStages(fmt,catalog,configfile,args.stages.split(','),nprocs=args.nprocs)
+        sys.stdout.write(json.dumps(results)+'\n')
+        sys.exit(0)
+
+    workdir = os.path.abspath(args.workdir)
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    formats = args.formats.split(',')
+    for fmt in formats:
+        if fmt not in FORMATS:
+            print 'Format %s not in %s.' % (fmt,','.join(sorted(FORMATS.keys())))
+            sys.exit(1)
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            print 'Stage %s not in %s.' % (stage,','.join(STAGES))
+            sys.exit(1)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    stubargs = ''
+    if args.stubDelay:
+        stubargs = '--stub-delay=%s' % args.stubDelay
+    configfile = writeConfig(workdir,stubargs=stubargs,poll=args.poll)
+
+    report = {'date':datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+              'host':platform.node(),'python':platform.python_version(),
+              'nprocs':args.nprocs,'poll':args.poll,
+              'results':[]}
+    for fmt in formats:
+        for size in sizes:
+            catalog = getCatalog(fmt,size,workdir)
+            #a fresh process for each load, so peak RSS is for that load alone
+            cmd = [sys.executable,os.path.abspath(__file__),'--worker',fmt,catalog,configfile,
+                   '--stages',args.stages,'--nprocs',str(args.nprocs)]
+            proc = subprocess.Popen(cmd,stdout=subprocess.PIPE)
+            output,errors = proc.communicate()
+            if proc.returncode:
+                print 'Benchmark of %i %s events failed.' % (size,fmt)
+                sys.exit(1)
+            for result in json.loads(output.strip().split('\n')[-1]):
+                result['format'] = fmt
+                result['size'] = size
+                report['results'].append(result)
+                print '%-10s %8i %-6s %10.2f events/sec %8.1f MB peak RSS' % (fmt,size,result['stage'],
+                                                                            result['events_per_sec'] or 0,
+                                                                            result['peak_rss_kb']/1024.0)
+    f = open(args.output,'wt')
+    json.dump(report,f,indent=2)
+    f.close()
+    print 'Results written to %s' % args.output
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the catalog loading pipeline on synthetic catalogs.')
+    parser.add_argument('-f','--formats', dest='formats',default=','.join(sorted(FORMATS.keys())),
+                        help='Comma separated list of catalog formats (default all of %s)' % ','.join(sorted(FORMATS.keys())))
+    parser.add_argument('-s','--sizes', dest='sizes',default=','.join([str(size) for size in DEFAULT_SIZES]),
+                        help='Comma separated list of catalog sizes (default %s)' % ','.join([str(size) for size in DEFAULT_SIZES]))
+    parser.add_argument('-t','--stages', dest='stages',default=','.join(STAGES),
+                        help='Comma separated list of stages to time (default %s)' % ','.join(STAGES))
+    parser.add_argument('-w','--workdir', dest='workdir',default='benchmark',
+                        help='Folder for catalogs, config and output (default ./benchmark)')
+    parser.add_argument('-o','--output', dest='output',default='benchmark.json',
+                        help='JSON results file (default benchmark.json)')
+    parser.add_argument('-n','--nprocs', dest='nprocs',type=int,default=1,
+                        help='Number of processes to render with (default 1)')
+    parser.add_argument('-d','--stub-delay', dest='stubDelay',
+                        help='Seconds the PDL stub should take for each product')
+    parser.add_argument('-p','--poll', dest='poll',action='store_true',default=False,
+                        help='Push through a polling PDL stub instead of starting one for each product')
+    parser.add_argument('--worker', dest='worker',nargs=3,metavar=('FORMAT','CATALOG','CONFIGFILE'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    main(args)
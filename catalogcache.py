@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Persistent cache of parsed catalogs.
+
+The first time a catalog file is read through a catalog module, all of its events are
+parsed and stored (pickled) in an SQLite database, keyed by a hash of the file contents
+and of the module source.  Later runs on the same file, with any time window, read the
+events back from the database instead of parsing the file again.
+"""
+
+#stdlib imports
+import sqlite3
+import hashlib
+import datetime
+import os.path
+import cPickle
+import gc
+
+#local imports
+import parallelparse
+import fasttime
+
+#time window used to parse the whole of a catalog
+PARSE_START = datetime.datetime(1,1,1)
+PARSE_END = datetime.datetime(9999,12,31)
+HASHBLOCK = 1024*1024 #number of bytes to hash at a time
+BLOCKSIZE = 1000 #number of events pickled together (pickling them together is faster and smaller)
+
+def getContentHash(filename):
+    digest = hashlib.sha1()
+    f = open(filename,'rb')
+    while True:
+        data = f.read(HASHBLOCK)
+        if not data:
+            break
+        digest.update(data)
+    f.close()
+    return digest.hexdigest()
+
+def getModuleFile(module):
+    #the source file of a module, rather than the .pyc
+    modulefile = module.__file__
+    if modulefile.endswith('.pyc') or modulefile.endswith('.pyo'):
+        modulefile = modulefile[0:-1]
+    return os.path.abspath(modulefile)
+
+class CatalogCache(object):
+    """
+    SQLite database of parsed catalog events.
+    """
+    def __init__(self,filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER,
+                           mtime REAL, hash TEXT)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS catalogs (key TEXT PRIMARY KEY, module TEXT,
+                           args TEXT, nevents INTEGER, parsetime TEXT)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS blocks (key TEXT, seq INTEGER, mintime INTEGER,
+                           maxtime INTEGER, events BLOB)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS blockidx ON blocks (key, seq)')
+        self.db.commit()
+
+    def getFileHash(self,path):
+        """
+        Get the hash of a file's contents, only reading the file if it has changed since we last hashed it.
+        @param path: File name.
+        @return: Hex digest string.
+        """
+        path = os.path.abspath(path)
+        fstat = os.stat(path)
+        row = self.db.execute('SELECT size,mtime,hash FROM files WHERE path=?',(path,)).fetchone()
+        if row is not None and row[0] == fstat.st_size and row[1] == fstat.st_mtime:
+            return row[2]
+        digest = getContentHash(path)
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?)',(path,fstat.st_size,fstat.st_mtime,digest))
+        self.db.commit()
+        return digest
+
+    def getKey(self,module,args):
+        """
+        Get the cache key for a catalog.
+        @param module: Catalog module.
+        @param args: Arguments for the module's getEvents() function.  Those that are files are
+        identified by their contents, the others by their values.
+        @return: Hex digest string that changes if the module or any of the input files do.
+        """
+        parts = [module.__name__,self.getFileHash(getModuleFile(module))]
+        for arg in args:
+            if os.path.isfile(arg):
+                parts.append(self.getFileHash(arg))
+            else:
+                parts.append(repr(arg))
+        return hashlib.sha1('\n'.join(parts)).hexdigest()
+
+    def hasCatalog(self,key):
+        row = self.db.execute('SELECT nevents FROM catalogs WHERE key=?',(key,)).fetchone()
+        return row is not None
+
+    def addCatalog(self,key,module,args,events):
+        """
+        Store the parsed events of a catalog, replacing any older version of the same catalog.
+        @param key: Cache key from getKey().
+        @param module: Catalog module.
+        @param args: Arguments for the module's getEvents() function.
+        @param events: Sequence of event dictionaries.
+        """
+        argstr = repr([os.path.abspath(arg) if os.path.isfile(arg) else arg for arg in args])
+        oldkeys = self.db.execute('SELECT key FROM catalogs WHERE module=? AND args=?',(module.__name__,argstr)).fetchall()
+        for oldkey, in oldkeys + [(key,)]:
+            self.db.execute('DELETE FROM blocks WHERE key=?',(oldkey,))
+            self.db.execute('DELETE FROM catalogs WHERE key=?',(oldkey,))
+        nevents = 0
+        nblocks = 0
+        block = []
+        for event in events:
+            block.append(event)
+            nevents += 1
+            if len(block) == BLOCKSIZE:
+                self.addBlock(key,nblocks,block)
+                nblocks += 1
+                block = []
+        if len(block):
+            self.addBlock(key,nblocks,block)
+        self.db.execute('INSERT INTO catalogs VALUES (?,?,?,?,?)',(key,module.__name__,argstr,nevents,
+                                                                   datetime.datetime.utcnow().isoformat()))
+        self.db.commit()
+
+    def addBlock(self,key,seq,events):
+        times = [fasttime.toEpoch(event['time']) for event in events]
+        data = sqlite3.Binary(cPickle.dumps(events,cPickle.HIGHEST_PROTOCOL))
+        self.db.execute('INSERT INTO blocks VALUES (?,?,?,?,?)',(key,seq,min(times),max(times),data))
+
+    def getCatalogEvents(self,key,startDate=None,endDate=None):
+        """
+        Read events back from the cache.
+        @param key: Cache key from getKey().
+        @param startDate: Earliest event time datetime, or None.
+        @param endDate: Latest event time datetime, or None.
+        @return: Generator of event dictionaries, in the order they were parsed.
+        """
+        starttime = -2**63
+        endtime = 2**63-1
+        if startDate is not None:
+            starttime = fasttime.toEpoch(startDate)
+        if endDate is not None:
+            endtime = fasttime.toEpoch(endDate)
+        cursor = self.db.execute('SELECT events FROM blocks WHERE key=? AND maxtime>=? AND mintime<=? ORDER BY seq',
+                                 (key,starttime,endtime))
+        for row in cursor:
+            #the garbage collector makes unpickling many events several times slower
+            gcenabled = gc.isenabled()
+            gc.disable()
+            try:
+                events = cPickle.loads(str(row[0]))
+            finally:
+                if gcenabled:
+                    gc.enable()
+            for event in events:
+                if startDate is not None and event['time'] < startDate:
+                    continue
+                if endDate is not None and event['time'] > endDate:
+                    continue
+                yield event
+
+    def getEvents(self,module,args,startDate=None,endDate=None,nprocs=1):
+        """
+        Get events from a catalog, parsing it and caching the results if it isn't already cached.
+        @param module: Catalog module.
+        @param args: Arguments for the module's getEvents() function.
+        @param startDate: Earliest event time datetime, or None.
+        @param endDate: Latest event time datetime, or None.
+        @param nprocs: Number of processes to parse the catalog with (see parallelparse.py).
+        @return: Generator of event dictionaries with times in the window.
+        """
+        key = self.getKey(module,args)
+        if not self.hasCatalog(key):
+            #the parallel parser reads one file, so anything else is parsed the same way as without a cache
+            if nprocs > 1 and parallelparse.isParallel(module,args):
+                events = parallelparse.getEvents(module,args[0],startDate=PARSE_START,endDate=PARSE_END,nprocs=nprocs)
+            else:
+                events = module.getEvents(args,startDate=PARSE_START,endDate=PARSE_END)
+            self.addCatalog(key,module,args,events)
+        return self.getCatalogEvents(key,startDate,endDate)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
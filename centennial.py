@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
-import datetime
-import math
+#third party imports
+import numpy
+
+#local imports
+import fasttime
+import fixedwidth
 
 #1900-07-29 06:59:00.00
 TIMEFMT = '%Y-%m-%d %H:%M:%S.%f'
@@ -19,85 +23,93 @@ AZGAP = {'':'Unknown azimuthal gap',
 #ABE        1905  4 19  12 25  0.00  -32.000-171.000   0.0 179   0 6.8 Ms AN2   0.0          0.0          0.0          0.0          0.0          0.0          0.0
 #---- SCHL  1905  7 23   2 46 12.00   49.300  94.900   0.0 333   0 8.5 Mw SCHL  7.7 Ms AN2   8.2 mB ABE1  8.2 UK G&R   8.7 UK PAS   0.0          0.0          0.0
 
+#(field,start,end,type) of each column, in the stripped lines (see fixedwidth.py)
+FIELDS = [('icat',0,6,str),('asol',5,6,str),('isol',7,11,str),
+          ('year',11,15,int),('month',15,18,int),('day',18,21,int), #fortran i4,2i3
+          ('hour',22,25,int),('minute',25,28,int),('second',28,34,float), #fortran 2i3,f6.2
+          ('lat',35,43,float),('lon',43,51,float), #fortran 2f8.3
+          ('depth',51,57,float), #f6.1
+          ('fereg',57,61,int),('nstations',61,65,int), #2i4
+          ('mag1',65,69,float),('method',70,72,str),('source',72,77,str), #f4.1,a2,a5
+          ('mag2',78,82,str),('method2',83,85,str)] #mag2 is converted only if there's a first magnitude
+TIMEFIELDS = ['year','month','day','hour','minute','second']
+SCHEMA = fixedwidth.Schema(FIELDS)
+#the times are parsed a column at a time, so the rest of each event is parsed without them
+RECORDSCHEMA = fixedwidth.Schema([field for field in FIELDS if field[0] not in TIMEFIELDS])
+
+RECORDLINES = 1 #one event per line
+HEADERLINES = 0
+DATE_FILTERED = True #getEvents() only returns events in the time window
+
 def getEvents(args,startDate=None,endDate=None):
     f = open(args[0],'rt')
     lines = f.readlines()
     f.close()
-    eqdict = {}
-    for line in lines:
-        eqdict = {}
-        line = line.strip()
-        eqdict['icat'] = line[0:6].strip()
-        eqdict['asol'] = line[5].strip()
-        
-        eqdict['isol'] = line[7:11].strip()
-        year = int(line[11:15])
-        #fortran 2i3
-        month = int(line[15:18].strip())
-        day = int(line[18:21].strip())
-        #fortran 2i3
-        hour = int(line[22:25].strip())
-        minute = int(line[25:28].strip())
-        #fortran f6.2
-        second = float(line[28:34].strip())
-        millisecond = int((second - math.floor(second))*1e6)
-        second = int(math.floor(second))
+    return parseRecords(lines,startDate,endDate)
 
-        #at least one event appears to have undefined values for day,hour,min
-        if day == 0:
-            day = 1
-            
-        eqdict['time'] = datetime.datetime(year,month,day,hour,minute,second,millisecond)
-        #filter out events outside time window
-        if eqdict['time'] < startDate or eqdict['time'] > endDate:
-            continue
+def parseRecords(lines,startDate=None,endDate=None):
+    """
+    Parse catalog lines into event dictionaries (see parallelparse.py).
+    @param lines: List of catalog lines.
+    @param startDate: Earliest event time datetime, or None.
+    @param endDate: Latest event time datetime, or None.
+    @return: Generator of event dictionaries.
+    """
+    lines = [line.strip() for line in lines]
+    #the times of all of the events, at once (see fasttime.py)
+    columns = SCHEMA.parseColumns(lines,TIMEFIELDS)
+    second = columns['second']
+    microsecond = ((second - numpy.floor(second))*1e6).astype(int)
+    second = numpy.floor(second).astype(int)
+
+    #at least one event appears to have undefined values for day,hour,min
+    day = columns['day']
+    day[day == 0] = 1
+
+    times = fasttime.getEpochTimes(columns['year'],columns['month'],day,columns['hour'],columns['minute'],
+                                   second,microsecond)
+    #filter out events outside time window
+    keep = fasttime.getWindow(times,startDate,endDate)
+    indices = numpy.flatnonzero(keep).tolist()
+    etimes = fasttime.toDatetimes(times[keep])
+    ids = fasttime.getTimeIds(times[keep])
+    for i in range(0,len(indices)):
+        fields = RECORDSCHEMA.parseRecord(lines[indices[i]])
+        eqdict = {}
+        eqdict['icat'] = fields['icat']
+        eqdict['asol'] = fields['asol']
+        eqdict['isol'] = fields['isol']
+        eqdict['time'] = etimes[i]
         
         if eqdict['asol'] in AZGAP.keys():
             eqdict['magcomment'] = AZGAP[eqdict['asol']]
         else:
             eqdict['magcomment'] = 'Unknown azimuthal gap'
-        eqdict['id'] = eqdict['time'].strftime('%Y%m%d%H%M%S')
-
-        
-        
-        #fortran 2f8.3
-        eqdict['lat'] = float(line[35:43].strip())
-        eqdict['lon'] = float(line[43:51].strip())
-
-        #f6.1
-        eqdict['depth'] = float(line[51:57].strip())*1000
-
-        #2i4
-        eqdict['fereg'] = int(line[57:61].strip())
-        
-        eqdict['nstations'] = int(line[61:65].strip())
+        eqdict['id'] = ids[i]
+        eqdict['lat'] = fields['lat']
+        eqdict['lon'] = fields['lon']
+        eqdict['depth'] = fields['depth']*1000
+        eqdict['fereg'] = fields['fereg']
+        eqdict['nstations'] = fields['nstations']
     
         #there can be as many as 8 (?) contributed magnitudes - let's get them all
-        #f4.1
         maglist = []
-        startidx = 65
-        for ic in range(0,2):
-            magdict = {}
-            magdict['mag'] = float(line[startidx:startidx+4].strip())
-            if magdict['mag'] == 0:
+        for mag,method in [(fields['mag1'],fields['method']),(fields['mag2'],fields['method2'])]:
+            #lines without a first magnitude can stop short of the second
+            mag = float(mag)
+            if mag == 0:
                 break
-            magdict['method'] = line[startidx+5:startidx+7].strip()
-            if magdict['method'].lower() != 'ms' and ic > 0:
+            if method.lower() != 'ms' and len(maglist):
                 break
+            magdict = {}
+            magdict['mag'] = mag
+            magdict['method'] = method
             magdict['evalstatus'] = 'final'
             magdict['evalmode'] = 'manual'
-            maglist.append(magdict.copy())
-            startidx += 13
+            maglist.append(magdict)
         eqdict['magnitude'] = maglist
-
-        #a2
-        try:
-            eqdict['method'] = line[70:72].strip()
-        except:
-            pass    
-
-        #a5
-        eqdict['source'] = line[72:77].strip()
+        eqdict['method'] = fields['method']
+        eqdict['source'] = fields['source']
 
         #tell PDL what the evaluation mode/status are
         eqdict['evalmode'] = 'manual'
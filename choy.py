@@ -11,13 +11,23 @@ import subprocess
 import sys
 import urllib,urllib2
 
+#third party imports
+import numpy
+
+#local imports
+import fasttime
+import fixedwidth
+
 TIMEFMT = '%Y-%m-%dT%H:%M:%S.%f'
+#fixed width date and time at the start of each line: YYYYMMDD HHMMSS.SS (see fixedwidth.py)
+TIMESCHEMA = fixedwidth.Schema([('year',0,4,int),('month',4,6,int),('day',6,8,int),
+                                ('hour',9,11,int,0),('minute',11,13,int,0),('second',13,15,int,0),
+                                ('hundredths',16,18,int)])
+RECORDLINES = 1 #one event per line, after a header line
+HEADERLINES = 1
+DATE_FILTERED = True #getEvents() only returns events in the time window
 
 def getEvents(args,startDate=None,endDate=None):
-    if startDate is None:
-        startDate = datetime.datetime(1800,1,1)
-    if endDate is None:
-        endDate = datetime.utcnow()
     fname = args[0]
     if not os.path.isfile(fname):
         raise Exception('File %s does not exist' % fname)
@@ -26,36 +36,35 @@ def getEvents(args,startDate=None,endDate=None):
     f.readline()
     lines = f.readlines()
     f.close()
-    for line in lines:
-        event = {}
-        line = line.strip()
-        datestr = line[0:8]
-        year = int(datestr[0:4])
-        month = int(datestr[4:6])
-        day = int(datestr[6:8])
-        line = line[9:]
-        timestr = line[0:9]
-        try:
-            hour = int(timestr[0:2])
-        except:
-            hour = 0
-        try:
-            minute = int(timestr[2:4])
-        except:
-            minute = 0
-        try:
-            second = int(timestr[4:6])
-        except:
-            second = 0
-        microsecond = int(int(timestr[7:9])*1e4) #multiplying hundredths of a second by 10000
-        time = datetime.datetime(year,month,day,hour,minute,second,microsecond)
-        if time < startDate or time > endDate:
-            continue
-        line = line[10:]
-        parts = line.split()
+    return parseRecords(lines,startDate,endDate)
+
+def parseRecords(lines,startDate=None,endDate=None):
+    """
+    Parse catalog lines (after the header) into event dictionaries (see parallelparse.py).
+    @param lines: List of catalog lines.
+    @param startDate: Earliest event time datetime, or None.
+    @param endDate: Latest event time datetime, or None.
+    @return: Generator of event dictionaries.
+    """
+    if startDate is None:
+        startDate = datetime.datetime(1800,1,1)
+    if endDate is None:
+        endDate = datetime.datetime.utcnow()
+    lines = [line.strip() for line in lines]
+    #the times of all of the events, at once (see fasttime.py)
+    columns = TIMESCHEMA.parseColumns(lines)
+    microsecond = columns['hundredths']*10000 #multiplying hundredths of a second by 10000
+    times = fasttime.getEpochTimes(columns['year'],columns['month'],columns['day'],
+                                   columns['hour'],columns['minute'],columns['second'],microsecond)
+    keep = fasttime.getWindow(times,startDate,endDate)
+    indices = numpy.flatnonzero(keep).tolist()
+    etimes = fasttime.toDatetimes(times[keep])
+    ids = fasttime.getTimeIds(times[keep])
+    for i in range(0,len(indices)):
+        parts = lines[indices[i]][19:].split()
         event = {}
-        event['time'] = time
-        event['id'] = time.strftime('%Y%m%d%H%M%S')
+        event['time'] = etimes[i]
+        event['id'] = ids[i]
         event['lat'] = float(parts[0])
         event['lon'] = float(parts[1])
         event['depth'] = float(parts[2])*1000
@@ -69,6 +78,7 @@ def getEvents(args,startDate=None,endDate=None):
         me = (2.0/3.0) * (math.log10(event['energy']) - 4.4)
         mag = {'mag':round(me*10.0)/10.0,'method':'Me','evalstatus':'reviewed','evalmode':'manual'}
         event['magnitude'] = [mag]
+        event['mag'] = mag['mag'] #the focal mechanism template wants this
         yield event
 
 if __name__ == '__main__':
@@ -6,14 +6,24 @@ import os.path
 import datetime
 import optparse
 import importlib
+import time
 from xml.dom import minidom
+from multiprocessing.pool import ThreadPool
 
 #local imports
 import comquakeml
+import eventrecord
+import manifest
+import parallelparse
+import catalogcache
 
 TIMEFMT = '%Y-%m-%d %H:%M:%S'
 DEFAULT_START = datetime.datetime(1000,1,1)
 DEFAULT_END = datetime.datetime(3000,1,1)
+DEFAULT_JOBS = 1
+DEFAULT_RETRIES = 2
+RETRY_DELAY = 2.0 #seconds to wait before the first retry, doubled for each one after that
+RENDER_CHUNK = 1000 #number of events handed to the render processes at a time
 
 def getEventTime(xmlfile):
     root = minidom.parse(xmlfile)
@@ -124,6 +134,159 @@ def processEvent(quake,event,origins,events,numevents,ievent):
         x = 1
     return (filename,oidx)
 
+def filterEvents(events,quake,xmlfiles,etimes,stats,pmanifest,hashes):
+    """
+    Skip events whose products are already up to date, keeping track of the input.
+    @param events: Sequence of event dictionaries from a catalog module.
+    @param quake: QuakeML object.
+    @param xmlfiles: List that the names of rendered XML files that still need pushing are appended to.
+    @param etimes: Dictionary of event times keyed by XML file name, updated for the skipped events.
+    @param stats: Dictionary with earliest and latest event times and the number of new events, updated as we go.
+    @param pmanifest: Manifest object.
+    @param hashes: Dictionary of input hashes keyed by event ID, filled in for the new events.
+    @return: Generator of new or changed event dictionaries.
+    """
+    settings = manifest.getSettings(quake)
+    for event in events:
+        if checkEvent(event,settings,xmlfiles,etimes,stats,pmanifest,hashes):
+            yield event
+
+def filterBatches(batches,quake,xmlfiles,etimes,stats,pmanifest,hashes):
+    """
+    Skip events whose products are already up to date, as filterEvents() does, for batches of events.
+    @param batches: Sequence of event batches from a catalog module getEventBatches() function.
+    @return: Generator of batches of new or changed events.
+    (The other parameters are as for filterEvents().)
+    """
+    settings = manifest.getSettings(quake)
+    for batch in batches:
+        rows = eventrecord.getBatchRows(batch)
+        keep = [i for i in range(0,len(rows)) if checkEvent(rows[i],settings,xmlfiles,etimes,stats,pmanifest,hashes)]
+        if len(keep):
+            yield eventrecord.selectBatch(batch,keep)
+
+def checkEvent(event,settings,xmlfiles,etimes,stats,pmanifest,hashes):
+    #keep track of an event for filterEvents() or filterBatches(), returning True if it needs rendering
+    if event['time'] < stats['earliest']:
+        stats['earliest'] = event['time']
+    if event['time'] > stats['latest']:
+        stats['latest'] = event['time']
+    inputhash = manifest.getEventHash(event,settings)
+    status = pmanifest.getStatus(event['id'],inputhash)
+    if status == manifest.DONE:
+        return False
+    if status == manifest.PUSH:
+        xmlfile = pmanifest.getProduct(event['id'])['xmlfile']
+        xmlfiles.append(xmlfile)
+        etimes[xmlfile] = event['time']
+        return False
+    hashes[event['id']] = inputhash
+    sys.stderr.write('Parsing event %s\n' % event['time'])
+    stats['numevents'] += 1
+    return True
+
+def filterDates(events,startdate,enddate):
+    #for catalog modules that don't leave out the events outside the time window themselves
+    for event in events:
+        if event['time'] >= startdate and event['time'] <= enddate:
+            yield event
+
+def renderBatch(quake,batch,pool,nprocs,producttype,summary,xmlfiles,etimes,pmanifest,hashes):
+    """
+    Render a list of events with a pool of processes.
+    @param quake: QuakeML object.
+    @param batch: List of (event,origins) tuples, where origins has at most one origin.
+    @param pool: Pool from quake.getRenderPool().
+    @param nprocs: Number of processes in the pool.
+    @param producttype: Product type option.
+    @param summary: List of summary strings, appended to for events without an origin.
+    @param xmlfiles: List of XML file names, appended to.
+    @param etimes: Dictionary of event times keyed by XML file name, updated.
+    @param pmanifest: Manifest object, updated with the rendered files.
+    @param hashes: Dictionary of input hashes keyed by event ID.
+    """
+    events = [event for event,origins in batch]
+    eorigins = []
+    for event,origins in batch:
+        if len(origins):
+            eorigins.append(origins[0])
+        else:
+            eorigins.append(None)
+    filenames = quake.renderEvents(events,eorigins,nprocs=nprocs,pool=pool)
+    for i in range(0,len(batch)):
+        event,origins = batch[i]
+        print 'Rendered event %s to %s' % (event['id'],filenames[i])
+        if len(origins) != 1 and producttype != 'origin':
+            summary.append(getSummary(event,origins,-1))
+        xmlfiles.append(filenames[i])
+        etimes[filenames[i]] = event['time']
+        pmanifest.recordRender(event['id'],hashes[event['id']],filenames[i])
+
+def pushFile(quake,xmlfile,nelapsed,trumpWeight,retries):
+    """
+    Push a QuakeML file to PDL, retrying failures with exponential backoff.
+    @param quake: QuakeML object.
+    @param xmlfile: QuakeML file name.
+    @param nelapsed: Number of days since the event.
+    @param trumpWeight: Trump weight string, or None.
+    @param retries: Maximum number of times to retry the file.
+    @return: (xmlfile,success,output,errors) tuple.
+    """
+    res,output,errors = quake.push(xmlfile,trumpWeight,nelapsed=nelapsed)
+    attempt = 0
+    while not res and attempt < retries:
+        time.sleep(RETRY_DELAY * 2**attempt)
+        res,output,errors = quake.push(xmlfile,trumpWeight,nelapsed=nelapsed)
+        attempt += 1
+    return (xmlfile,res,output,errors)
+
+def pushFiles(quake,xmlfiles,etimes,trumpWeight=None,njobs=DEFAULT_JOBS,retries=DEFAULT_RETRIES,pmanifest=None):
+    """
+    Push QuakeML files to PDL with a pool of worker threads.
+    @param quake: QuakeML object.
+    @param xmlfiles: List of QuakeML file names (None entries are skipped).
+    @param etimes: Dictionary of event times keyed by QuakeML file name.  Files not found
+    here are parsed to find the event time.
+    @param trumpWeight: Trump weight string, or None.
+    @param njobs: Number of pushes to run at once.
+    @param retries: Maximum number of times to retry a failed file.
+    @param pmanifest: Manifest object to record the results in, or None.
+    @return: List of (xmlfile,output,errors) tuples for the files that could not be sent.
+    """
+    now = datetime.datetime.utcnow()
+    tasks = [] #(xmlfile,nelapsed) of each file, each pushed (and retried) by one worker
+    for xmlfile in xmlfiles:
+        if xmlfile is None:
+            continue
+        if etimes.has_key(xmlfile):
+            etime = etimes[xmlfile]
+        else:
+            etime = getEventTime(xmlfile)
+        nelapsed = (now - etime).days
+        tasks.append((xmlfile,nelapsed))
+    failures = []
+    pool = ThreadPool(njobs)
+    try:
+        def worker(task):
+            xmlfile,nelapsed = task
+            return pushFile(quake,xmlfile,nelapsed,trumpWeight,retries)
+        for xmlfile,res,output,errors in pool.imap_unordered(worker,tasks):
+            p,fname = os.path.split(xmlfile)
+            if pmanifest is not None:
+                if res:
+                    pmanifest.recordPush(xmlfile,res,output)
+                else:
+                    pmanifest.recordPush(xmlfile,res,errors)
+            if not res:
+                print 'Failed to send quakeML file %s. Output: "%s" Error: "%s"' % (fname,output,errors)
+                failures.append((xmlfile,output,errors))
+            else:
+                print 'Sent quakeML file %s, output %s.' % (fname,output)
+    finally:
+        pool.close()
+        pool.join()
+    return failures
+
 #this should be a generator
 def getEvents():
     #yield event
@@ -148,8 +311,8 @@ def main(options,args):
     except ImportError:
         print '%s does not appear to be a valid Python module.' % modname
         sys.exit(1)
-    if not module.__dict__.has_key('getEvents'):
-        print '%s does not appear to have the required function getEvents().'
+    if not module.__dict__.has_key('getEvents') and not module.__dict__.has_key('getEventBatches'):
+        print '%s does not appear to have the required function getEvents() or getEventBatches().'
         sys.exit(1)
     twindow = 16
     dwindow = 100
@@ -190,6 +353,34 @@ def main(options,args):
         except:
             print 'Could not parse end date "%s"' % options.endDate
             sys.exit(1)
+    njobs = DEFAULT_JOBS
+    retries = DEFAULT_RETRIES
+    nprocs = 1
+    nparse = 1
+    try:
+        if options.jobs is not None:
+            njobs = int(options.jobs)
+        if options.retries is not None:
+            retries = int(options.retries)
+        if options.nprocs is not None:
+            nprocs = int(options.nprocs)
+        if options.parseProcs is not None:
+            nparse = int(options.parseProcs)
+    except ValueError:
+        print 'Number of jobs, retries and processes must be integer values.'
+        sys.exit(1)
+    if njobs < 1 or retries < 0 or nprocs < 1 or nparse < 1:
+        print 'Number of jobs and processes must be at least 1, and retries must not be negative.'
+        sys.exit(1)
+    if nparse > 1 and not parallelparse.isParallel(module):
+        print '%s can not be parsed in parallel, using one process.' % modname
+        nparse = 1
+    if nparse > 1 and not parallelparse.isParallel(module,args[1:]):
+        print 'Only a single uncompressed catalog file can be parsed in parallel, using one process.'
+        nparse = 1
+    if options.cache is not None and not module.__dict__.has_key('getEvents'):
+        print '%s only reads batches of events, which can not be cached.' % modname
+        sys.exit(1)
     if options.producttype is not None:
         types = [comquakeml.ORIGIN,comquakeml.FOCAL,comquakeml.TENSOR]
         ptype = options.producttype
@@ -199,76 +390,130 @@ def main(options,args):
     quake = comquakeml.QuakeML(ptype,folder,catalog=catalog,agency=agency,
                             triggersource=triggersource,contributor=contributor,
                             method=method,timewindow=twindow,distwindow=dwindow)
+    manifestfile = os.path.join(quake.xmlfolder,manifest.MANIFESTFILE)
+    if options.manifest is not None:
+        manifestfile = options.manifest
+    clearmanifest = False
     if options.clear:
         resp = raw_input('You set the option to clear all existing QuakeML output.  Are you sure? Y/[n]')
         if resp.strip().lower() == 'y':
             quake.clearOutput()
+            clearmanifest = True
         else:
             print 'Not clearing QuakeML output.'
+    pmanifest = manifest.Manifest(manifestfile)
+    if clearmanifest:
+        pmanifest.clear()
 
     #parse the input data from file, database, webserver, whatever
     earliest = datetime.datetime(3000,1,1)
     latest = datetime.datetime(1,1,1)
     xmlfiles = []
+    etimes = {} #event times of the xml files, so we don't have to parse them again when pushing
+
+    ccache = None
+    batches = None #blocks of events as columns, from modules that can read them that way
+    datefiltered = module.__dict__.get('DATE_FILTERED',False)
+    if options.cache is not None:
+        #parse the whole catalog once, then read the time window we want from the cache
+        ccache = catalogcache.CatalogCache(options.cache)
+        events = ccache.getEvents(module,args[1:],startDate=startdate,endDate=enddate,nprocs=nparse)
+        datefiltered = True
+    elif nparse > 1:
+        events = parallelparse.getEvents(module,args[1],startDate=startdate,endDate=enddate,nprocs=nparse)
+    elif module.__dict__.has_key('getEventBatches'):
+        batches = module.getEventBatches(args[1:],startDate=startdate,endDate=enddate)
+        if not datefiltered:
+            batches = (eventrecord.selectTimes(batch,startdate,enddate) for batch in batches)
+        events = (event for batch in batches for event in eventrecord.getBatchRecords(batch))
+    else:
+        events = module.getEvents(args[1:],startDate=startdate,endDate=enddate)
+    #the module getEvents() function doesn't have to do anything with the startDate and endDate parameters
+    if not datefiltered and batches is None:
+        events = filterDates(events,startdate,enddate)
 
     if options.delete:
         numdeleted = 0
-        for event in module.getEvents(args[1:],startDate=startdate,endDate=enddate):
+        for event in events:
             quake.delete(event)
+            pmanifest.remove(event['id'])
             numdeleted += 1
         print '%i events were deleted.  Exiting.' % numdeleted
+        pmanifest.close()
+        if ccache is not None:
+            ccache.close()
         sys.exit(0)
     
-    numevents = 0
-    #the module getEvents() function doesn't have to do anything with the startDate and endDate parameters
-    for event in module.getEvents(args[1:],startDate=startdate,endDate=enddate):
-        if event['time'] < earliest:
-            earliest = event['time']
-        if event['time'] > latest:
-            latest = event['time']
-        xmlfile = os.path.join(quake.xmlfolder,'%s.xml' % event['id'])
-        if os.path.isfile(xmlfile):
-            xmlfiles.append(xmlfile)
-            continue
-        if event['time'] > datetime.datetime(2007,9,30):
-            pass
-        quake.add(event)
-        sys.stderr.write('Parsing event %s\n' % event['time'])
-        numevents += 1
+    stats = {'earliest':earliest,'latest':latest,'numevents':0}
+    hashes = {} #input hashes of the events we render, keyed by event ID
+    if batches is not None and not options.stream:
+        #add whole batches at a time, without making a dictionary for each event
+        for batch in filterBatches(batches,quake,xmlfiles,etimes,stats,pmanifest,hashes):
+            quake.addBatch(batch)
+        eventsource = quake.generateEvents()
+    elif options.stream:
+        #render each event as soon as its association window has passed
+        eventsource = quake.streamEvents(filterEvents(events,quake,xmlfiles,etimes,stats,pmanifest,hashes))
+    else:
+        quake.addEvents(filterEvents(events,quake,xmlfiles,etimes,stats,pmanifest,hashes))
+        eventsource = quake.generateEvents()
         
     numnear = len(quake.NearEventIndices)
     numprocessed = 0
     summary = [] #list of events that were not associated, or were associated manually
-    for event,origins,events in quake.generateEvents():
-        xmlfile,oidx = processEvent(quake,event,origins,events,numevents,numprocessed)
+    pool = None
+    if nprocs > 1:
+        pool = quake.getRenderPool(nprocs)
+    batch = [] #events that don't need a person to choose an origin, waiting to be rendered by the pool
+    for event,origins,events in eventsource:
+        if pool is not None and len(origins) <= 1:
+            batch.append((event,origins))
+            if len(batch) == RENDER_CHUNK:
+                renderBatch(quake,batch,pool,nprocs,options.producttype,summary,xmlfiles,etimes,pmanifest,hashes)
+                numprocessed += len(batch)
+                batch = []
+            continue
+        xmlfile,oidx = processEvent(quake,event,origins,events,stats['numevents'],numprocessed)
         if xmlfile is None:
             x = 1
         if len(origins) != 1 and options.producttype != 'origin':
             summary.append(getSummary(event,origins,oidx))
         xmlfiles.append(xmlfile)
+        if xmlfile is not None:
+            etimes[xmlfile] = event['time']
+            pmanifest.recordRender(event['id'],hashes[event['id']],xmlfile)
         numprocessed += 1
+    if pool is not None:
+        renderBatch(quake,batch,pool,nprocs,options.producttype,summary,xmlfiles,etimes,pmanifest,hashes)
+        numprocessed += len(batch)
+        pool.close()
+        pool.join()
         
+    failures = []
+    pushfiles = [xmlfile for xmlfile in xmlfiles if xmlfile is not None]
     if options.load:
-        for xmlfile in xmlfiles:
-            if xmlfile is None:
-                continue
-            etime = getEventTime(xmlfile)
-            nelapsed = (datetime.datetime.utcnow() - etime).days
-            res,output,errors = quake.push(xmlfile,options.trumpWeight,nelapsed=nelapsed)
-            p,fname = os.path.split(xmlfile)
-            if not res:
-                print 'Failed to send quakeML file %s. Output: "%s" Error: "%s"' % (fname,output,errors)
-            else:
-                print 'Sent quakeML file %s, output %s.' % (fname,output)
+        failures = pushFiles(quake,pushfiles,etimes,trumpWeight=options.trumpWeight,
+                             njobs=njobs,retries=retries,pmanifest=pmanifest)
+        quake.sender.close()
+    pmanifest.close()
+    if ccache is not None:
+        ccache.close()
 
-    if not len(summary):
+    if not len(summary) and not len(failures):
         sys.exit(0)
+    earliest = stats['earliest']
+    latest = stats['latest']
     DAYFMT = '%Y-%m-%d'
     print
     print 'Summary for period %s to %s:' % (earliest.strftime(DAYFMT),latest.strftime(DAYFMT))
     for eventinfo in summary:
         print eventinfo
         print
+    if len(failures):
+        print '%i of %i QuakeML files could not be sent to PDL after %i retries:' % (len(failures),len(pushfiles),retries)
+        for xmlfile,output,errors in failures:
+            print '\t%s: %s' % (xmlfile,errors.strip())
+        sys.exit(1)
         
         
 if __name__ == '__main__':
@@ -293,6 +538,19 @@ if __name__ == '__main__':
                   help="Set the method used to determine catalog (Mww, Mwc, etc.)", metavar="METHOD")
     parser.add_option("-l", "--load", dest="load",default=False,action="store_true",
                   help="Load catalog of created XML into ComCat")
+    parser.add_option("-s", "--stream", dest="stream",default=False,action="store_true",
+                  help="Render each event as soon as it is read, instead of reading the whole catalog first (input must be in time order)")
+    parser.add_option("-n", "--nprocs", dest="nprocs",
+                  help="Number of processes to render QuakeML with (default 1)", metavar="NPROCS")
+    parser.add_option("-P", "--parse-procs", dest="parseProcs",
+                  help="Number of processes to parse the input file with, for catalog modules that support it (default 1)",
+                  metavar="NPROCS")
+    parser.add_option("-j", "--jobs", dest="jobs",
+                  help="Number of QuakeML files to push to PDL at once when loading (default %i)" % DEFAULT_JOBS,
+                  metavar="JOBS")
+    parser.add_option("--retries", dest="retries",
+                  help="Number of times to retry a failed push, with exponential backoff (default %i)" % DEFAULT_RETRIES,
+                  metavar="RETRIES")
     parser.add_option("-f", "--folder", dest="folder",
                   help="""Set folder for output QuakeML, appended to config output folder.  
     Defaults to current date/time""", metavar="FOLDER")
@@ -308,6 +566,14 @@ if __name__ == '__main__':
     parser.add_option("-c", "--clear",
                   action="store_true", dest="clear", default=False,
                   help="Clear XML output")
+    parser.add_option("-M", "--manifest", dest="manifest",
+                  help="""Set the file recording which products have been rendered and pushed, so that
+    re-runs skip unchanged events (defaults to %s in the output folder)""" % manifest.MANIFESTFILE,
+                  metavar="MANIFEST")
+    parser.add_option("-C", "--cache", dest="cache",
+                  help="""Keep the parsed input catalog in this file, so later runs on the same catalog
+    (with any start and end dates) don't have to parse it again""",
+                  metavar="CACHEFILE")
     parser.add_option("-x", "--delete",
                   action="store_true", dest="delete", default=False,
                   help="Delete specified products")
@@ -10,21 +10,26 @@ import os.path
 import subprocess
 import sys
 import re
-from xml.etree import ElementTree
-import StringIO
 from xml.dom import minidom
 import glob
 import optparse
 import ConfigParser
+import bisect
+import collections
+import multiprocessing
+import gc
 
 #third party imports
-import obspy.imaging.beachball
 import numpy
 import pytz
 
 #local imports
 from neicmap import distance
 from neicutil import timeutil
+import xmltemplate
+import pdlsender
+import eventrecord
+import fasttime
 
 #module constants
 ORIGIN = 'origin'
@@ -34,6 +39,20 @@ TIMEFMT = '%Y-%m-%dT%H:%M:%SZ'
 DEFAULT_MOMENT_METHOD = 'Mwc'
 DEFAULT_SOURCE = 'us'
 PRODUCT_TYPES = [ORIGIN,TENSOR,FOCAL]
+R2D = 180/numpy.pi
+ANGLEKEYS = ['tazimuth','tplunge','tvalue',
+             'nazimuth','nplunge','nvalue',
+             'pazimuth','pplunge','pvalue',
+             'np1strike','np1dip','np1rake',
+             'np2strike','np2dip','np2rake']
+FDSNURL = 'http://comcat.cr.usgs.gov/fdsnws/event/1/query?%s'
+APITIMEFMT = '%Y-%m-%dT%H:%M:%S.%f'
+EPOCH = datetime.datetime(1970,1,1)
+USECS = 1000000 #event times are kept as integer microseconds since EPOCH (see fasttime.py)
+TIMEKEYS = ['time','triggertime','ctime'] #fields rendered with TIMEFMT
+BLOCKDAYS = 30 #length of the time blocks of origins fetched by OriginCache
+PAGESIZE = 20000 #maximum number of events the FDSN service will return in one request
+LATBAND = 10.0 #width in degrees of the latitude bands OriginCache sorts origins into
 
 #string formatting for all of the possible event parameters (for rendering in XML)
 FORMATS = {'id':'%s',
@@ -105,34 +124,16 @@ def getEventId(quakemlfile):
     dom.unlink()
     return eventid
 
-def getCommandOutput(cmd):
+def getEuclidean(lat1,lon1,time1,lat2,lon2,time2,dwindow=100.0,twindow=16.0):
     """
-    Internal method for calling external command.
-    @param cmd: String command ('ls -l', etc.)
-    @return: Two-element tuple containing a boolean indicating success or failure, 
-    and the output from running the command.
+    Get the normalized distance between events, in space and time.
+    @param lat1,lon1,time1: Location and time (integer microseconds since 1970) of the first event.
+    @param lat2,lon2,time2: Location and time of the second event, or numpy arrays of them.
+    @return: (euclidean,distance in km,whole seconds apart) tuple.
     """
-    proc = subprocess.Popen(cmd,
-                            shell=True,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE
-                            )
-    output,errors = proc.communicate()
-    retcode = proc.returncode
-    if retcode == 0:
-        retcode = True
-    else:
-        retcode = False
-    return (retcode,output,errors)
-
-def getEuclidean(lat1,lon1,time1,lat2,lon2,time2,dwindow=100.0,twindow=16.0):
     dd = distance.sdist(lat1,lon1,lat2,lon2)/1000.0
     normd = dd/dwindow
-    if time2 > time1:
-        dt = time2-time1
-    else:
-        dt = time1-time2
-    nsecs = dt.days*86400 + dt.seconds
+    nsecs = numpy.abs(time2 - time1)//USECS
     normt = nsecs/twindow
     euclid = numpy.sqrt(normd**2 + normt**2)
     return (euclid,dd,nsecs)
@@ -144,6 +145,55 @@ def parseTime(milliseconds):
     etime = etime + datetime.timedelta(0,0,microseconds)
     return etime
 
+def parseFeature(feature):
+    """
+    Turn a GeoJSON feature from the FDSN event service into an origin dictionary.
+    @param feature: GeoJSON feature dictionary.
+    @return: Dictionary with lat,lon,depth,mag,time and id fields.
+    """
+    eventdict = {}
+    eventdict['lon'] = feature['geometry']['coordinates'][0]
+    eventdict['lat'] = feature['geometry']['coordinates'][1]
+    eventdict['depth'] = feature['geometry']['coordinates'][2]
+    eventdict['mag'] = feature['properties']['mag']
+    otime = int(feature['properties']['time'])
+    eventdict['time'] = parseTime(otime)
+    eventdict['id'] = feature['id']
+    return eventdict
+
+def getSearchBox(lat,lon,etime,dwindow,twindow):
+    """
+    Get the time window and bounding box used to search for origins near an event.
+    @param etime: Event time in integer microseconds since 1970.
+    @return: (mintime,maxtime,minlat,maxlat,minlon,maxlon) tuple, with times in microseconds.
+    The longitudes may be outside -180 to 180 when the box crosses the date line.
+    """
+    mintime = etime - int(round(twindow*USECS))
+    maxtime = etime + int(round(twindow*USECS))
+    minlat = lat - dwindow * QuakeML.KM2DEG
+    maxlat = lat + dwindow * QuakeML.KM2DEG
+    minlon = lon - dwindow * QuakeML.KM2DEG * (1/distance.cosd(lat))
+    maxlon = lon + dwindow * QuakeML.KM2DEG * (1/distance.cosd(lat))
+    return (mintime,maxtime,minlat,maxlat,minlon,maxlon)
+
+def scoreOrigins(lat,lon,etime,origins):
+    """
+    Fill in the euclidean,timedelta and distance fields of a list of origins.
+    @param etime: Event time in integer microseconds since 1970.
+    @return: Origins sorted by euclidean distance from the event.
+    """
+    if not len(origins):
+        return []
+    lats = numpy.array([origin['lat'] for origin in origins],dtype=float)
+    lons = numpy.array([origin['lon'] for origin in origins],dtype=float)
+    times = numpy.array([fasttime.toEpoch(origin['time']) for origin in origins],dtype=numpy.int64)
+    euclid,ddist,tdist = getEuclidean(lat,lon,etime,lats,lons,times)
+    for i in range(0,len(origins)):
+        origins[i]['euclidean'] = float(euclid[i])
+        origins[i]['timedelta'] = int(tdist[i])
+        origins[i]['distance'] = float(ddist[i])
+    return sorted(origins,key=lambda origin: origin['euclidean'])
+
 def calculateMagnitude(moment):
     #Calculate moment magnitude from scalar moment in units of ????
     magnitude = (2./3.)*(math.log10(moment)-9.1)
@@ -156,32 +206,170 @@ def getMomentTensorAngles(event):
     ekeys = set(event.keys())
     if not keys.issubset(ekeys):
         raise Exception,'Not all of the keys %s are found in event.' % ','.join(keylist)
-    mrr = event['mrr']
-    mtt = event['mtt']
-    mpp = event['mpp']
-    mrt = event['mrt']
-    mrp = event['mrp']
-    mtp = event['mtp']
-    mt = obspy.imaging.beachball.MomentTensor(mrr,mtt,mpp,mrt,mrp,mtp,1)
-    axes = obspy.imaging.beachball.MT2Axes(mt) #T, N and P
-    plane1 = obspy.imaging.beachball.MT2Plane(mt)
-    plane2 = obspy.imaging.beachball.AuxPlane(plane1.strike,plane1.dip,plane1.rake)
-    event['tazimuth'] = axes[0].strike
-    event['tplunge'] = axes[0].dip
-    event['tvalue'] = axes[0].val
-    event['nazimuth'] = axes[1].strike
-    event['nplunge'] = axes[1].dip
-    event['nvalue'] = axes[1].val
-    event['pazimuth'] = axes[2].strike
-    event['pplunge'] = axes[2].dip
-    event['pvalue'] = axes[2].val
-    event['np1strike'] = plane1.strike
-    event['np1dip'] = plane1.dip
-    event['np1rake'] = plane1.rake
-    event['np2strike'] = plane2[0]
-    event['np2dip'] = plane2[1]
-    event['np2rake'] = plane2[2]
+    components = [numpy.array([event[key]],dtype=float) for key in keylist]
+    angles = getMomentTensorAnglesBatch(*components)
+    for key in ANGLEKEYS:
+        event[key] = angles[key][0]
     return event
+
+def getMomentTensorAnglesBatch(mrr,mtt,mpp,mrt,mrp,mtp):
+    """
+    Get the principal axes and nodal planes of many moment tensors at once.
+    This is a vectorized version of the obspy beachball MT2Axes, MT2Plane and AuxPlane functions.
+    @param mrr,mtt,mpp,mrt,mrp,mtp: Numpy arrays of moment tensor components.
+    @return: Dictionary of numpy arrays, keyed by event field name (tazimuth,tplunge,tvalue,...np2rake).
+    """
+    mt = numpy.zeros((len(mrr),3,3))
+    mt[:,0,0] = mrr
+    mt[:,1,1] = mtt
+    mt[:,2,2] = mpp
+    mt[:,0,1] = mt[:,1,0] = mrt
+    mt[:,0,2] = mt[:,2,0] = mrp
+    mt[:,1,2] = mt[:,2,1] = mtp
+    angles = {}
+    oldsettings = numpy.seterr(all='ignore')
+    try:
+        values,azimuths,plunges = getPrincipalAxes(mt)
+        for i,axis in [(2,'t'),(1,'n'),(0,'p')]:
+            angles[axis+'azimuth'] = azimuths[:,i]
+            angles[axis+'plunge'] = plunges[:,i]
+            angles[axis+'value'] = values[:,i]
+        strike,dip,rake = getNodalPlane(mt)
+        angles['np1strike'] = strike
+        angles['np1dip'] = dip
+        angles['np1rake'] = rake
+        strike,dip,rake = getAuxPlane(strike,dip,rake)
+        angles['np2strike'] = strike
+        angles['np2dip'] = dip
+        angles['np2rake'] = rake
+    finally:
+        numpy.seterr(**oldsettings)
+    return angles
+
+def getPrincipalAxes(mt):
+    #eigenvalues, azimuths and plunges of an Nx3x3 array of tensors, in ascending order of eigenvalue (P,N,T)
+    values,vectors = numpy.linalg.eigh(mt)
+    plunge = numpy.arcsin(-vectors[:,0,:])
+    azimuth = numpy.arctan2(vectors[:,2,:],-vectors[:,1,:])
+    up = plunge <= 0
+    plunge[up] = -plunge[up]
+    azimuth[up] += numpy.pi
+    azimuth[azimuth < 0] += 2*numpy.pi
+    azimuth[azimuth > 2*numpy.pi] -= 2*numpy.pi
+    return (values,azimuth*R2D,plunge*R2D)
+
+def getNodalPlane(mt):
+    #strike,dip and rake arrays of one nodal plane of an Nx3x3 array of tensors
+    values,v = numpy.linalg.eig(mt)
+    values = numpy.real(values)
+    v = numpy.real(v)
+    d = values[:,[1,0,2]]
+    vectors = numpy.empty_like(v)
+    vectors[:,0,:] = numpy.column_stack((v[:,1,1],-v[:,1,0],-v[:,1,2]))
+    vectors[:,1,:] = numpy.column_stack((v[:,2,1],-v[:,2,0],-v[:,2,2]))
+    vectors[:,2,:] = numpy.column_stack((-v[:,0,1],v[:,0,0],v[:,0,2]))
+    rows = numpy.arange(len(mt))
+    vmax = vectors[rows,:,d.argmax(axis=1)]
+    vmin = vectors[rows,:,d.argmin(axis=1)]
+    ae = (vmax + vmin)/numpy.sqrt(2.0)
+    an = (vmax - vmin)/numpy.sqrt(2.0)
+    aer = numpy.sqrt(numpy.sum(ae**2,axis=1))
+    anr = numpy.sqrt(numpy.sum(an**2,axis=1))
+    ae = ae/aer[:,None]
+    an = an/anr[:,None]
+    an[anr == 0] = numpy.nan
+    #we want the normal pointing up (or the nan one, as obspy does)
+    flip = ~(an[:,2] <= 0)
+    an[flip] = -an[flip]
+    ae[flip] = -ae[flip]
+    ft,fd,fl = getTDL(an,ae)
+    return (360 - ft,fd,180 - fl)
+
+def getQuadrantAngle(angle,sinval,cosval):
+    #put an angle from arcsin into the right quadrant given its sine and cosine
+    angle = numpy.where((sinval >= 0) & (cosval < 0),180. - angle,angle)
+    angle = numpy.where((sinval < 0) & (cosval <= 0),180. + angle,angle)
+    angle = numpy.where((sinval < 0) & (cosval > 0),360. - angle,angle)
+    return angle
+
+def getQuadrantRake(angle,sinval,cosval):
+    angle = numpy.where((sinval >= 0) & (cosval < 0),180. - angle,angle)
+    angle = numpy.where((sinval < 0) & (cosval <= 0),angle - 180.,angle)
+    angle = numpy.where((sinval < 0) & (cosval > 0),-angle,angle)
+    return angle
+
+def getTDL(an,bn):
+    #strike,dip,rake from normal and slip vectors (obspy TDL)
+    xn,yn,zn = an[:,0],an[:,1],an[:,2]
+    xe,ye,ze = bn[:,0],bn[:,1],bn[:,2]
+    aaa = 1.0/1000000
+    con = 57.2957795
+    vertical = numpy.fabs(zn) < aaa
+
+    #vertical planes
+    vft = numpy.arcsin(numpy.minimum(numpy.fabs(xn),1.0))*con
+    vft = getQuadrantAngle(vft,-xn,yn)
+    vfl = numpy.arcsin(numpy.fabs(ze))*con
+    vcl = numpy.where(numpy.fabs(xn) < aaa,xe/yn,-ye/xn)
+    vfl = getQuadrantRake(vfl,-ze,vcl)
+
+    #everything else
+    zn = numpy.where(-zn > 1.0,-1.0,zn)
+    fdh = numpy.arccos(-zn)
+    fd = numpy.where(vertical,90.,fdh*con)
+    sd = numpy.sin(fdh)
+    st = -xn/sd
+    ct = yn/sd
+    ft = numpy.arcsin(numpy.minimum(numpy.fabs(st),1.0))*con
+    ft = getQuadrantAngle(ft,st,ct)
+    sl = -ze/sd
+    fl = numpy.arcsin(numpy.minimum(numpy.fabs(sl),1.0))*con
+    cl = -sd*(yn*zn*ze/sd/sd + ye)/xn
+    cl = numpy.where(ct == 0,ye/st,cl)
+    cl = numpy.where(st == 0,xe/ct,cl)
+    fl = getQuadrantRake(fl,sl,cl)
+
+    #obspy gives up on a non-vertical plane with no dip
+    nodip = ~vertical & (sd == 0)
+    ft = numpy.where(vertical,vft,numpy.where(nodip,numpy.nan,ft))
+    fl = numpy.where(vertical,vfl,numpy.where(nodip,numpy.nan,fl))
+    fd = numpy.where(nodip,numpy.nan,fd)
+    return (ft,fd,fl)
+
+def getStrikeDip(n,e,u):
+    #strike and dip arrays of planes with normal vectors given by north,east and up components
+    down = u < 0
+    n = numpy.where(down,-n,n)
+    e = numpy.where(down,-e,e)
+    u = numpy.where(down,-u,u)
+    strike = numpy.arctan2(e,n)*R2D - 90
+    strike = numpy.where(strike < 0,strike + 360,strike)
+    x = numpy.sqrt(n**2 + e**2)
+    dip = numpy.arctan2(x,u)*R2D
+    return (strike,dip)
+
+def getAuxPlane(s1,d1,r1):
+    #strike,dip and rake arrays of the auxiliary planes (obspy AuxPlane)
+    z = (s1 + 90)/R2D
+    z2 = d1/R2D
+    z3 = r1/R2D
+    #slip vector in plane 1
+    sl1 = -numpy.cos(z3)*numpy.cos(z) - numpy.sin(z3)*numpy.sin(z)*numpy.cos(z2)
+    sl2 = numpy.cos(z3)*numpy.sin(z) - numpy.sin(z3)*numpy.cos(z)*numpy.cos(z2)
+    sl3 = numpy.sin(z3)*numpy.sin(z2)
+    strike,dip = getStrikeDip(sl2,sl1,sl3)
+    #normal vector to plane 1
+    n1 = numpy.sin(z)*numpy.sin(z2)
+    n2 = numpy.cos(z)*numpy.sin(z2)
+    #strike vector of plane 2
+    h1 = -sl2
+    h2 = sl1
+    z = (h1*n1 + h2*n2)/numpy.sqrt(h1*h1 + h2*h2)
+    #we might get above 1.0 only due to floating point precision
+    z = numpy.clip(z,-1.0,1.0)
+    z = numpy.arccos(z)*R2D
+    rake = numpy.where(sl3 > 0,z,numpy.where(sl3 <= 0,-z,0))
+    return (strike,dip,rake)
     
 def calculateTotalMoment(mrr,mtt,mpp,mrt,mrp,mtp):
     wm1 = mrr**2 + mtt**2 + mpp**2
@@ -206,6 +394,172 @@ def findMacros(xmltext):
             umacros.append(macro)
     return umacros
 
+#the QuakeML object (stripped down) that each render worker process uses
+renderer = None
+
+def initRenderer(quake):
+    global renderer
+    renderer = quake
+
+def renderTask(task):
+    event,origin,ctime = task
+    return renderer.renderXML(event,origin,ctime=ctime)
+
+class EventIndex(object):
+    """
+    Incremental spatio-temporal index of event hypocenters.
+
+    Events are hashed into time buckets as wide as the largest time separation
+    two "near" events can have, so a new event only has to be compared against
+    the events in its own bucket and the two adjacent ones.
+    """
+    def __init__(self,distwindow,timewindow):
+        self.DistanceWindow = distwindow
+        self.TimeWindow = timewindow
+        #two events with a normalized euclidean distance <= sqrt(2) can't be more than sqrt(2) time windows apart
+        self.BucketWidth = int(numpy.sqrt(2)*timewindow*USECS)
+        if not self.BucketWidth > 0:
+            self.BucketWidth = USECS
+        self.Buckets = {} #bucket number -> list of (index,lat,lon,time) tuples
+        self.Count = 0
+
+    def getBucket(self,time):
+        return int(time//self.BucketWidth)
+
+    def add(self,lat,lon,time):
+        """
+        Add an event to the index.
+        @param lat: Event latitude.
+        @param lon: Event longitude.
+        @param time: Event time in integer microseconds since 1970.
+        @return: Sorted list of the indices of previously added events that are near this one.
+        """
+        bucket = self.getBucket(time)
+        candidates = []
+        for b in (bucket-1,bucket,bucket+1):
+            if self.Buckets.has_key(b):
+                candidates += self.Buckets[b]
+        near = []
+        if len(candidates):
+            candidates.sort()
+            cidx,clat,clon,ctime = zip(*candidates)
+            nplat = numpy.array(clat)
+            nplon = numpy.array(clon)
+            nptime = numpy.array(ctime,dtype=numpy.int64)
+            normdist = (distance.sdist(lat,lon,nplat,nplon)/1000)/self.DistanceWindow
+            normtdelta = (numpy.abs(time - nptime)/float(USECS))/self.TimeWindow
+            eucdistance = numpy.sqrt(normdist**2+normtdelta**2)
+            iclose = numpy.where(eucdistance <= numpy.sqrt(2))
+            for i in iclose[0]:
+                near.append(cidx[i])
+        if not self.Buckets.has_key(bucket):
+            self.Buckets[bucket] = []
+        self.Buckets[bucket].append((self.Count,lat,lon,time))
+        self.Count += 1
+        return near
+
+    def evict(self,time):
+        """
+        Forget events that can't be near any event at or after a given time.
+        @param time: Time in microseconds of the earliest event that will be added from now on.
+        """
+        oldest = self.getBucket(time)-1
+        for bucket in self.Buckets.keys():
+            if bucket < oldest:
+                del self.Buckets[bucket]
+
+class OriginCache(object):
+    """
+    Origins fetched from the FDSN event service in large time blocks, for associating
+    many events without making a request for each one.
+
+    Each block is split into latitude bands, each holding its origins sorted by time,
+    and the search box of associate2() is applied locally.
+    """
+    def __init__(self,triggersource=None,url=FDSNURL,blockdays=BLOCKDAYS):
+        self.TriggerSource = triggersource
+        self.Url = url
+        self.BlockDays = blockdays
+        self.Blocks = {} #block number: {band: (times in microseconds,origins)}
+
+    def getBlock(self,time):
+        return time // (self.BlockDays*86400*USECS)
+
+    def getBand(self,lat):
+        return int(math.floor(lat/LATBAND))
+
+    def fetchBlock(self,block):
+        starttime = EPOCH + datetime.timedelta(days=block*self.BlockDays)
+        endtime = EPOCH + datetime.timedelta(days=(block+1)*self.BlockDays)
+        pdict = {'starttime':starttime.strftime(APITIMEFMT),'endtime':endtime.strftime(APITIMEFMT),
+                 'catalog':self.TriggerSource,'format':'geojson','eventtype':'earthquake',
+                 'orderby':'time-asc','limit':PAGESIZE}
+        if self.TriggerSource == "" or self.TriggerSource is None:
+            pdict.pop('catalog')
+        bands = {}
+        ids = set()
+        offset = 1
+        while True:
+            pdict['offset'] = offset
+            searchurl = self.Url % urllib.urlencode(pdict)
+            try:
+                fh = urllib2.urlopen(searchurl)
+                data = fh.read()
+                fh.close()
+                features = json.loads(data)['features']
+            except Exception,msg:
+                raise Exception,'Could not reach "%s" - error "%s"' % (searchurl,str(msg))
+            for feature in features:
+                origin = parseFeature(feature)
+                #the end time is inclusive, so the next block may have this one too
+                if origin['time'] >= endtime or origin['id'] in ids:
+                    continue
+                ids.add(origin['id'])
+                band = self.getBand(origin['lat'])
+                if not bands.has_key(band):
+                    bands[band] = []
+                bands[band].append((fasttime.toEpoch(origin['time']),origin))
+            if len(features) < PAGESIZE:
+                break
+            offset += PAGESIZE
+        for band in bands.keys():
+            borigins = sorted(bands[band],key=lambda torigin: torigin[0])
+            bands[band] = ([t for t,o in borigins],[o for t,o in borigins])
+        self.Blocks[block] = bands
+
+    def fetch(self,mintime,maxtime):
+        """
+        Make sure all of the origins between two times (in microseconds since 1970) have been fetched.
+        """
+        for block in range(self.getBlock(mintime),self.getBlock(maxtime)+1):
+            if not self.Blocks.has_key(block):
+                self.fetchBlock(block)
+
+    def getOrigins(self,mintime,maxtime,minlat,maxlat,minlon,maxlon):
+        """
+        Get the origins inside a time window and bounding box, as the FDSN service would.
+        @param mintime,maxtime: Time window in integer microseconds since 1970.
+        @return: List of copies of origin dictionaries, most recent first.
+        """
+        self.fetch(mintime,maxtime)
+        origins = []
+        for block in range(self.getBlock(mintime),self.getBlock(maxtime)+1):
+            bands = self.Blocks[block]
+            for band in range(self.getBand(minlat),self.getBand(maxlat)+1):
+                if not bands.has_key(band):
+                    continue
+                times,borigins = bands[band]
+                for i in range(bisect.bisect_left(times,mintime),bisect.bisect_right(times,maxtime)):
+                    origin = borigins[i]
+                    if origin['lat'] < minlat or origin['lat'] > maxlat:
+                        continue
+                    #boxes crossing the date line have longitudes outside -180 to 180
+                    for lon in [origin['lon'],origin['lon']+360,origin['lon']-360]:
+                        if lon >= minlon and lon <= maxlon:
+                            origins.append(origin.copy())
+                            break
+        return sorted(origins,key=lambda origin: origin['time'],reverse=True)
+
 class QuakeML(object):
     REQMTFIELDS = ['id','lat','lon','depth','time',
                    'mrr','mtt','mpp','mtp','mrp','mrt']
@@ -218,7 +572,7 @@ class QuakeML(object):
     TIMEFMT = '%Y-%m-%dT%H:%M:%S'
     KM2DEG = 1.0/111.191
     def __init__(self,type,xmlfolder,distwindow=100,timewindow=16,source='us',method=DEFAULT_MOMENT_METHOD,
-                 catalog=None,triggersource=None,contributor='us',agency=''):
+                 catalog=None,triggersource=None,contributor='us',agency='',configfile=None):
 
         self.DistanceWindow = distwindow
         self.TimeWindow = timewindow
@@ -245,19 +599,30 @@ class QuakeML(object):
             self.magxml = open(magfile,'rt').read()
         else:
             raise IOError,"Unsupported product type '%s'" % type
+        self.template = xmltemplate.compileTemplate(self.xml)
+        self.magtemplate = xmltemplate.compileTemplate(self.magxml,isfragment=True)
 
         #load a config file
-        configfile = os.path.join(homedir,'config.ini')
-        if not os.path.isfile(configfile):
-            raise Exception('Config file config.ini not found in %s.' % (homedir))
+        if configfile is None:
+            configfile = os.path.join(homedir,'config.ini')
+            if not os.path.isfile(configfile):
+                raise Exception('Config file config.ini not found in %s.' % (homedir))
+        elif not os.path.isfile(configfile):
+            raise Exception('Config file %s not found.' % (configfile))
         self.config = ConfigParser.RawConfigParser()
         self.config.read(configfile)
+        self.sender = pdlsender.getSender(self.config)
+        self.fdsnurl = FDSNURL
+        if self.config.has_option('FDSN','url'):
+            self.fdsnurl = self.config.get('FDSN','url')
+        self.Origins = None #OriginCache, if we're prefetching origins for association
         
         self.EventList = []
         self.NearEventIndices = [] #list of tuples of indices of events that are closer than timethresh/distthresh from each other
         self.Lat = []
         self.Lon = []
-        self.Time = []
+        self.Time = [] #event times in integer microseconds since 1970
+        self.Index = EventIndex(self.DistanceWindow,self.TimeWindow)
         self.catalog = catalog
         self.source = source
         self.method = method
@@ -275,7 +640,7 @@ class QuakeML(object):
 
     def delete(self,event):
         typedict = {'origin':'origin','focal':'focal-mechanism','moment':'moment-tensor'}
-        DCMD = 'java -jar [PDLFOLDER]/ProductClient.jar --send --source=[SOURCE] --configFile=[PDLFOLDER]/[CONFIGFILE] --code=[EVENTID] --type=[TYPE] --delete --privateKey=[PDLFOLDER]/[PDLKEY]'
+        DCMD = '--send --source=[SOURCE] --configFile=[PDLFOLDER]/[CONFIGFILE] --code=[EVENTID] --type=[TYPE] --delete --privateKey=[PDLFOLDER]/[PDLKEY]'
         eid = event['id']
         pdlfolder = self.config.get('PDL','folder')
         pdlkey = self.config.get('PDL','keyfile')
@@ -295,7 +660,7 @@ class QuakeML(object):
         cmd = cmd.replace('[EVENTID]',eid)
         cmd = cmd.replace('[TYPE]',typedict[self.type])
         print 'Deleting event %s' % eid
-        res,output,errors = getCommandOutput(cmd)
+        res,output,errors = self.sender.send(cmd.split())
         return (res,output,errors)
 
     def getOriginDict(self,quakemlfile):
@@ -362,7 +727,7 @@ class QuakeML(object):
         types = {'moment':'moment-tensor','focal':'focal-mechanism'}
         pdlfolder = self.config.get('PDL','folder')
         pdlkey = self.config.get('PDL','keyfile')
-        OCMD = 'java -jar [PDLFOLDER]/ProductClient.jar --send --configFile=[PDLFOLDER]/[CONFIGFILE] --privateKey=[PDLFOLDER]/[KEYFILE] eventsource=[SOURCE] --eventsourcecode=[CODE] --code=[ID] --source=us --type=origin --eventtime=[ETIME] --latitude=[LAT] --longitude=[LON] --depth=[DEP] --magnitude=[MAG]'
+        OCMD = '--send --configFile=[PDLFOLDER]/[CONFIGFILE] --privateKey=[PDLFOLDER]/[KEYFILE] eventsource=[SOURCE] --eventsourcecode=[CODE] --code=[ID] --source=us --type=origin --eventtime=[ETIME] --latitude=[LAT] --longitude=[LON] --depth=[DEP] --magnitude=[MAG]'
         cmd = OCMD.replace('[PDLFOLDER]',pdlfolder)
         cmd = cmd.replace('[CONFIGFILE]',pdlconfig)
         cmd = cmd.replace('[KEYFILE]',pdlkey)
@@ -379,13 +744,13 @@ class QuakeML(object):
         cmd = cmd.replace('[DEP]','%.1f' % origin['depth'])
         cmd = cmd.replace('[MAG]','%.1f' % origin['mag'])
         cmd = cmd.replace('[TYPE]',types[self.type])
-        res,output,errors = getCommandOutput(cmd)
+        res,output,errors = self.sender.send(cmd.split())
         return res,output,errors
         
     
-    def push(self,quakemlfile,trumpWeight=None,nelapsed=None):
-        MCMD = 'java -jar [PDLFOLDER]/ProductClient.jar --mainclass=gov.usgs.earthquake.eids.EIDSInputWedge --configFile=[PDLFOLDER]/[CONFIGFILE] --privateKey=[PDLFOLDER]/[KEYFILE] --file=[QUAKEMLFILE]'
-        TCMD = 'java -jar [PDLFOLDER]/ProductClient.jar --send --configFile=[PDLFOLDER]/[CONFIGFILE] --privateKey=[PDLFOLDER]/[KEYFILE] --source=us --code=[ID] --property-weight=[WEIGHT] --link-product=urn:usgs-product:[CONTRIBUTOR]:origin:[CATALOG][ID]:[VERSION]'
+    def getPushArgs(self,quakemlfile,trumpWeight=None,nelapsed=None):
+        MCMD = '--mainclass=gov.usgs.earthquake.eids.EIDSInputWedge --configFile=[PDLFOLDER]/[CONFIGFILE] --privateKey=[PDLFOLDER]/[KEYFILE] --file=[QUAKEMLFILE]'
+        TCMD = '--send --configFile=[PDLFOLDER]/[CONFIGFILE] --privateKey=[PDLFOLDER]/[KEYFILE] --source=us --code=[ID] --property-weight=[WEIGHT] --link-product=urn:usgs-product:[CONTRIBUTOR]:origin:[CATALOG][ID]:[VERSION]'
 
         pdlfolder = self.config.get('PDL','folder')
         pdlkey = self.config.get('PDL','keyfile')
@@ -406,9 +771,9 @@ class QuakeML(object):
         cmd = cmd.replace('[CONFIGFILE]',pdlconfig)
         cmd = cmd.replace('[KEYFILE]',pdlkey)
         cmd = cmd.replace('[QUAKEMLFILE]',quakemlfile)
-        res,output,errors = getCommandOutput(cmd)
 
         #if the user wants to send a trump message, detect that by trumpWeight not None
+        tcmd = None
         if trumpWeight is not None:
             tcmd = TCMD.replace('[PDLFOLDER]',pdlfolder)
             tcmd = tcmd.replace('[CONFIGFILE]',pdlconfig)
@@ -418,12 +783,37 @@ class QuakeML(object):
             eid = getEventId(quakemlfile)#this is sort of a hack, but it's the easiest way to get the ID for the event
             tcmd = tcmd.replace('[ID]',eid)
             tcmd = tcmd.replace('[WEIGHT]',trumpWeight)
-            res1,output1,errors1 = getCommandOutput(cmd)
+            tcmd = tcmd.split()
+        return (cmd.split(),tcmd)
+
+    def push(self,quakemlfile,trumpWeight=None,nelapsed=None):
+        return self.pushBatch([quakemlfile],trumpWeight=trumpWeight,nelapsed=[nelapsed])[0]
+
+    def pushBatch(self,quakemlfiles,trumpWeight=None,nelapsed=None):
+        """
+        Send a list of QuakeML files to PDL, along with trump messages if requested.
+        @param quakemlfiles: List of QuakeML file names.
+        @param trumpWeight: Trump weight string, or None.
+        @param nelapsed: List of number of days since each event (None for old events), or None.
+        @return: List of (success,output,errors) tuples, one for each file.
+        """
+        if nelapsed is None:
+            nelapsed = [None]*len(quakemlfiles)
+        arglists = []
+        trumplists = []
+        for quakemlfile,ndays in zip(quakemlfiles,nelapsed):
+            args,targs = self.getPushArgs(quakemlfile,trumpWeight=trumpWeight,nelapsed=ndays)
+            arglists.append(args)
+            trumplists.append(targs)
+        results = self.sender.sendBatch(arglists)
+        if trumpWeight is None:
+            return results
+        tresults = self.sender.sendBatch(trumplists)
+        for i in range(0,len(results)):
+            res1,output1,errors1 = tresults[i]
             if not res1:
-                res = res1
-                output = output1
-                errors = errors1
-        return (res,output,errors)
+                results[i] = (res1,output1,errors1)
+        return results
             
     def getRequiredKeys(self):
         if self.type == 'origin':
@@ -459,6 +849,7 @@ class QuakeML(object):
         self.Lon = []
         self.Time = []
         self.NearEventIndices = []
+        self.Index = EventIndex(self.DistanceWindow,self.TimeWindow)
         return
 
     def hasAngles(self,eqdict):
@@ -472,8 +863,8 @@ class QuakeML(object):
                 return False
         return True
         
-    def add(self,eqdict):
-        eqfields = eqdict.keys()
+    def checkFields(self,eqfields):
+        #make sure we have the fields our product type needs
         seteqfields = set(eqfields)
         if self.type == 'origin':
             reqfields = set(self.REQORFIELDS)
@@ -486,6 +877,10 @@ class QuakeML(object):
             missing = reqfields.difference(seteqfields)
             raise Exception,'Missing required fields "%s" from input dictionary' % (','.join(list(missing)))
 
+    def prepareEvent(self,eqdict):
+        #check the required fields and add the ones that apply to the whole catalog
+        self.checkFields(eqdict.keys())
+
         #add in the fields that apply to the whole catalog we are loading
         eqdict['source'] = self.source
         if not eqdict.has_key('method'):
@@ -496,7 +891,10 @@ class QuakeML(object):
         eqdict['triggersource'] = self.triggersource
         eqdict['contributor'] = self.contributor
         eqdict['agency'] = self.agency
-        
+        return eqdict
+
+    def completeEvent(self,eqdict):
+        #fill in the tensor angles, moment and magnitude, if we need them and don't have them
         if self.type == 'moment' and not self.hasAngles(eqdict):
             eqdict = getMomentTensorAngles(eqdict)
         if self.type == 'moment' and not eqdict.has_key('moment'):
@@ -509,53 +907,156 @@ class QuakeML(object):
             eqdict['moment'] = calculateTotalMoment(mrr,mtt,mpp,mrt,mrp,mtp)
         if not eqdict.has_key('magnitude') and self.type != 'origin':
             eqdict['magnitude'][0]['mag'] = calculateMagnitude(eqdict['moment'])
-        
-        self.EventList.append(eqdict)
+        return eqdict
+
+    def appendEvent(self,eqdict):
+        #we keep compact records rather than dictionaries (see eventrecord.py)
+        self.EventList.append(eventrecord.getRecord(eqdict))
         self.updateCloseEvents()
-        
+
+    def add(self,eqdict):
+        eqdict = self.completeEvent(self.prepareEvent(eqdict))
+        self.appendEvent(eqdict)
+
+    def addEvents(self,eqdicts):
+        """
+        Add many events, doing the moment tensor math for all of them at once.
+        @param eqdicts: Sequence of event dictionaries, as for add().
+        """
+        #the garbage collector makes building many records at once a lot slower
+        gcenabled = gc.isenabled()
+        gc.disable()
+        try:
+            eqdicts = [eventrecord.getRecord(self.prepareEvent(eqdict)) for eqdict in eqdicts]
+        finally:
+            if gcenabled:
+                gc.enable()
+        if self.type == 'moment':
+            keylist = ['mrr','mtt','mpp','mrt','mrp','mtp']
+            noangles = [eqdict for eqdict in eqdicts if not self.hasAngles(eqdict)]
+            if len(noangles):
+                components = [numpy.array([eqdict[key] for eqdict in noangles],dtype=float) for key in keylist]
+                angles = getMomentTensorAnglesBatch(*components)
+                for i in range(0,len(noangles)):
+                    for key in ANGLEKEYS:
+                        noangles[i][key] = angles[key][i]
+            nomoment = [eqdict for eqdict in eqdicts if not eqdict.has_key('moment')]
+            if len(nomoment):
+                components = [numpy.array([eqdict[key] for eqdict in nomoment],dtype=float) for key in keylist]
+                moments = calculateTotalMoment(*components)
+                for i in range(0,len(nomoment)):
+                    nomoment[i]['moment'] = moments[i]
+        for eqdict in eqdicts:
+            self.appendEvent(self.completeEvent(eqdict))
+
+    def prepareBatch(self,batch):
+        """
+        Do what prepareEvent() and addEvents() do for a batch of events, a column at a time.
+        @param batch: Dictionary of equal length columns keyed by event field (see eventrecord.py).
+        @return: New batch with the catalog fields, and tensor angles and moments if we need them.
+        """
+        self.checkFields(batch.keys())
+        nevents = eventrecord.getBatchLength(batch)
+        batch = batch.copy()
+        batch['source'] = [self.source]*nevents
+        if not batch.has_key('method'):
+            batch['method'] = [self.method]*nevents
+        if not batch.has_key('lowermethod'):
+            batch['lowermethod'] = [self.lowermethod]*nevents
+        batch['catalog'] = [self.catalog]*nevents
+        batch['triggersource'] = [self.triggersource]*nevents
+        batch['contributor'] = [self.contributor]*nevents
+        batch['agency'] = [self.agency]*nevents
+        if self.type == 'moment':
+            keylist = ['mrr','mtt','mpp','mrt','mrp','mtp']
+            components = [numpy.asarray(batch[key],dtype=float) for key in keylist]
+            if not set(ANGLEKEYS).issubset(batch.keys()):
+                angles = getMomentTensorAnglesBatch(*components)
+                for key in ANGLEKEYS:
+                    batch[key] = angles[key]
+            if not batch.has_key('moment'):
+                batch['moment'] = calculateTotalMoment(*components)
+        return batch
+
+    def addBatch(self,batch):
+        """
+        Add a batch of events, as from a catalog module getEventBatches() function.
+        @param batch: Dictionary of equal length columns keyed by event field (see eventrecord.py).
+        """
+        for eqdict in eventrecord.getBatchRecords(self.prepareBatch(batch)):
+            self.appendEvent(self.completeEvent(eqdict))
+
+    def streamEvents(self,eqdicts):
+        """
+        Add events one at a time and yield each one once no later event can be near it,
+        keeping only the events inside that window in memory.  Events are not kept in EventList,
+        but pairs of near events are still recorded (by input order) in NearEventIndices.
+        @param eqdicts: Sequence of event dictionaries, as for add(), in time order.
+        @return: Generator of (event,origins,events) tuples, as for generateEvents().
+        """
+        window = int(round(numpy.sqrt(2)*self.TimeWindow*USECS))
+        pending = collections.deque() #(time,event) tuples
+        lasttime = None
+        for eqdict in eqdicts:
+            eqdict = self.completeEvent(self.prepareEvent(eqdict))
+            time = fasttime.toEpoch(eqdict['time'])
+            if lasttime is not None and time < lasttime:
+                raise Exception,'Event %s at %s is out of time order - streaming requires sorted input.' % (eqdict['id'],eqdict['time'])
+            lasttime = time
+            self.indexEvent(eqdict,time)
+            self.Index.evict(time)
+            while len(pending) and time - pending[0][0] > window:
+                yield (pending.popleft()[1],[],[])
+            pending.append((time,eqdict))
+        while len(pending):
+            yield (pending.popleft()[1],[],[])
+
+    def indexEvent(self,eqdict,time=None):
+        #add an event to the near-event index, return its time in microseconds
+        if time is None:
+            time = fasttime.toEpoch(eqdict['time'])
+        thisidx = self.Index.Count
+        for idx in self.Index.add(eqdict['lat'],eqdict['lon'],time):
+            self.NearEventIndices.append((idx,thisidx))
+        return time
 
     def updateCloseEvents(self):
         thiseq = self.EventList[-1]
-        time = float(thiseq['time'].strftime('%s'))
-        lat = thiseq['lat']
-        lon = thiseq['lon']
-        if not len(self.Lat):
-            self.Lat.append(lat)
-            self.Lon.append(lon)
-            self.Time.append(time)
-            return
-        nplat = numpy.array(self.Lat)
-        nplon = numpy.array(self.Lon)
-        nptime = numpy.array(self.Time)
-        normdist = (distance.sdist(lat,lon,nplat,nplon)/1000)/self.DistanceWindow
-        normtdelta = (numpy.abs(time - nptime))/self.TimeWindow
-        eucdistance = numpy.sqrt(normdist**2+normtdelta**2)
-        iclose = numpy.where(eucdistance <= numpy.sqrt(2))
-        thisidx = len(self.Lat)
-        near = []
-        for idx in iclose[0]:
-            self.NearEventIndices.append((idx,thisidx))
-        self.Lat.append(lat)
-        self.Lon.append(lon)
+        time = self.indexEvent(thiseq)
+        self.Lat.append(thiseq['lat'])
+        self.Lon.append(thiseq['lon'])
         self.Time.append(time)
         return
 
+    def prefetch(self,blockdays=BLOCKDAYS):
+        """
+        Associate events using origins fetched from the FDSN service in blocks of time,
+        instead of making a request for each event.  Blocks covering the events already
+        added are fetched now, others when an event needs them.
+        @param blockdays: Length in days of each block of origins.
+        """
+        self.Origins = OriginCache(self.triggersource,url=self.fdsnurl,blockdays=blockdays)
+        if not len(self.EventList):
+            return
+        #the events are searched for by trigger time when they have one
+        times = numpy.array([fasttime.toEpoch(event.get('triggertime',event['time'])) for event in self.EventList],
+                            dtype=numpy.int64)
+        twindow = int(round(self.TimeWindow*USECS))
+        self.Origins.fetch(int(times.min())-twindow,int(times.max())+twindow)
+
     def associate2(self,event):
         if event.has_key('triggerlat'):
             lat = event['triggerlat']
             lon = event['triggerlon']
-            etime = event['triggertime']
+            etime = fasttime.toEpoch(event['triggertime'])
         else:
             lat = event['lat']
             lon = event['lon']
-            etime = event['time']
-        APITIMEFMT = '%Y-%m-%dT%H:%M:%S.%f'
-        mintime = etime - datetime.timedelta(seconds=self.TimeWindow)
-        maxtime = etime + datetime.timedelta(seconds=self.TimeWindow)
-        minlat = lat - self.DistanceWindow * self.KM2DEG
-        maxlat = lat + self.DistanceWindow * self.KM2DEG
-        minlon = lon - self.DistanceWindow * self.KM2DEG * (1/distance.cosd(lat))
-        maxlon = lon + self.DistanceWindow * self.KM2DEG * (1/distance.cosd(lat))
+            etime = fasttime.toEpoch(event['time'])
+        box = getSearchBox(lat,lon,etime,self.DistanceWindow,self.TimeWindow)
+        if self.Origins is not None:
+            return scoreOrigins(lat,lon,etime,self.Origins.getOrigins(*box))
+        mintime,maxtime,minlat,maxlat,minlon,maxlon = box
 
         #handle meridian crossing problem
         # if minlon < 180 and maxlon > 180:
@@ -563,43 +1064,24 @@ class QuakeML(object):
         # if minlon < -180 and maxlon > -180:
         #     minlon = 360 + minlon
         
-        etimestr = etime.strftime(self.TIMEFMT)+'Z'
-        searchurl = 'http://comcat.cr.usgs.gov/fdsnws/event/1/query?%s'
-        #searchurl = 'http://comcat.cr.usgs.gov/earthquakes/feed/search.php?%s'
         pdict = {'minlatitude':minlat,'minlongitude':minlon,
                  'maxlatitude':maxlat,'maxlongitude':maxlon,
-                 'starttime':mintime.strftime(APITIMEFMT),'endtime':maxtime.strftime(APITIMEFMT),
+                 'starttime':fasttime.toDatetime(mintime).strftime(APITIMEFMT),
+                 'endtime':fasttime.toDatetime(maxtime).strftime(APITIMEFMT),
                  'catalog':self.triggersource,'format':'geojson','eventtype':'earthquake'}
         if self.triggersource == "" or self.triggersource is None:
             pdict.pop('catalog')
         params = urllib.urlencode(pdict)
-        searchurl = searchurl % params
-        if etime.year >= 2006:
-            pass
+        searchurl = self.fdsnurl % params
         origins = []
         try:
             fh = urllib2.urlopen(searchurl)
             data = fh.read()
-            #data2 = data[len(pdict['callback'])+1:-2]
             datadict = json.loads(data)['features']
             for feature in datadict:
-                eventdict = {}
-                eventdict['lon'] = feature['geometry']['coordinates'][0]
-                eventdict['lat'] = feature['geometry']['coordinates'][1]
-                eventdict['depth'] = feature['geometry']['coordinates'][2]
-                eventdict['mag'] = feature['properties']['mag']
-                otime = int(feature['properties']['time'])
-                eventdict['time'] = parseTime(otime)
-                idlist = feature['properties']['ids'].strip(',').split(',')
-                eventdict['id'] = feature['id']
-                euclid,ddist,tdist = getEuclidean(lat,lon,etime,eventdict['lat'],eventdict['lon'],eventdict['time'])
-                eventdict['euclidean'] = euclid
-                eventdict['timedelta'] = tdist
-                eventdict['distance'] = ddist
-                origins.append(eventdict.copy())
+                origins.append(parseFeature(feature))
             fh.close()
-            origins = sorted(origins,key=lambda origin: origin['euclidean'])
-            return origins
+            return scoreOrigins(lat,lon,etime,origins)
         except Exception,msg:
             raise Exception,'Could not reach "%s" - error "%s"' % (searchurl,msg.message)
         
@@ -626,7 +1108,8 @@ class QuakeML(object):
                 eventdict['mag'] = feature['properties']['mag']
                 eventdict['time'] = parseTime(int(feature['properties']['time']))
                 eventdict['id'] = feature['properties']['ids'].split(',')[0]
-                eventdict['distance'] = getEuclidean(lat,lon,etime,eventdict['lat'],eventdict['lon'],eventdict['time'])
+                eventdict['distance'] = getEuclidean(lat,lon,fasttime.toEpoch(etime),eventdict['lat'],eventdict['lon'],
+                                                     fasttime.toEpoch(eventdict['time']))
                 origins.append(event.copy())
             fh.close()
             origins = sorted(origins,key=lambda origin: origin['distance'])
@@ -634,72 +1117,74 @@ class QuakeML(object):
         except Exception,exception_object:
             raise exception_object,'Could not reach "%s"' % searchurl
 
-    def renderXML(self,event,origin=None):
-        event['ctime'] = datetime.datetime.utcnow()
-        event['version'] = event['ctime'].strftime('%s')
+    def stampEvent(self,event,origin=None,ctime=None):
+        #set the creation time, version and trigger fields of an event about to be rendered
+        if ctime is None:
+            ctime = datetime.datetime.utcnow()
+        event['ctime'] = ctime
+        event['version'] = '%i' % (fasttime.toEpoch(ctime)//USECS)
 
-        #treat magnitude field specially - it is possible with origins to have
-        #multiple magnitudes input - we have a separate magnitude template file
-        #that we fill in with each group of magnitude information
-        magtext = ''
-        for magdict in event['magnitude']:
-            tmptext = self.magxml
-            for key in magdict.keys():
-                if key not in FORMATS.keys():
-                    continue
-                macro = '[%s]' % key.upper()
-                value = FORMATS[key] % magdict[key]
-                tmptext = tmptext.replace(macro,value)
-            magtext += tmptext
-        
         if origin is not None:
             event['triggertime'] = origin['time']
             event['triggerlon'] = origin['lon']
             event['triggerlat'] = origin['lat']
             event['triggerdepth'] = origin['depth']*1000
             event['triggerid'] = origin['id']
-                
-        xmltext = self.xml
-        xmltext = xmltext.replace('[MAGNITUDES]',magtext)
-        
+
+    def renderXML(self,event,origin=None,ctime=None):
+        """
+        Render an event to a QuakeML file in the output folder.
+        @param event: Event dictionary.
+        @param origin: Origin dictionary of the event this one is associated with, or None.
+        @param ctime: Creation time (which also sets the version) to give the event, defaults to now.
+        @return: Name of the QuakeML file.
+        """
+        self.stampEvent(event,origin,ctime)
+
+        values = {}
         for key in event.keys():
-            if key not in FORMATS.keys():
+            if key not in FORMATS:
                 continue
-            macro = '[%s]' % key.upper()
             value = event[key]
-            if isinstance(value,datetime.datetime):
+            if key in TIMEKEYS:
+                #times are only turned into strings here, and may be datetimes or microseconds since 1970
+                if not isinstance(value,datetime.datetime):
+                    value = fasttime.toDatetime(value)
                 value = value.strftime(TIMEFMT)
             else:
                 try:
                     value = FORMATS[key] % value #use our pre-approved list of 
                 except:
                     pass
-            xmltext = xmltext.replace(macro,value)
+            if not isinstance(value,basestring):
+                raise TypeError,'Could not format value %s for field "%s"' % (repr(value),key)
+            values[key.upper()] = value
 
+        #treat magnitude field specially - it is possible with origins to have
+        #multiple magnitudes input - we have a separate magnitude template file
+        #that we fill in with each group of magnitude information
+        magnitudes = []
+        for magdict in event['magnitude']:
+            magvalues = values.copy()
+            for key in magdict.keys():
+                if key not in FORMATS:
+                    continue
+                magvalues[key.upper()] = FORMATS[key] % magdict[key]
+            magnitudes.append((self.magtemplate,magvalues))
 
-        #get the preferred magnitude ID from the xml we just made
+        #get the preferred magnitude ID from the magnitudes we're rendering
         prefmethod = event['magnitude'][0]['method']
-        try:
-            dom = minidom.parseString(xmltext)
-            mags = dom.getElementsByTagName('magnitude')
-            prefid = None
-            for mag in mags:
-                pid = mag.getAttribute('publicID')
-                if pid.lower().endswith((prefmethod.lower())):
-                    prefid = pid
-                    break
-            dom.unlink()
-        except:
-            open('debug.xml','wt').write(xmltext)
-            sys.exit(1)
-        #now put it into the xml
-        xmltext = xmltext.replace('[PREFMAGID]',prefid)
-        #get rid of any fields that weren't filled in by the catalog module
-        xmltext = self.removeUnusedMacros(xmltext)
-
-        #strip out all newline characters
-        xmltext = xmltext.replace('\n','')
-        xmltext = xmltext.replace('\t','')
+        prefid = None
+        for pid in self.template.getAttributes('magnitude','publicID',values,magnitudes):
+            if pid.lower().endswith((prefmethod.lower())):
+                prefid = pid
+                break
+        if prefid is None:
+            raise Exception,'Could not find a magnitude with method %s for event %s' % (prefmethod,event['id'])
+        values['PREFMAGID'] = prefid
+
+        #fields that weren't filled in by the catalog module are left out
+        xmltext = self.template.render(values,magnitudes)
         
         filename = os.path.join(self.xmlfolder,'%s.xml' % event['id'])
         f = open(filename,'wt')
@@ -707,64 +1192,62 @@ class QuakeML(object):
         f.close()
         return filename
 
-    def removeUnusedMacros(self,xmltext):
-        #ElementTree seems to want to parse from a file, so fake it with StringIO
-        xmlio = StringIO.StringIO()
-        xmlio.write(xmltext)
-        xmlio.seek(0)
-        tree = ElementTree.parse(xmlio)
-        xmlio.close()
-        #make a map of the parent-child relationships
-        #the child elements are the keys, the parents are the values
-        parent_map = dict((c, p) for p in tree.getiterator() for c in p)
-        root = tree.getroot()
-        trashcan = []
-        for element in root.iter():
-            for key,value in element.items():
-                matchlist = re.findall(MACROPATTERN,value)
-                if len(matchlist):
-                    trashcan.append(element)
-            tagdata = element.text
-            if tagdata is None:
-                continue
-            if re.search(MACROPATTERN,tagdata) is not None:
-                    trashcan.append(element)
-        for trash in trashcan:
-            #print 'Removing unfilled element %s' % str(element)
-            parent = parent_map[trash]
-            try:
-                parent.remove(trash)
-            except Exception,e:
-                pass
-        f = StringIO.StringIO()
-        tree.write(f,xml_declaration=False,default_namespace='')
-        xmloutput = f.getvalue()
-        f.close()
+    def getRenderer(self):
+        #a copy of ourselves with just what renderXML() needs, to hand to worker processes
+        renderer = copy.copy(self)
+        renderer.sender = None
+        renderer.Origins = None
+        renderer.EventList = []
+        renderer.NearEventIndices = []
+        renderer.Lat = []
+        renderer.Lon = []
+        renderer.Time = []
+        renderer.Index = None
+        return renderer
 
-        #There are a bunch of things that ElementTree does to the XML, all having to do with namespaces.
-        #What follows is some hacky search/replace code to undo the changes
-        #I don't want the "nsX" namespace identifiers in here - nuking them with a regular expression
-        pattern = 'ns[0-9]*:'
-        xmloutput = re.sub(pattern,'',xmloutput)
-        
-        #there are three namespace defining attributes in the q:quakeml element.  ElementTree blows these away.
-        #let's just replace everything in the <quakeml> opening tag with the right stuff...
-        m1 = re.search('<quakeml',xmloutput)
-        m2 = re.compile('>').search(xmloutput,m1.start())
-        repltext = """<q:quakeml xmlns="http://quakeml.org/xmlns/bed/1.2" xmlns:catalog="http://anss.org/xmlns/catalog/0.1" xmlns:q="http://quakeml.org/xmlns/quakeml/1.2">"""
-        xmloutput = xmloutput.replace(xmloutput[m1.start():m2.end()],repltext)
-
-        #ElementTree took away the "q:" namespace qualifier, so let's put it back
-        xmloutput = xmloutput.replace('<quakeml','<q:quakeml')
-        xmloutput = xmloutput.replace('</quakeml','</q:quakeml')
-
-        #The catalog: namespace qualifiers in the event tag are gone too, so lets fix that
-        xmloutput = xmloutput.replace('eventid','catalog:eventid')
-        xmloutput = xmloutput.replace('eventsource','catalog:eventsource')
-        xmloutput = xmloutput.replace('datasource','catalog:datasource')
-        xmloutput = xmloutput.replace('dataid','catalog:dataid')
-        
-        return xmloutput
+    def getRenderPool(self,nprocs=None):
+        """
+        Start a pool of processes for renderEvents() to use.
+        @param nprocs: Number of processes (defaults to the number of CPUs).
+        @return: multiprocessing Pool object, which the caller should close() and join() when done.
+        """
+        return multiprocessing.Pool(nprocs,initializer=initRenderer,initargs=(self.getRenderer(),))
+
+    def renderEvents(self,events,origins=None,nprocs=None,pool=None):
+        """
+        Render many events to QuakeML files, using a pool of processes.
+        All of the events are stamped here with the same creation time and version, so the output
+        does not depend on which process renders which event.
+        @param events: List of event dictionaries.
+        @param origins: List of associated origin dictionaries (or None) for each event, or None.
+        @param nprocs: Number of processes to use (defaults to the number of CPUs).  If a pool is given,
+        this should be the number of processes in it.
+        @param pool: Pool from getRenderPool(), or None to start (and stop) one just for these events.
+        @return: List of QuakeML file names, in the same order as the events.
+        """
+        if origins is None:
+            origins = [None]*len(events)
+        ctime = datetime.datetime.utcnow()
+        tasks = []
+        for event,origin in zip(events,origins):
+            self.stampEvent(event,origin,ctime)
+            tasks.append((event,origin,ctime))
+        if not len(tasks):
+            return []
+        mypool = pool
+        if pool is None:
+            mypool = self.getRenderPool(nprocs)
+        if nprocs is None:
+            nprocs = multiprocessing.cpu_count()
+        try:
+            #a few chunks per process evens out the load without too much messaging
+            chunksize = len(tasks)//(nprocs*4) + 1
+            filenames = mypool.map(renderTask,tasks,chunksize)
+        finally:
+            if pool is None:
+                mypool.close()
+                mypool.join()
+        return filenames
 
     def generateEvents(self):
         i = 0
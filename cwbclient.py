@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+Client for the CWB metadata server (cwbpub port 2052).
+
+A request is a command line padded with NUL characters to 80 bytes, and the server answers
+with lines of text ending in <EOR>.  mloc.py used to open a new connection for every request.
+CWBClient keeps a pool of open connections and writes several requests on each before
+reading the responses, so that a batch of requests costs a few round trips rather than one
+connection per request.  Every request has a time limit, and requests that fail are tried
+once more on a fresh connection.  Requests that still can't be answered get None instead of
+a response, so callers can tell a server that's down from one that has nothing to say.
+"""
+
+#stdlib imports
+import socket
+import threading
+import time
+
+REQUEST_LENGTH = 80 #requests are padded to this many bytes
+EOR = '<EOR>' #end of response marker
+MAX_OUTSTANDING = 16 #number of requests we will write on a connection before reading responses
+RECV_SIZE = 65536
+DEFAULT_TIMEOUT = 30 #seconds to wait for a response
+RETRY_DELAY = 2 #seconds to wait before trying again on a new connection
+ACQUIRE_TIMEOUT = 300 #seconds to wait for a connection to be free before giving up
+
+def padRequest(req):
+    """
+    Pad a request command to the length the server expects.
+    @param req: Command string ('-c c -s ..ANMO -b all \\n', for example).
+    @return: Command padded with NUL characters to 80 bytes.
+    """
+    req = str(req)
+    if len(req) < REQUEST_LENGTH:
+        req += chr(0) * (REQUEST_LENGTH - len(req))
+    return req
+
+class CWBConnection(object):
+    """
+    One connection to the server, with a buffer for reading responses.
+    """
+    def __init__(self,host,port,timeout):
+        self.sock = socket.create_connection((host,port),timeout)
+        self.buffer = ''
+        self.nresponses = 0
+
+    def send(self,req):
+        self.sock.sendall(req)
+
+    def readResponse(self,timeout):
+        #read up to the next end of response marker, giving up after timeout seconds
+        deadline = time.time() + timeout
+        while True:
+            idx = self.buffer.find(EOR)
+            if idx > -1:
+                response = self.buffer[0:idx+len(EOR)]
+                self.buffer = self.buffer[idx+len(EOR):]
+                if self.buffer.startswith('\r\n'):
+                    self.buffer = self.buffer[2:]
+                elif self.buffer.startswith('\n'):
+                    self.buffer = self.buffer[1:]
+                self.nresponses += 1
+                return response
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('No response from CWB server in %s seconds' % timeout)
+            self.sock.settimeout(remaining)
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                raise IOError('CWB server closed the connection')
+            self.buffer += data
+
+    def close(self):
+        try:
+            self.sock.close()
+        except:
+            pass
+
+class CWBClient(object):
+    """
+    Pool of pipelined connections to a CWB metadata server.
+    """
+    def __init__(self,host,port,maxconns=4,timeout=DEFAULT_TIMEOUT):
+        """
+        @param host: Server host name.
+        @param port: Server port.
+        @param maxconns: Maximum number of connections to keep open.
+        @param timeout: Seconds to wait for each response (and for each connection to be made).
+        """
+        self.host = host
+        self.port = port
+        self.maxconns = maxconns
+        self.timeout = timeout
+        self.idle = []
+        self.nconns = 0 #connections open or being opened, idle or not
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        #hand out an idle connection, make a new one if we're allowed, otherwise wait for one
+        #to be released or closed
+        deadline = time.time() + ACQUIRE_TIMEOUT
+        self.condition.acquire()
+        try:
+            while not len(self.idle) and self.nconns >= self.maxconns:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise IOError('No free connection to the CWB server in %s seconds' % ACQUIRE_TIMEOUT)
+                self.condition.wait(remaining)
+            if len(self.idle):
+                return self.idle.pop()
+            self.nconns += 1
+        finally:
+            self.condition.release()
+        #connect outside the lock, so other threads can use the idle connections meanwhile
+        try:
+            return CWBConnection(self.host,self.port,self.timeout)
+        except:
+            self.dropConnection()
+            raise
+
+    def dropConnection(self):
+        #one fewer connection, so a waiting thread can make a new one
+        self.condition.acquire()
+        self.nconns -= 1
+        self.condition.notify()
+        self.condition.release()
+
+    def release(self,conn,broken=False):
+        if broken:
+            conn.close()
+            self.dropConnection()
+            return
+        self.condition.acquire()
+        self.idle.append(conn)
+        self.condition.notify()
+        self.condition.release()
+
+    def pipeRequests(self,conn,reqs,responses):
+        #responses are appended as they arrive, so the caller knows how far we got if this fails
+        nsent = len(responses)
+        ndone = len(responses)
+        while ndone < len(reqs):
+            while nsent < len(reqs) and nsent - ndone < MAX_OUTSTANDING:
+                conn.send(padRequest(reqs[nsent]))
+                nsent += 1
+            responses.append(conn.readResponse(self.timeout))
+            ndone += 1
+
+    def queryBatch(self,reqs):
+        """
+        Send a list of requests, pipelined through one connection.
+        @param reqs: List of request commands (padded or not).
+        @return: List of response strings, one for each request.  Requests that could not be
+        answered get None.
+        """
+        responses = []
+        nfailures = 0 #number of connections in a row that failed without answering anything
+        while len(responses) < len(reqs):
+            ndone = len(responses)
+            conn = None
+            try:
+                conn = self.acquire()
+                self.pipeRequests(conn,reqs,responses)
+                self.release(conn)
+                continue
+            except (socket.error,IOError):
+                if conn is not None:
+                    self.release(conn,broken=True)
+            #the server may just close connections after a while, so if this one has answered
+            #anything, carry on with a new one
+            if len(responses) > ndone or (conn is not None and conn.nresponses > 0):
+                nfailures = 0
+                continue
+            nfailures += 1
+            if nfailures < 2:
+                time.sleep(RETRY_DELAY)
+                continue
+            nfailures = 0
+            if conn is None:
+                #can't connect at all
+                responses += [None] * (len(reqs) - len(responses))
+            else:
+                #give up on the request that failed twice
+                responses.append(None)
+        return responses
+
+    def query(self,req):
+        """
+        Send one request.
+        @param req: Request command.
+        @return: Response string, or None if the request could not be answered.
+        """
+        return self.queryBatch([req])[0]
+
+    def queryParallel(self,reqs):
+        """
+        Send a list of requests, spread over all of the connections in the pool.
+        @param reqs: List of request commands.
+        @return: List of response strings (or None), one for each request.
+        """
+        nchunks = min(self.maxconns,len(reqs))
+        if nchunks < 2:
+            return self.queryBatch(reqs)
+        chunks = [reqs[i::nchunks] for i in range(0,nchunks)]
+        results = [None] * nchunks
+        def runChunk(i):
+            results[i] = self.queryBatch(chunks[i])
+        threads = [threading.Thread(target=runChunk,args=(i,)) for i in range(0,nchunks)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        responses = [None] * len(reqs)
+        for i in range(0,nchunks):
+            responses[i::nchunks] = results[i]
+        return responses
+
+    def close(self):
+        self.condition.acquire()
+        idle = self.idle
+        self.idle = []
+        self.condition.release()
+        for conn in idle:
+            self.release(conn,broken=True)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+Stand-in for the CWB metadata server, for testing and benchmarking mloc.py without cwbpub.
+
+It answers the requests StationTranslator makes (see cwbclient.py for the protocol) with
+made up metadata: every station has one epoch and HH and BH channels in network XX, except
+stations matching --unknown, which only have an IR alias, stations matching --missing,
+which have nothing at all, and stations matching --moved, which move to network YY in the
+middle of 2005.  Run it and point mloc at it:
+
+  python cwbstub.py --port 2052 &
+  python mloc.py cluster.qom outfolder study -c localhost:2052
+"""
+
+#stdlib imports
+import sys
+import re
+import time
+import argparse
+import threading
+import SocketServer
+
+REQUEST_LENGTH = 80
+EPOCHSTART = '1990-01-01 00:00'
+EPOCHEND = '2599-12-31 00:00'
+CHANNELS = ['HHZ','HHN','HHE','BHZ','BHN','BHE']
+NETWORK = 'XX'
+MOVED_NETWORK = 'YY'
+MOVED_TIME = '2005-06-01 00:00'
+LOCATION = '00'
+
+def handleRequest(req,options):
+    #the text of the response to one request
+    args = req.split()
+    station = None
+    if '-s' in args:
+        station = args[args.index('-s')+1].split('.')[-1]
+    elif '-a' in args:
+        station = args[args.index('-a')+1].split('.')[-1]
+    if station is None:
+        return 'Unknown request\n'
+    if options.missing is not None and re.search(options.missing,station):
+        return 'no channels found to match\n'
+    unknown = options.unknown is not None and re.search(options.unknown,station)
+    if '-a' in args:
+        #alias lookups: FDSN.IR.STA or *.*.STA
+        if not unknown or args[args.index('-a')+1].startswith('FDSN'):
+            return ''
+        return 'ISC.IR.%s.1:alias\n' % station
+    if unknown:
+        return 'no channels found to match\n'
+    epochs = [(NETWORK,EPOCHSTART,EPOCHEND)]
+    if options.moved is not None and re.search(options.moved,station):
+        epochs = [(NETWORK,EPOCHSTART,MOVED_TIME),(MOVED_NETWORK,MOVED_TIME,EPOCHEND)]
+    date = args[args.index('-b')+1]
+    lines = ''
+    for network,start,end in epochs:
+        if date != 'all' and not (start[0:10] <= date.replace('/','-') < end[0:10]):
+            continue
+        for channel in CHANNELS:
+            if date == 'all':
+                lines += '%s %s %s %s: 0.0 0.0 0.0 0.0 0.0 40.0 %s to %s\n' % (network,station,LOCATION,channel,
+                                                                            start,end)
+            else:
+                lines += '%s %s %s %s:channel\n' % (network,station,LOCATION,channel)
+    return lines
+
+class CWBHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        options = self.server.options
+        data = ''
+        while True:
+            while len(data) < REQUEST_LENGTH:
+                chunk = self.request.recv(4096)
+                if not chunk:
+                    return
+                data += chunk
+            req = data[0:REQUEST_LENGTH].rstrip(chr(0)).strip()
+            data = data[REQUEST_LENGTH:]
+            if options.log is not None:
+                self.server.lock.acquire()
+                f = open(options.log,'at')
+                f.write(req+'\n')
+                f.close()
+                self.server.lock.release()
+            if options.delay:
+                time.sleep(options.delay)
+            self.request.sendall(handleRequest(req,options)+'<EOR>\n')
+            if options.close:
+                return
+
+class CWBServer(SocketServer.ThreadingMixIn,SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pretend to be a CWB metadata server.')
+    parser.add_argument('--port', dest='port',type=int,default=2052,
+                        help='Port to listen on')
+    parser.add_argument('--log', dest='log',
+                        help='Append each request to this file')
+    parser.add_argument('--delay', dest='delay',type=float,default=0.0,
+                        help='Seconds to wait before answering each request')
+    parser.add_argument('--close', dest='close',action='store_true',
+                        help='Close the connection after each answer, instead of reading more requests')
+    parser.add_argument('--unknown', dest='unknown',
+                        help='Stations matching this regular expression only have an IR alias')
+    parser.add_argument('--missing', dest='missing',
+                        help='Stations matching this regular expression have no metadata at all')
+    parser.add_argument('--moved', dest='moved',
+                        help='Stations matching this regular expression change networks in 2005')
+    options = parser.parse_args()
+    server = CWBServer(('',options.port),CWBHandler)
+    server.options = options
+    server.lock = threading.Lock()
+    sys.stderr.write('Listening on port %i\n' % options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
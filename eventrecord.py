@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+
+"""
+Compact stand-in for the event dictionaries the catalog modules produce.
+
+A dictionary with 50 string keys costs several kilobytes per event, most of it hash table
+and float objects.  An EventRecord keeps its float values packed in an array of doubles
+and everything else in tuples, and the key names and positions live in a layout that is
+shared by every record with the same set of keys.  Event times go in the array as well, as
+microseconds since 1970 (see fasttime.py), and ids made of a prefix and a number (us1234,
+19760101000414) are kept as the number, with the prefix.  Values that are the same for a
+whole catalog (source, contributor, evaluation mode, id prefix, etc.) are interned and kept
+in a tuple of their own, which is shared by every record with the same values.
+
+Catalog modules can also hand over events a block at a time, as a batch: a dictionary of
+columns (numpy arrays or lists, all the same length) keyed by event field.  Records are
+made from a whole batch at once by getBatchRecords().
+"""
+
+#stdlib imports
+import array
+import operator
+import datetime
+import re
+
+#third party imports
+import numpy
+
+#local imports
+import fasttime
+
+#string fields that only take a few different values, which records can share
+INTERNFIELDS = ['source','method','lowermethod','catalog','triggersource','contributor','agency',
+                'evalmode','evalstatus','sourcetimetype','momentcategory','type','magcomment',
+                'depthquality','locquality','magquality','icat','isol','asol']
+_INTERNFIELDS = set(INTERNFIELDS)
+#string fields that are usually a prefix and a number
+IDFIELDS = ['id']
+_IDFIELDS = set(IDFIELDS)
+#a prefix without digits, then a number the array of floats can hold exactly, with nothing after it
+IDPATTERN = re.compile(r'(\D*)([1-9][0-9]{0,14})\Z')
+#largest number of microseconds since 1970 the array of floats can hold exactly (about 285 years)
+MAXEPOCH = 2**53
+
+#kinds of value, which decide where a record keeps them
+OBJECT = False #anything else, kept in a tuple (interned fields in the shared tuple)
+NUMBER = True #floats, kept in the array of floats
+TIME = 'time' #datetimes, kept in the array of floats as microseconds since 1970
+IDENT = 'ident' #ids, kept as the number in the array of floats and the prefix in the shared tuple
+
+#where a record keeps a value (the first element of each RecordLayout.fields value)
+_NUMBER = 0
+_OBJECT = 1
+_SHARED = 2
+_TIME = 3
+_IDENT = 4
+
+class RecordLayout(object):
+    """
+    The keys of a set of records, and where in each record the value of each key is kept.
+    """
+    def __init__(self,keys=(),kinds=()):
+        self.keys = tuple(keys)
+        self.kinds = tuple(kinds) #OBJECT, NUMBER, TIME or IDENT for each key
+        self.fields = {} #key: (where the value is kept,index there)
+        numbers = [] #positions in key order of the values kept in each part of a record
+        objects = []
+        shared = []
+        idents = []
+        for i in range(0,len(self.keys)):
+            key,kind = self.keys[i],self.kinds[i]
+            if kind == NUMBER:
+                self.fields[key] = (_NUMBER,len(numbers))
+                numbers.append(i)
+            elif kind == TIME:
+                self.fields[key] = (_TIME,len(numbers))
+                numbers.append(i)
+            elif kind == IDENT:
+                idents.append((key,len(numbers)))
+                numbers.append(i)
+            elif key in _INTERNFIELDS:
+                self.fields[key] = (_SHARED,len(shared))
+                shared.append(i)
+            else:
+                self.fields[key] = (_OBJECT,len(objects))
+                objects.append(i)
+        #id prefixes go after the other shared values, as they go after the values when packing them
+        for j in range(0,len(idents)):
+            key,index = idents[j]
+            self.fields[key] = (_IDENT,(index,len(shared)))
+            shared.append(len(self.keys)+j)
+        self.numberkeys = [self.keys[i] for i in numbers]
+        self.objectkeys = [self.keys[i] for i in objects]
+        self.sharedkeys = [self.keys[i] for i in shared if i < len(self.keys)]
+        self.identkeys = [key for key,index in idents]
+        #positions and kinds of the values that are converted before they are packed
+        self.packed = [(i,self.kinds[i]) for i in range(0,len(self.kinds)) if self.kinds[i] in (TIME,IDENT)]
+        #functions that pick the values for each part of a record out of a list of values in key order
+        self.getNumbers = getItemGetter(numbers)
+        self.getObjects = getItemGetter(objects)
+        self.getShared = getItemGetter(shared)
+        self.plain = None
+        self.additions = {} #(key,kind) -> layout with that key added
+        self.removals = {} #key -> layout with that key taken out
+
+    def add(self,key,kind):
+        layout = self.additions.get((key,kind))
+        if layout is None:
+            layout = getLayout(self.keys+(key,),self.kinds+(kind,))
+            self.additions[(key,kind)] = layout
+        return layout
+
+    def remove(self,key):
+        layout = self.removals.get(key)
+        if layout is None:
+            pairs = [(k,kind) for k,kind in zip(self.keys,self.kinds) if k != key]
+            layout = getLayout([k for k,kind in pairs],[kind for k,kind in pairs])
+            self.removals[key] = layout
+        return layout
+
+    def getPlain(self):
+        #the layout with the same keys, but with times and ids kept as they are
+        if self.plain is None:
+            self.plain = getLayout(self.keys,[kind == NUMBER for kind in self.kinds])
+        return self.plain
+
+def getItemGetter(indices):
+    #like operator.itemgetter(), but always returning a tuple
+    if len(indices) == 0:
+        return lambda values: ()
+    if len(indices) == 1:
+        index = indices[0]
+        return lambda values: (values[index],)
+    return operator.itemgetter(*indices)
+
+#all of the layouts in use, keyed by (keys,kinds), and by (keys,value types) for making records from dictionaries
+_LAYOUTS = {}
+_TYPELAYOUTS = {}
+
+def getLayout(keys,kinds):
+    """
+    Get the shared layout for a sequence of keys.
+    @param keys: Sequence of key names, in order.
+    @param kinds: Sequence of OBJECT, NUMBER, TIME or IDENT, one for each key.
+    @return: RecordLayout.
+    """
+    signature = (tuple(keys),tuple(kinds))
+    layout = _LAYOUTS.get(signature)
+    if layout is None:
+        layout = RecordLayout(*signature)
+        _LAYOUTS[signature] = layout
+    return layout
+
+EMPTY = getLayout((),())
+
+#tuples of interned values that records share
+_SHAREDVALUES = {}
+
+def getValue(key,value):
+    if key in _INTERNFIELDS and type(value) is str:
+        return intern(value)
+    return value
+
+def getShared(values):
+    #the shared copy of a tuple of interned values
+    try:
+        return _SHAREDVALUES.setdefault(values,values)
+    except TypeError: #something unhashable
+        return values
+
+def packTime(dtime):
+    #microseconds since 1970 as a float, or None for a datetime the array of floats can't hold exactly
+    if dtime.tzinfo is not None:
+        return None
+    epoch = fasttime.toEpoch(dtime)
+    if epoch <= -MAXEPOCH or epoch >= MAXEPOCH:
+        return None
+    return float(epoch)
+
+def splitId(eventid):
+    #(interned prefix,number) of an id, or None for an id that isn't a prefix and a number
+    match = IDPATTERN.match(eventid)
+    if match is None:
+        return None
+    return (intern(match.group(1)),float(match.group(2)))
+
+def getKind(key,value):
+    #how a value is kept, checking that it can be
+    if isinstance(value,float):
+        return NUMBER
+    if type(value) is datetime.datetime and packTime(value) is not None:
+        return TIME
+    if key in _IDFIELDS and type(value) is str and IDPATTERN.match(value) is not None:
+        return IDENT
+    return OBJECT
+
+def getTypeKind(key,vtype):
+    #how values of a type are kept, if they can be (see packValues())
+    if issubclass(vtype,float): #including numpy float64
+        return NUMBER
+    if vtype is datetime.datetime:
+        return TIME
+    if vtype is str and key in _IDFIELDS:
+        return IDENT
+    return OBJECT
+
+def packValues(layout,values):
+    """
+    Split the values of a record into the parts the record keeps.
+    @param layout: RecordLayout.
+    @param values: Sequence of values in the layout's key order.
+    @return: (array of floats,tuple of objects,shared tuple), or None if a time or an id can't be
+    kept the way the layout says.
+    """
+    if len(layout.packed):
+        values = list(values)
+        for index,kind in layout.packed:
+            if kind == TIME:
+                value = packTime(values[index])
+                if value is None:
+                    return None
+                values[index] = value
+            else:
+                parts = splitId(values[index])
+                if parts is None:
+                    return None
+                values[index] = parts[1]
+                values.append(parts[0])
+    shared = tuple([intern(value) if type(value) is str else value for value in layout.getShared(values)])
+    return (array.array('d',layout.getNumbers(values)),layout.getObjects(values),getShared(shared))
+
+class EventRecord(object):
+    """
+    Event with the mapping methods of a dictionary.
+    """
+    __slots__ = ['_layout','_numbers','_objects','_shared']
+
+    def __init__(self,items=None,**kwargs):
+        self._layout = EMPTY
+        self._numbers = array.array('d')
+        self._objects = ()
+        self._shared = ()
+        if items is not None:
+            self.fill(items)
+        if len(kwargs):
+            self.update(kwargs)
+
+    def fill(self,items):
+        #set up an empty record from a dictionary (or list of pairs), with each array allocated once
+        if hasattr(items,'keys'):
+            keys = tuple(items.keys())
+            values = items.values()
+        else:
+            keys = tuple([key for key,value in items])
+            values = [value for key,value in items]
+        #the layout depends on the type of each value, and looking it up by type saves checking each one
+        signature = (keys,tuple(map(type,values)))
+        layout = _TYPELAYOUTS.get(signature)
+        if layout is None:
+            layout = getLayout(keys,[getTypeKind(key,vtype) for key,vtype in zip(keys,signature[1])])
+            if len(layout.keys) != len(keys):
+                raise ValueError,'Duplicate keys in %s' % repr(keys)
+            _TYPELAYOUTS[signature] = layout
+        parts = packValues(layout,values)
+        if parts is None:
+            #a time or an id that doesn't fit in the array of floats
+            layout = layout.getPlain()
+            parts = packValues(layout,values)
+        self._layout = layout
+        self._numbers,self._objects,self._shared = parts
+
+    def setValues(self,layout,values):
+        #replace all of the values, with a layout that fits them
+        self._layout = layout
+        self._numbers,self._objects,self._shared = packValues(layout,values)
+
+    def __getitem__(self,key):
+        where,index = self._layout.fields[key]
+        if where == _NUMBER:
+            return self._numbers[index]
+        if where == _SHARED:
+            return self._shared[index]
+        if where == _OBJECT:
+            return self._objects[index]
+        if where == _TIME:
+            return fasttime.toDatetime(self._numbers[index])
+        return self._shared[index[1]] + '%d' % self._numbers[index[0]]
+
+    def __setitem__(self,key,value):
+        kind = getKind(key,value)
+        field = self._layout.fields.get(key)
+        if field is not None:
+            where,index = field
+            if where == _NUMBER and kind == NUMBER:
+                self._numbers[index] = value
+                return
+            if where == _TIME and kind == TIME:
+                self._numbers[index] = packTime(value)
+                return
+            if where == _OBJECT and kind == OBJECT:
+                self._objects = self._objects[0:index] + (value,) + self._objects[index+1:]
+                return
+            if where == _SHARED and kind == OBJECT:
+                self._shared = getShared(self._shared[0:index] + (getValue(key,value),) + self._shared[index+1:])
+                return
+            #kept some other way now
+            del self[key]
+        self.setValues(self._layout.add(key,kind),self.values()+[value])
+
+    def __delitem__(self,key):
+        layout = self._layout.remove(key)
+        if layout is self._layout:
+            raise KeyError,key
+        self.setValues(layout,[self[k] for k in layout.keys])
+
+    def __contains__(self,key):
+        return key in self._layout.fields
+
+    def has_key(self,key):
+        return key in self._layout.fields
+
+    def get(self,key,default=None):
+        if key not in self._layout.fields:
+            return default
+        return self[key]
+
+    def keys(self):
+        return list(self._layout.keys)
+
+    def values(self):
+        return [self[key] for key in self._layout.keys]
+
+    def items(self):
+        return [(key,self[key]) for key in self._layout.keys]
+
+    def iterkeys(self):
+        return iter(self._layout.keys)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._layout.keys)
+
+    def copy(self):
+        record = EventRecord()
+        record._layout = self._layout
+        record._numbers = array.array('d',self._numbers)
+        record._objects = self._objects
+        record._shared = self._shared
+        return record
+
+    def update(self,other):
+        if hasattr(other,'keys'):
+            other = [(key,other[key]) for key in other.keys()]
+        for key,value in other:
+            self[key] = value
+
+    def setdefault(self,key,default=None):
+        if key not in self._layout.fields:
+            self[key] = default
+        return self[key]
+
+    def pop(self,key,*default):
+        if key not in self._layout.fields:
+            if len(default):
+                return default[0]
+            raise KeyError,key
+        value = self[key]
+        del self[key]
+        return value
+
+    def todict(self):
+        return dict(self.items())
+
+    def __eq__(self,other):
+        if not hasattr(other,'keys'):
+            return False
+        return self.todict() == dict([(key,other[key]) for key in other.keys()])
+
+    def __ne__(self,other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'EventRecord(%s)' % repr(self.todict())
+
+    def __getstate__(self):
+        #the keys and kinds tuples are shared, so pickle only stores them once for many records
+        return (self._layout.keys,self._layout.kinds,self._numbers.tostring(),self._objects,self._shared)
+
+    def __setstate__(self,state):
+        if len(state) == 4:
+            #pickled before times, ids and shared values were kept apart: floats, then everything else
+            keys,kinds,numbers,objects = state
+            floats = array.array('d')
+            floats.fromstring(numbers)
+            floats = iter(floats)
+            objects = iter(objects)
+            self.fill([(key,floats.next() if kind else objects.next()) for key,kind in zip(keys,kinds)])
+            return
+        keys,kinds,numbers,objects,shared = state
+        self._layout = getLayout(keys,kinds)
+        self._numbers = array.array('d')
+        self._numbers.fromstring(numbers)
+        self._objects = tuple(objects)
+        self._shared = getShared(tuple(shared))
+
+def getMagnitudeRecords(magnitudes):
+    #map() makes a list just long enough, where a list comprehension leaves room for more
+    return map(getMagnitudeRecord,magnitudes)
+
+def getMagnitudeRecord(magnitude):
+    if isinstance(magnitude,dict):
+        return getRecord(magnitude)
+    return magnitude
+
+def getRecord(event):
+    """
+    Turn an event dictionary into an EventRecord.
+    @param event: Event dictionary, or an EventRecord (which is returned as is).
+    @return: EventRecord, with each of its magnitude dictionaries also made into an EventRecord.
+    """
+    if isinstance(event,EventRecord):
+        return event
+    record = EventRecord(event)
+    #the magnitude dictionaries are as big as the rest of a small event, so compact those too
+    magnitudes = record.get('magnitude')
+    if isinstance(magnitudes,list):
+        record['magnitude'] = getMagnitudeRecords(magnitudes)
+    return record
+
+def getBatchLength(batch):
+    """
+    Get the number of events in a batch.
+    @param batch: Dictionary of equal length columns keyed by event field.
+    @return: Number of events.
+    """
+    lengths = set([len(column) for column in batch.values()])
+    if len(lengths) > 1:
+        raise ValueError,'Batch columns have different lengths %s' % repr(sorted(lengths))
+    if not len(lengths):
+        return 0
+    return lengths.pop()
+
+def getColumnValues(column):
+    #a column as a list of python values (numpy datetime64 arrays become datetimes, and so on)
+    if isinstance(column,numpy.ndarray):
+        return column.tolist()
+    return list(column)
+
+def selectBatch(batch,indices):
+    """
+    Get some of the events in a batch.
+    @param batch: Dictionary of equal length columns keyed by event field.
+    @param indices: Sequence of event indices, or boolean numpy array.
+    @return: New batch with only those events.
+    """
+    if isinstance(indices,numpy.ndarray) and indices.dtype == bool:
+        indices = numpy.flatnonzero(indices)
+    selection = {}
+    for key,column in batch.items():
+        if isinstance(column,numpy.ndarray):
+            selection[key] = column[numpy.asarray(indices,dtype=int)]
+        else:
+            selection[key] = [column[i] for i in indices]
+    return selection
+
+def selectTimes(batch,startDate=None,endDate=None):
+    """
+    Get the events in a batch with times inside a window.
+    @param batch: Dictionary of equal length columns keyed by event field, with a time column of
+    datetimes or numpy datetime64 values.
+    @param startDate: Earliest event time datetime, or None.
+    @param endDate: Latest event time datetime, or None.
+    @return: New batch with only those events.
+    """
+    times = batch['time']
+    if isinstance(times,numpy.ndarray) and times.dtype.kind == 'M':
+        keep = numpy.ones(len(times),dtype=bool)
+        if startDate is not None:
+            keep &= times >= numpy.datetime64(startDate)
+        if endDate is not None:
+            keep &= times <= numpy.datetime64(endDate)
+        return selectBatch(batch,keep)
+    keep = [i for i in range(0,len(times)) if (startDate is None or times[i] >= startDate) and
+            (endDate is None or times[i] <= endDate)]
+    return selectBatch(batch,keep)
+
+def getBatchRows(batch):
+    """
+    Turn a batch into event dictionaries.
+    @param batch: Dictionary of equal length columns keyed by event field.
+    @return: List of event dictionaries, in batch order.
+    """
+    keys = batch.keys()
+    columns = [getColumnValues(batch[key]) for key in keys]
+    return [dict(zip(keys,row)) for row in zip(*columns)]
+
+def packColumn(key,column):
+    """
+    Work out how the values in a batch column can all be kept.
+    @param key: Event field.
+    @param column: Numpy array or list.
+    @return: (kind,numbers,prefixes) tuple: OBJECT, NUMBER, TIME or IDENT, the column of floats to
+    keep in the arrays of floats (None for objects), and the column of id prefixes (None except for ids).
+    """
+    if isinstance(column,numpy.ndarray):
+        if column.dtype.kind == 'f':
+            return (NUMBER,column,None)
+        if column.dtype.kind == 'M':
+            epochs = column.astype('M8[us]').view(numpy.int64)
+            #NaT is the most negative int64, so it's out of range as well
+            if ((epochs > -MAXEPOCH) & (epochs < MAXEPOCH)).all():
+                return (TIME,epochs.astype(numpy.float64),None)
+            return (OBJECT,None,None)
+    values = getColumnValues(column)
+    if not len(values):
+        return (OBJECT,None,None)
+    if len([value for value in values if type(value) is datetime.datetime]) == len(values):
+        epochs = [packTime(value) for value in values]
+        if None not in epochs:
+            return (TIME,epochs,None)
+    if key in _IDFIELDS and len([value for value in values if type(value) is str]) == len(values):
+        parts = [splitId(value) for value in values]
+        if None not in parts:
+            return (IDENT,[number for prefix,number in parts],[prefix for prefix,number in parts])
+    return (OBJECT,None,None)
+
+def getObjectColumn(key,column):
+    #a batch column as the values records keep
+    values = getColumnValues(column)
+    if key in _INTERNFIELDS:
+        values = [intern(value) if type(value) is str else value for value in values]
+    if key == 'magnitude':
+        values = [getMagnitudeRecords(magnitudes) if isinstance(magnitudes,list) else magnitudes
+                  for magnitudes in values]
+    return values
+
+def getBatchRecords(batch):
+    """
+    Turn a batch into EventRecords, all of which share one layout.
+    @param batch: Dictionary of equal length columns keyed by event field.  Float numpy
+    arrays, times and ids are packed into the records' arrays of floats, other columns are
+    kept as objects.
+    @return: List of EventRecords, in batch order.
+    """
+    nevents = getBatchLength(batch)
+    keys = batch.keys()
+    kinds = []
+    numbercolumns = {}
+    prefixcolumns = {}
+    for key in keys:
+        kind,numbers,prefixes = packColumn(key,batch[key])
+        kinds.append(kind)
+        numbercolumns[key] = numbers
+        prefixcolumns[key] = prefixes
+    layout = getLayout(keys,kinds)
+
+    #pack the floats for all of the events into one string, and slice each record's floats from that
+    numbers = numpy.empty((nevents,len(layout.numberkeys)),dtype='f8')
+    for j in range(0,len(layout.numberkeys)):
+        numbers[:,j] = numbercolumns[layout.numberkeys[j]]
+    data = numbers.tostring()
+    width = numbers.itemsize*len(layout.numberkeys)
+
+    columns = [getObjectColumn(key,batch[key]) for key in layout.objectkeys]
+    sharedcolumns = ([getObjectColumn(key,batch[key]) for key in layout.sharedkeys] +
+                     [prefixcolumns[key] for key in layout.identkeys])
+    if len(columns):
+        rows = zip(*columns)
+    else:
+        rows = [()]*nevents
+    if len(sharedcolumns):
+        sharedrows = zip(*sharedcolumns)
+    else:
+        sharedrows = [()]*nevents
+
+    records = []
+    for i in xrange(0,nevents):
+        record = EventRecord.__new__(EventRecord)
+        record._layout = layout
+        record._numbers = array.array('d',data[i*width:(i+1)*width])
+        record._objects = rows[i]
+        record._shared = getShared(sharedrows[i])
+        records.append(record)
+    return records
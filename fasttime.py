@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Fast conversion of whole columns of event times.
+
+The catalog modules used to build a datetime for every row with strptime() or int() slices,
+which was most of the time it took to read a text catalog.  The functions here work on all
+of the times in a block of rows at once, with numpy, and represent them as integer
+microseconds since 1970 (the same numbers as numpy datetime64[us] values).  Datetimes are
+only made, also all at once, for the rows that are kept.
+"""
+
+#stdlib imports
+import datetime
+
+#third party imports
+import numpy
+
+EPOCH = datetime.datetime(1970,1,1)
+
+def toEpoch(dtime):
+    """
+    Turn a datetime into microseconds since 1970.
+    @param dtime: Datetime.
+    @return: Integer microseconds, which sort the same way the times do.
+    """
+    delta = dtime - EPOCH
+    return (delta.days*86400 + delta.seconds)*1000000 + delta.microseconds
+
+def toDatetime(epoch):
+    #the datetime for an integer number of microseconds since 1970
+    return EPOCH + datetime.timedelta(microseconds=int(epoch))
+
+def toDatetimes(epochs):
+    """
+    Turn a column of times into datetimes.
+    @param epochs: Numpy array or sequence of integer microseconds since 1970.
+    @return: List of datetimes.
+    """
+    return numpy.asarray(epochs,dtype=numpy.int64).view('M8[us]').tolist()
+
+def getEpochTimes(year,month,day,hour=0,minute=0,second=0,microsecond=0):
+    """
+    Make times from columns (or single values) of date and time parts.
+    @param year,month,day,hour,minute,second,microsecond: Integer numpy arrays or numbers.
+    @return: Numpy int64 array of microseconds since 1970.
+    @raise ValueError: If any of the parts are out of range, with the same message datetime() gives.
+    """
+    parts = numpy.broadcast_arrays(*[numpy.asarray(part,dtype=numpy.int64) for part in
+                                     [year,month,day,hour,minute,second,microsecond]])
+    year,month,day,hour,minute,second,microsecond = [numpy.atleast_1d(part) for part in parts]
+    bad = (year < 1) | (year > 9999) | (month < 1) | (month > 12) | (day < 1)
+    bad |= (hour < 0) | (hour > 23) | (minute < 0) | (minute > 59) | (second < 0) | (second > 59)
+    bad |= (microsecond < 0) | (microsecond > 999999)
+    months = numpy.where(bad,0,(year-1970)*12 + month-1).astype('M8[M]')
+    firstdays = months.astype('M8[D]').view(numpy.int64)
+    ndays = (months+1).astype('M8[D]').view(numpy.int64) - firstdays
+    bad |= day > ndays
+    if bad.any():
+        i = numpy.flatnonzero(bad)[0]
+        #let datetime tell us what's wrong with it
+        values = [int(part[i]) for part in [year,month,day,hour,minute,second,microsecond]]
+        datetime.datetime(*values)
+        raise ValueError,'Invalid time %s' % repr(values)
+    days = firstdays + day-1
+    return (((days*24 + hour)*60 + minute)*60 + second)*1000000 + microsecond
+
+def parseTimestamps(timestrs,fmt=None):
+    """
+    Parse a column of ISO 8601 time strings, like 2013-04-01 18:11:53.25 or 2013-04-01T18:11:53.
+    @param timestrs: Sequence of time strings.
+    @param fmt: strptime() format for the strings, used for any that aren't ISO 8601 (which are
+    parsed one at a time).
+    @return: Numpy int64 array of microseconds since 1970.
+    """
+    if not len(timestrs):
+        return numpy.zeros(0,dtype=numpy.int64)
+    try:
+        times = numpy.array(timestrs,dtype='M8[us]')
+    except ValueError:
+        times = None
+    if times is not None and not numpy.isnat(times).any():
+        return times.view(numpy.int64)
+    if fmt is None:
+        raise ValueError,'Could not parse times %s ...' % repr(list(timestrs[0:3]))
+    return numpy.array([toEpoch(datetime.datetime.strptime(timestr,fmt)) for timestr in timestrs],dtype=numpy.int64)
+
+def getWindow(epochs,startDate=None,endDate=None):
+    """
+    Find the times inside a time window.
+    @param epochs: Numpy array of microseconds since 1970.
+    @param startDate: Earliest time datetime, or None.
+    @param endDate: Latest time datetime, or None.
+    @return: Numpy boolean array, True for the times in the window.
+    """
+    keep = numpy.ones(len(epochs),dtype=bool)
+    if startDate is not None:
+        keep &= epochs >= toEpoch(startDate)
+    if endDate is not None:
+        keep &= epochs <= toEpoch(endDate)
+    return keep
+
+def getTimeIds(epochs):
+    """
+    Make YYYYMMDDHHMMSS event IDs from a column of times.
+    @param epochs: Numpy array of microseconds since 1970.
+    @return: List of ID strings.
+    """
+    if not len(epochs):
+        return []
+    #picked out of YYYY-MM-DDTHH:MM:SS strings
+    timestrs = numpy.datetime_as_string(numpy.asarray(epochs,dtype=numpy.int64).view('M8[us]'),unit='s').astype('S19')
+    timestrs = timestrs.view(numpy.uint8).reshape(-1,19)[:,[0,1,2,3,5,6,8,9,11,12,14,15,17,18]]
+    return numpy.ascontiguousarray(timestrs).view('S14')[:,0].tolist()
@@ -17,6 +17,7 @@ import calendar
 #local imports
 import comquakeml
 import ndk
+import manifest
 
 QUICKURL = 'http://www.ldeo.columbia.edu/~gcmt/projects/CMT/catalog/NEW_QUICK/qcmt.ndk'
 MONTHLYURL = 'http://www.ldeo.columbia.edu/~gcmt/projects/CMT/catalog/NEW_MONTHLY/'
@@ -142,6 +143,23 @@ def eventInComCat(event,isdev=False):
         inComCat = False
     return inComCat
 
+def filterEvents(events,pmanifest,settings,hashes,force=False):
+    """
+    Skip events that have already been pushed to PDL with the same input.
+    @param events: Sequence of event dictionaries.
+    @param pmanifest: Manifest object.
+    @param settings: QuakeML settings, from manifest.getSettings().
+    @param hashes: Dictionary of input hashes keyed by event ID, filled in for the events we don't skip.
+    @param force: Don't skip anything.
+    @return: Generator of event dictionaries.
+    """
+    for event in events:
+        inputhash = manifest.getEventHash(event,settings)
+        if not force and pmanifest.getStatus(event['id'],inputhash) == manifest.DONE:
+            continue
+        hashes[event['id']] = inputhash
+        yield event
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d','--dev', dest='useDev',action='store_true',
@@ -187,11 +205,16 @@ if __name__ == '__main__':
     else:
         newstart = processdict['lastquick'] - datetime.timedelta(days=7)
 
+    #the manifest outlives the QuakeML files we clean up, and tells us what we've already sent
+    pmanifest = manifest.Manifest(os.path.join(quake.xmlfolder,manifest.MANIFESTFILE))
+    settings = manifest.getSettings(quake)
+    hashes = {}
+
     #process quick solutions first
     qndkfile = getQuickNDK()
     if qndkfile is None: #couldn't get the quick CMT files
         sys.exit(1)
-    for event in ndk.getEvents([qndkfile],startDate=newstart):
+    for event in filterEvents(ndk.getEvents([qndkfile],startDate=newstart),pmanifest,settings,hashes,force=args.force):
         if not args.force and eventInComCat(event,isdev=args.useDev):
             continue
         print 'Adding event %s' % event['id']
@@ -200,10 +223,12 @@ if __name__ == '__main__':
     for event,origins,events in quake.generateEvents():
         #what to do with multiple or no origins?
         quakemlfile = quake.renderXML(event)
+        pmanifest.recordRender(event['id'],hashes[event['id']],quakemlfile)
         print 'Rendering quick event %s' % event['id']
         if not args.testMode:
             nelapsed = (datetime.datetime.utcnow() - event['time']).days
             res,output,errors = quake.push(quakemlfile,nelapsed=nelapsed)
+            pmanifest.recordPush(quakemlfile,res,output+errors)
         if event['time'] > processdict['lastquick']:
             processdict['lastquick'] = event['time']
 
@@ -215,18 +240,22 @@ if __name__ == '__main__':
     #now process monthly reviewed stuff, if we have a new monthly file at all
     if not len(mndkfiles):
         quake.clearOutput()
+        pmanifest.close()
         sys.exit(0)
     for mndkfile in mndkfiles:
-        for event in ndk.getEvents([mndkfile]):
-            quake.add(event)
+        quake.addEvents(filterEvents(ndk.getEvents([mndkfile]),pmanifest,settings,hashes,force=args.force))
 
-    for event,origins,events in quake.generateEvents():
+    #the monthly files are big enough to be worth rendering in parallel
+    events = [event for event,origins,events in quake.generateEvents()]
+    quakemlfiles = quake.renderEvents(events)
+    for event,quakemlfile in zip(events,quakemlfiles):
         #what to do with multiple or no origins?
-        quakemlfile = quake.renderXML(event)
         print 'Rendering reviewed event %s' % event['id']
+        pmanifest.recordRender(event['id'],hashes[event['id']],quakemlfile)
         if not args.testMode:
             nelapsed = (datetime.datetime.utcnow() - event['time']).days
-            quake.push(quakemlfile,nelapsed=nelapsed)
+            res,output,errors = quake.push(quakemlfile,nelapsed=nelapsed)
+            pmanifest.recordPush(quakemlfile,res,output+errors)
         if event['time'] > processdict['lastreviewed']:
             processdict['lastreviewed'] = event['time']
 
@@ -237,6 +266,7 @@ if __name__ == '__main__':
     f.close()
         
     #clean up after ourselves
+    pmanifest.close()
     if not args.noClean:
         quake.clearOutput()
     for mndkfile in mndkfiles:
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""
+Fixed width record formats, declared once and parsed two ways.
+
+A format is a list of fields, each a (name,start,end,type) tuple giving the character range
+of the field in the record and its type: int, float, or str (stripped of spaces).  A fifth
+element can give a default value for fields that can't be converted; without one, a field
+that can't be converted raises the same ValueError that int() or float() would.
+
+Schema() compiles a format into two parsers:
+ - parseRecord() parses a single record (a line, or several lines run together) into a
+   dictionary, cutting all of the fields out of it at once with a precomputed struct.
+ - parseColumns() parses a whole block of records into a dictionary of numpy columns,
+   a field at a time (see getColumn()).
+
+So a catalog module that declares the format of its records gets both.
+"""
+
+#stdlib imports
+import struct
+
+#third party imports
+import numpy
+
+def parseNumbers(chars):
+    """
+    Convert fixed width decimal numbers ("-12.345", "  17") without going through strings.
+    The digits are accumulated into an integer which is then divided by a power of ten, which
+    gives exactly the same (correctly rounded) result as float().
+    @param chars: NxW numpy uint8 array of numbers, one per row.
+    @return: Numpy float array of N values, or None if any of the numbers is in a form
+    this can't handle (exponents, blank fields, etc.)
+    """
+    columns = numpy.ascontiguousarray(chars.T) #one row per character position, for speed
+    known = (columns == ord(' ')) | (columns == ord('+')) | (columns == ord('-')) | (columns == ord('.')) | \
+            ((columns >= ord('0')) & (columns <= ord('9')))
+    if not known.all():
+        return None
+    mantissa = numpy.zeros(len(chars),dtype=numpy.int64)
+    ndigits = numpy.zeros(len(chars),dtype=numpy.int64)
+    ndecimals = numpy.zeros(len(chars),dtype=numpy.int64)
+    npoints = numpy.zeros(len(chars),dtype=numpy.int64)
+    negative = numpy.zeros(len(chars),dtype=bool)
+    for column in columns:
+        isdigit = column >= ord('0') #digits are the only characters left above '.'
+        mantissa = numpy.where(isdigit,mantissa*10 + (column - ord('0')),mantissa)
+        ndigits += isdigit
+        ndecimals += isdigit & (npoints > 0)
+        npoints += column == ord('.')
+        negative |= column == ord('-')
+    if (npoints > 1).any() or (ndigits == 0).any():
+        return None
+    values = mantissa / numpy.power(10.0,numpy.arange(len(columns)+1))[ndecimals]
+    return numpy.where(negative,-values,values)
+
+def getChars(strings,width=0):
+    """
+    Turn a column of strings into a character array, for getColumn().
+    @param strings: Sequence of strings (lines of a text catalog, for example).
+    @param width: Minimum number of characters in each row (short strings are padded with zeros).
+    @return: Numpy uint8 array with one row per string.
+    """
+    if not len(strings):
+        return numpy.zeros((0,width),dtype=numpy.uint8)
+    chars = numpy.array(strings,dtype='S')
+    width = max(chars.dtype.itemsize,width)
+    return chars.astype('S%i' % width).view(numpy.uint8).reshape(len(strings),width)
+
+def getFieldChars(chars,start,end):
+    #the characters of one field of every row, padded with zeros where the rows are too short
+    field = numpy.zeros((len(chars),end-start),dtype=numpy.uint8)
+    values = chars[:,start:end]
+    field[:,0:values.shape[1]] = values
+    return field
+
+def getColumn(strings,start,end,dtype=int,default=None):
+    """
+    Parse a fixed width field out of a column of strings.
+    @param strings: Sequence of strings, or a character array from getChars() (which is faster
+    when several fields are parsed out of the same strings).
+    @param start: Index of the first character of the field.
+    @param end: Index after the last character of the field.
+    @param dtype: int, float or str (which gives a numpy string array of the stripped fields).
+    @param default: Value for fields that can't be converted, or None to raise a ValueError.
+    @return: Numpy array of the field values.
+    """
+    if not len(strings):
+        return numpy.zeros(0,dtype=dtype)
+    if not isinstance(strings,numpy.ndarray):
+        strings = getChars(strings,end)
+    chars = getFieldChars(strings,start,end)
+    fields = chars.view('S%i' % (end-start))[:,0]
+    if dtype is str:
+        return numpy.char.strip(fields)
+    values = parseNumbers(chars)
+    if values is not None and not (dtype is int and (chars == ord('.')).any()):
+        return values.astype(dtype)
+    #the slow way, which raises the same errors as float() or int()
+    try:
+        return fields.astype(dtype)
+    except ValueError:
+        if default is None:
+            raise
+    values = []
+    for field in fields.tolist():
+        try:
+            values.append(dtype(field))
+        except ValueError:
+            values.append(default)
+    return numpy.array(values,dtype=dtype)
+
+def convertField(convert,text,default):
+    #convert a field that has a default value
+    try:
+        return convert(text)
+    except ValueError:
+        return default
+
+class Schema(object):
+    """
+    A compiled fixed width record format.
+    """
+    def __init__(self,fields):
+        """
+        @param fields: List of (name,start,end,type) or (name,start,end,type,default) tuples
+        (see the module documentation).  Fields may overlap.
+        """
+        self.Fields = []
+        for field in fields:
+            name,start,end,dtype = field[0:4]
+            default = None
+            if len(field) > 4:
+                default = field[4]
+            if dtype not in [int,float,str]:
+                raise Exception,'Unsupported type %s for field "%s"' % (repr(dtype),name)
+            if not end > start:
+                raise Exception,'Empty character range for field "%s"' % name
+            self.Fields.append((name,start,end,dtype,default))
+        self.Width = max([end for name,start,end,dtype,default in self.Fields])
+
+        #cut the record at every field boundary, so that each field is a run of whole pieces
+        #(usually just one) and the struct can skip the characters no field uses
+        bounds = sorted(set([0] + [start for name,start,end,dtype,default in self.Fields] +
+                            [end for name,start,end,dtype,default in self.Fields]))
+        fmt = ''
+        pieces = {} #character offset: index of the piece that starts there in the unpacked tuple
+        for left,right in zip(bounds[0:-1],bounds[1:]):
+            used = False
+            for name,start,end,dtype,default in self.Fields:
+                if start <= left and right <= end:
+                    used = True
+                    break
+            if used:
+                pieces[left] = len(pieces)
+                fmt += '%is' % (right-left)
+            else:
+                fmt += '%ix' % (right-left)
+        self.Struct = struct.Struct(fmt)
+
+        #generate the record parser: a function that unpacks the pieces and converts each field
+        #in one expression, about as fast as slicing the fields out by hand
+        namespace = {'unpack':self.Struct.unpack_from,'convert':convertField,'strip':str.strip,'int':int,'float':float}
+        items = []
+        for i in range(0,len(self.Fields)):
+            name,start,end,dtype,default = self.Fields[i]
+            first = pieces[start]
+            npieces = len([left for left in pieces.keys() if left >= start and left < end])
+            text = '+'.join(['pieces[%i]' % piece for piece in range(first,first+npieces)])
+            converter = {int:'int',float:'float',str:'strip'}[dtype]
+            if default is None:
+                items.append('%s:%s(%s)' % (repr(name),converter,text))
+            else:
+                namespace['default%i' % i] = default
+                items.append('%s:convert(%s,%s,default%i)' % (repr(name),converter,text,i))
+        source = 'def parse(record,offset):\n    pieces = unpack(record,offset)\n    return {%s}\n' % ','.join(items)
+        exec source in namespace
+        self.Parse = namespace['parse']
+
+    def getNames(self):
+        return [name for name,start,end,dtype,default in self.Fields]
+
+    def parseRecord(self,record,offset=0):
+        """
+        Parse one record.
+        @param record: Record string, or a buffer (a memoryview of a whole file, for example)
+        holding the record.  Strings shorter than the format are padded with spaces.
+        @param offset: Offset of the record in the string or buffer.
+        @return: Dictionary of field values.
+        @raise ValueError: If a field without a default can't be converted.
+        """
+        if isinstance(record,basestring) and len(record)-offset < self.Width:
+            record = record[offset:].ljust(self.Width)
+            offset = 0
+        return self.Parse(record,offset)
+
+    def parseColumns(self,records,names=None):
+        """
+        Parse many records at once.
+        @param records: Sequence of record strings, or a character array from getChars().
+        @param names: Names of the fields to parse, or None for all of them.
+        @return: Dictionary of numpy arrays of field values (strings for str fields), keyed by field name.
+        @raise ValueError: If a field without a default can't be converted.
+        """
+        if not isinstance(records,numpy.ndarray):
+            records = getChars(records,self.Width)
+        columns = {}
+        for name,start,end,dtype,default in self.Fields:
+            if names is not None and name not in names:
+                continue
+            columns[name] = getColumn(records,start,end,dtype,default)
+        return columns
@@ -1,14 +1,33 @@
 #!/usr/bin/env python
 
-import datetime
+#third party imports
+import numpy
+
+#local imports
+import fasttime
 
 #1900-07-29 06:59:00.00
 TIMEFMT = '%Y-%m-%d %H:%M:%S.%f'
 
+RECORDLINES = 1 #one event per line, comment lines start with #
+HEADERLINES = 0
+DATE_FILTERED = True #getEvents() only returns events in the time window
+
 def getEvents(args,startDate=None,endDate=None):
     f = open(args[0],'rt')
     lines = f.readlines()
     f.close()
+    return parseRecords(lines,startDate,endDate)
+
+def parseRecords(lines,startDate=None,endDate=None):
+    """
+    Parse catalog lines into event dictionaries (see parallelparse.py).
+    @param lines: List of catalog lines.
+    @param startDate: Earliest event time datetime, or None.
+    @param endDate: Latest event time datetime, or None.
+    @return: Generator of event dictionaries.
+    """
+    rows = []
     for line in lines:
         if line.strip().startswith('#'):
             continue
@@ -18,11 +37,16 @@ def getEvents(args,startDate=None,endDate=None):
             float(parts[10])
         except ValueError:
             continue
+        rows.append(parts)
+    #the times of all of the events, at once (see fasttime.py)
+    times = fasttime.parseTimestamps([parts[0].strip() for parts in rows],TIMEFMT)
+    keep = fasttime.getWindow(times,startDate,endDate)
+    indices = numpy.flatnonzero(keep).tolist()
+    etimes = fasttime.toDatetimes(times[keep])
+    for i in range(0,len(indices)):
+        parts = rows[indices[i]]
         eqdict = {}
-        timestr = parts[0].strip()
-        eqdict['time'] = datetime.datetime.strptime(timestr,TIMEFMT)
-        if eqdict['time'] < startDate or eqdict['time'] > endDate:
-            continue
+        eqdict['time'] = etimes[i]
         eqdict['lat'] = float(parts[1])
         eqdict['lon'] = float(parts[2])
         try:
@@ -37,7 +37,7 @@ def pushAuto(quakemlfile,event,quake):
         propnuggets.append('--%s=%s' % (key,value))
     propstr = ' '.join(propnuggets)
                         
-    CMD = 'java -jar [PDLFOLDER]/ProductClient.jar %s --configFile=[PDLFOLDER]/[CONFIGFILE] --privateKey=[PDLFOLDER]/[KEYFILE] --file=[QUAKEMLFILE]' % propstr
+    CMD = '%s --configFile=[PDLFOLDER]/[CONFIGFILE] --privateKey=[PDLFOLDER]/[KEYFILE] --file=[QUAKEMLFILE]' % propstr
 
     pdlfolder = quake.config.get('PDL','folder')
     pdlkey = quake.config.get('PDL','keyfile')
@@ -46,7 +46,7 @@ def pushAuto(quakemlfile,event,quake):
     cmd = cmd.replace('[CONFIGFILE]',pdlconfig)
     cmd = cmd.replace('[KEYFILE]',pdlkey)
     cmd = cmd.replace('[QUAKEMLFILE]',quakemlfile)
-    res,output,errors = quake.getCommandOutput(cmd)
+    res,output,errors = quake.sender.send(cmd.split())
     return (res,output,errors)
     
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Persistent record of the products rendered and pushed from an output folder.
+
+For each event ID the manifest keeps a hash of the input fields the product was rendered
+from, a hash of the rendered file and the result of the last push, so that re-running a
+load only renders and pushes events that are new, have changed, or never made it to PDL.
+"""
+
+#stdlib imports
+import sqlite3
+import hashlib
+import datetime
+import os.path
+
+#local imports
+import eventrecord
+
+MANIFESTFILE = 'manifest.db'
+IGNOREKEYS = ['ctime','version'] #fields that change every time a product is rendered
+COMMIT_INTERVAL = 100 #number of changes to make before committing them to disk
+
+#what needs to be done with an event
+RENDER = 'render'
+PUSH = 'push'
+DONE = 'done'
+
+def getHashString(value):
+    """
+    Turn an event field value into a canonical string for hashing.
+    @param value: Dictionary (or EventRecord), list, datetime, number or string.
+    @return: String that only depends on the contents of value.
+    """
+    if isinstance(value,(dict,eventrecord.EventRecord)):
+        items = ['%r:%s' % (key,getHashString(value[key])) for key in sorted(value.keys())]
+        return '{%s}' % ','.join(items)
+    if isinstance(value,(list,tuple)):
+        return '[%s]' % ','.join([getHashString(item) for item in value])
+    if isinstance(value,datetime.datetime):
+        return value.isoformat()
+    if isinstance(value,float):
+        return repr(float(value))
+    return repr(value)
+
+def getSettings(quake):
+    """
+    Get the QuakeML settings that affect what an event is rendered to.
+    @param quake: QuakeML object.
+    @return: List of settings, including the template text.
+    """
+    return [quake.type,quake.source,quake.method,quake.catalog,quake.triggersource,
+            quake.contributor,quake.agency,quake.xml,quake.magxml]
+
+def getEventHash(event,settings=None):
+    """
+    Hash the input fields of an event.
+    @param event: Event dictionary.
+    @param settings: List of other things the product depends on (see getSettings()).
+    @return: Hex digest string.
+    """
+    fields = {}
+    for key in event.keys():
+        if key not in IGNOREKEYS:
+            fields[key] = event[key]
+    return hashlib.sha1(getHashString([fields,settings])).hexdigest()
+
+def getFileHash(filename):
+    f = open(filename,'rb')
+    digest = hashlib.sha1(f.read()).hexdigest()
+    f.close()
+    return digest
+
+class Manifest(object):
+    """
+    SQLite database of rendered and pushed products.
+    """
+    def __init__(self,filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('''CREATE TABLE IF NOT EXISTS products (id TEXT PRIMARY KEY, inputhash TEXT,
+                           contenthash TEXT, xmlfile TEXT, rendertime TEXT,
+                           pushed INTEGER, pushtime TEXT, pushoutput TEXT)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS xmlfileidx ON products (xmlfile)')
+        self.db.commit()
+        self.nchanges = 0
+
+    def getProduct(self,eventid):
+        """
+        Get the record for an event.
+        @param eventid: Event ID.
+        @return: Dictionary of id,inputhash,contenthash,xmlfile,rendertime,pushed,pushtime,pushoutput,
+        or None if the event has never been rendered.
+        """
+        row = self.db.execute('SELECT * FROM products WHERE id=?',(eventid,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(row.keys(),row))
+
+    def getStatus(self,eventid,inputhash):
+        """
+        Find out what needs to be done with an event.
+        @param eventid: Event ID.
+        @param inputhash: Hash of the event input fields, from getEventHash().
+        @return: RENDER if the event is new or has changed, or its file is missing or altered,
+        PUSH if the file is up to date but has not been sent to PDL, and DONE if it has.
+        """
+        product = self.getProduct(eventid)
+        if product is None or product['inputhash'] != inputhash:
+            return RENDER
+        if product['pushed']:
+            return DONE
+        xmlfile = product['xmlfile']
+        if os.path.isfile(xmlfile) and getFileHash(xmlfile) == product['contenthash']:
+            return PUSH
+        return RENDER
+
+    def recordRender(self,eventid,inputhash,xmlfile):
+        """
+        Record that an event has been rendered (and not yet pushed).
+        @param eventid: Event ID.
+        @param inputhash: Hash of the event input fields, from getEventHash().
+        @param xmlfile: Name of the rendered file.
+        """
+        rendertime = datetime.datetime.utcnow().isoformat()
+        self.db.execute('INSERT OR REPLACE INTO products VALUES (?,?,?,?,?,0,NULL,NULL)',
+                        (eventid,inputhash,getFileHash(xmlfile),xmlfile,rendertime))
+        self.changed()
+
+    def recordPush(self,xmlfile,success,output):
+        """
+        Record the result of pushing a rendered file.
+        @param xmlfile: Name of the rendered file.
+        @param success: True if the push succeeded.
+        @param output: Output or error text from the push.
+        """
+        pushtime = datetime.datetime.utcnow().isoformat()
+        output = output.decode('utf-8','replace') #sqlite won't take other 8-bit strings
+        self.db.execute('UPDATE products SET pushed=?,pushtime=?,pushoutput=? WHERE xmlfile=?',
+                        (int(bool(success)),pushtime,output,xmlfile))
+        self.changed()
+
+    def remove(self,eventid):
+        #forget an event, e.g. after its product has been deleted from PDL
+        self.db.execute('DELETE FROM products WHERE id=?',(eventid,))
+        self.changed()
+
+    def changed(self):
+        #commit every so often, so a crash only loses the last few records
+        self.nchanges += 1
+        if self.nchanges >= COMMIT_INTERVAL:
+            self.db.commit()
+            self.nchanges = 0
+
+    def clear(self):
+        self.db.execute('DELETE FROM products')
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
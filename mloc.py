@@ -5,7 +5,6 @@ import sys
 import os.path
 from datetime import datetime,timedelta
 import re
-import socket
 import string
 import argparse
 import textwrap
@@ -17,9 +16,14 @@ import json
 
 #local imports
 from neicio.tag import Tag
+import cwbclient
+import stationcache
+import stationinventory
+import fasttime
 
 CWBHOST = 'cwbpub.cr.usgs.gov'
 CWBPORT = 2052
+STATIONCACHE = 'stationcache.db' #see stationcache.py
 
 MINMAG = 4.0
 
@@ -45,53 +49,62 @@ DEPTHTYPES = {'c':'operator assigned',
               'w':'from moment tensor inversion'}
 
 class StationTranslator(object):
-    def __init__(self,dictionaryfile=None):
+    def __init__(self,dictionaryfile=None,client=None,cache=None,inventory=None):
+        """
+        @param dictionaryfile: File containing dictionary of station->NSCL codes, or None.  These
+        are used for all times, in preference to anything looked up.
+        @param client: cwbclient.CWBClient to ask for station metadata, or None to connect to
+        the public CWB server.
+        @param cache: stationcache.StationCache of NSCLs looked up before, or None to keep them
+        in memory.
+        @param inventory: stationinventory.StationInventory to find NSCLs in instead of asking
+        the CWB server, or None.
+        """
         self.stationdict = {}
+        self.resolved = {} #station key: NSCL of everything looked up, for save()
+        #NSCLs resolved while the server failed to answer some request, kept for this run only
+        self.unsaved = stationcache.StationCache(':memory:')
         if dictionaryfile is not None:
             f = open(dictionaryfile,'rt')
             for line in f.readlines():
                 key,value = line.split('=')
                 self.stationdict[key.strip()] = value.strip()
             f.close()
-            
+        if client is None:
+            client = cwbclient.CWBClient(CWBHOST,CWBPORT)
+        self.client = client
+        if cache is None:
+            cache = stationcache.StationCache(':memory:')
+        self.cache = cache
+        self.inventory = inventory
 
     def save(self,dictfile):
+        stationdict = self.resolved.copy()
+        stationdict.update(self.stationdict)
         f = open(dictfile,'wt')
-        for key,value in self.stationdict.iteritems():
+        for key,value in stationdict.iteritems():
             f.write('%s = %s\n' % (key.strip(),value.strip()))
         f.close()
 
     def callCWBServer(self,req):
-        response = ''
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM,0)
-            s.connect((CWBHOST,CWBPORT))
-            s.send(req)
-            while True:
-                tresp = s.recv(10241)
-                response += tresp
-                if response.find('<EOR>') > -1:
-                    break
-
-
-            s.close()
-        except Exception,msg:
-            try:
-                time.sleep(2)
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM,0)
-                s.connect((CWBHOST,CWBPORT))
-                s.send(req)
-                response = s.recv(10241)
-                s.close()
-            except:
-                pass
-        return response
-        
-    def getStationEpoch(self,station,phasetime):
-        req = '-c c -s ..%s -b all \n' % station
-        pad = chr(0) * (80 - len(req))
-        req = str(req + pad)
-        response = self.callCWBServer(req)
+        #connections are kept open and reused (see cwbclient.py).  None if the server didn't answer.
+        return self.client.query(req)
+
+    def close(self):
+        self.client.close()
+        self.cache.close()
+        self.unsaved.close()
+
+    def callCWBServerMany(self,reqs):
+        #answers to a list of requests, each asked once, spread over all of the client's connections
+        #(None for those the server didn't answer)
+        reqs = list(OrderedDict.fromkeys(reqs))
+        return dict(zip(reqs,self.client.queryParallel(reqs)))
+
+    def getEpochRequest(self,station):
+        return '-c c -s ..%s -b all \n' % station
+
+    def parseEpochs(self,response):
         lines = response.split('\n')
         epochs = []
         for line in lines:
@@ -105,6 +118,10 @@ class StationTranslator(object):
             t1 = datetime.strptime(datestr1 + ' ' + timestr1,'%Y-%m-%d %H:%M:%S')
             t2 = datetime.strptime(datestr2 + ' ' + timestr2,'%Y-%m-%d %H:%M:%S')
             epochs.append((t1,t2))
+        return epochs
+
+    def getEpoch(self,epochs,phasetime):
+        #a date in the first epoch that contains the phase time, where valid metadata is available
         etime = None
         for epoch in epochs:
             t1,t2 = epoch
@@ -119,11 +136,31 @@ class StationTranslator(object):
                 break
         return etime
 
-    def getIR(self,station):
-        req = '-b all -a *.*.%s -c c \n' % station
-        pad = chr(0) * (80 - len(req))
-        req = str(req + pad)
-        response = self.callCWBServer(req)
+    def getValidity(self,epochs,phasetime):
+        """
+        Find how long the answer for a phase time holds: the interval around it in which the
+        same epochs contain the phase time, so that getEpoch() picks the same one.
+        @param epochs: List of (start,end) datetimes from parseEpochs().
+        @param phasetime: Datetime of the phase.
+        @return: (starttime,endtime) bounds of the open interval, in microseconds since 1970.
+        """
+        slop = TIMERROR*86400*1000000
+        epoch = fasttime.toEpoch(phasetime)
+        bounds = [fasttime.toEpoch(t1)-slop for t1,t2 in epochs] + [fasttime.toEpoch(t2)+slop for t1,t2 in epochs]
+        if epoch in bounds:
+            return (epoch-1,epoch+1)
+        starttime = max([bound for bound in bounds if bound < epoch] + [stationcache.MINTIME])
+        endtime = min([bound for bound in bounds if bound > epoch] + [stationcache.MAXTIME])
+        return (starttime,endtime)
+
+    def getStationEpoch(self,station,phasetime):
+        epochs = self.parseEpochs(self.callCWBServer(self.getEpochRequest(station)) or '')
+        return self.getEpoch(epochs,phasetime)
+
+    def getIRRequest(self,station):
+        return '-b all -a *.*.%s -c c \n' % station
+
+    def parseIR(self,response,station):
         lines = response.split('\n')
         nscl = station
         for line in lines:
@@ -136,12 +173,14 @@ class StationTranslator(object):
             nscl = '%s.%s..' % (d,s)
             break
         return nscl
+
+    def getIR(self,station):
+        return self.parseIR(self.callCWBServer(self.getIRRequest(station)) or '',station)
     
-    def getFSDN(self,station):
-        req = '-c c -a FDSN.IR.%s -c c \n' % station
-        pad = chr(0) * (80 - len(req))
-        req = str(req + pad)
-        response = self.callCWBServer(req)
+    def getFSDNRequest(self,station):
+        return '-c c -a FDSN.IR.%s -c c \n' % station
+
+    def parseFSDN(self,response,station):
         lines = response.split('\n')
         fsdn = station
         for line in lines:
@@ -156,36 +195,44 @@ class StationTranslator(object):
             fsdn = '%s.%s..' % (parts[1],parts[2])
             break
         return fsdn
-    
-    def getNSCL(self,station,phasetype,phasetime):
-        stationkey = station+'-'+phasetype[0:1]
-        if self.stationdict.has_key(stationkey):
-            #sys.stderr.write('Using cached station key %s\n' % stationkey)
-            return self.stationdict[stationkey]
-        
+
+    def getFSDN(self,station):
+        return self.parseFSDN(self.callCWBServer(self.getFSDNRequest(station)) or '',station)
+
+    def getChannelRequest(self,station,epoch):
+        #channels on the day after a date where valid metadata is available
         dt = timedelta(seconds=86400)
-        preferred = station
-        epoch = self.getStationEpoch(station,phasetime) #get a date where valid metadata is available
-        if epoch is not None:
-            timestr = (epoch+dt).strftime('%Y/%m/%d')
-            okchannels = ['HH','BH','SH','HN']
-            scode = '..%s' % (station)
-            req = '-c c -s %s -b %s \n' % (scode,timestr)
-            pad = chr(0) * (80 - len(req))
-            req = str(req + pad)
-            response = self.callCWBServer(req)
-            lines = response.split('\n')
-            if response.find('no channels found to match') > -1:
-                preferred = station
-                lines = []
-        else:
+        timestr = (epoch+dt).strftime('%Y/%m/%d')
+        scode = '..%s' % (station)
+        return '-c c -s %s -b %s \n' % (scode,timestr)
+
+    def parseChannels(self,response,station,phasetype):
+        #the preferred NSCL for a phase, or the station name if there isn't one
+        lines = response.split('\n')
+        if response.find('no channels found to match') > -1:
             lines = []
-        nscl_list = []
+        channels = []
         for line in lines:
             parts = line.split(':')
             if len(parts) < 2:
                 continue
-            net,sta,loc,channel = parts[0].split()
+            channels.append(tuple(parts[0].split()))
+        return self.pickNSCL(channels,station,phasetype)
+
+    def pickNSCL(self,channels,station,phasetype):
+        """
+        Pick the channel to use for a phase.
+        @param channels: List of (network,station,location,channel) tuples, in the order the
+        CWB server (or a station inventory) lists them.
+        @param station: Station code.
+        @param phasetype: Phase name.
+        @return: NSCL string of the first HH, BH, SH or HN channel with the right orientation
+        (Z for P phases, 1, 2, E or N for S phases), or the station code if there isn't one.
+        """
+        preferred = station
+        okchannels = ['HH','BH','SH','HN']
+        nscl_list = []
+        for net,sta,loc,channel in channels:
             if sta.lower() != station.lower():
                 continue
             if channel[0:2] not in okchannels:
@@ -211,13 +258,132 @@ class StationTranslator(object):
             if channel.lower().startswith('hn'):
                 preferred = nscl
                 break
+        return preferred
+
+    def getInventoryNSCL(self,station,phasetype,phasetime):
+        #the same steps as getNSCL(), with the channels in the station inventory
+        preferred = station
+        epoch = self.getEpoch(self.inventory.getEpochs(station),phasetime)
+        if epoch is not None:
+            date = epoch + timedelta(seconds=86400)
+            date = datetime(date.year,date.month,date.day)
+            preferred = self.pickNSCL(self.inventory.getChannels(station,date),station,phasetype)
+        self.resolved[station+'-'+phasetype[0:1]] = preferred
+        return preferred
+
+    def getCachedNSCL(self,station,phase,phasetime):
+        #an NSCL resolved before, by an earlier run or this one
+        preferred = self.cache.getNSCL(station,phase,phasetime)
+        if preferred is None:
+            preferred = self.unsaved.getNSCL(station,phase,phasetime)
+        return preferred
+
+    def getNSCL(self,station,phasetype,phasetime):
+        stationkey = station+'-'+phasetype[0:1]
+        if self.stationdict.has_key(stationkey):
+            #sys.stderr.write('Using cached station key %s\n' % stationkey)
+            return self.stationdict[stationkey]
+        if self.inventory is not None:
+            return self.getInventoryNSCL(station,phasetype,phasetime)
+        preferred = self.getCachedNSCL(station,phasetype[0:1],phasetime)
+        if preferred is not None:
+            return preferred
+
+        failed = [] #requests the server didn't answer
+        def ask(req):
+            response = self.callCWBServer(req)
+            if response is None:
+                failed.append(req)
+                return ''
+            return response
+        
+        preferred = station
+        epochs = self.parseEpochs(ask(self.getEpochRequest(station)))
+        epoch = self.getEpoch(epochs,phasetime) #get a date where valid metadata is available
+        if epoch is not None:
+            response = ask(self.getChannelRequest(station,epoch))
+            preferred = self.parseChannels(response,station,phasetype)
         if preferred == station:
-            preferred = self.getFSDN(station)
+            preferred = self.parseFSDN(ask(self.getFSDNRequest(station)),station)
         if preferred == station:
-            preferred = self.getIR(station)
-        self.stationdict[stationkey] = preferred
+            preferred = self.parseIR(ask(self.getIRRequest(station)),station)
+        starttime,endtime = self.getValidity(epochs,phasetime)
+        if len(failed):
+            self.unsaved.addNSCL(station,phasetype[0:1],starttime,endtime,preferred)
+        else:
+            self.cache.addNSCL(station,phasetype[0:1],starttime,endtime,preferred)
+        self.resolved[stationkey] = preferred
         return preferred
 
+    def prefetch(self,phases):
+        """
+        Resolve the NSCLs of many phases at once, so that getNSCL() finds them in the cache.
+        Each step of getNSCL() is done for all of the stations together, with the requests
+        spread over the client's connections, rather than one station at a time.
+        @param phases: Sequence of (station,phasetype,phasetime) tuples.  As in getNSCL(), the
+        first time in each validity interval of a station and phase type is used.
+        @return: Number of new NSCLs resolved.  Those that depend on a request the server didn't
+        answer are kept for this run, but not stored in the cache.
+        """
+        if self.inventory is not None:
+            #nothing to ask the server
+            return 0
+        todo = []
+        for station,phasetype,phasetime in phases:
+            if self.stationdict.has_key(station+'-'+phasetype[0:1]):
+                continue
+            if self.getCachedNSCL(station,phasetype[0:1],phasetime) is not None:
+                continue
+            todo.append((station,phasetype,phasetime))
+
+        #epochs of all of the stations
+        responses = self.callCWBServerMany([self.getEpochRequest(station) for station,phasetype,phasetime in todo])
+        epochlists = {}
+        for request,response in responses.iteritems():
+            epochlists[request] = self.parseEpochs(response or '')
+        #one lookup for each station, phase type and validity interval
+        groups = OrderedDict()
+        failed = set() #keys of the groups with a request the server didn't answer
+        for station,phasetype,phasetime in todo:
+            epochs = epochlists[self.getEpochRequest(station)]
+            starttime,endtime = self.getValidity(epochs,phasetime)
+            key = (station,phasetype[0:1],starttime,endtime)
+            if not groups.has_key(key):
+                groups[key] = (station,phasetype,self.getEpoch(epochs,phasetime))
+                if responses[self.getEpochRequest(station)] is None:
+                    failed.add(key)
+        chanreqs = {}
+        for key,(station,phasetype,epoch) in groups.iteritems():
+            if epoch is not None:
+                chanreqs[key] = self.getChannelRequest(station,epoch)
+
+        #then their channels
+        responses = self.callCWBServerMany(chanreqs.values())
+        preferred = {}
+        for key,(station,phasetype,epoch) in groups.iteritems():
+            preferred[key] = station
+            if chanreqs.has_key(key):
+                if responses[chanreqs[key]] is None:
+                    failed.add(key)
+                preferred[key] = self.parseChannels(responses[chanreqs[key]] or '',station,phasetype)
+
+        #and the FDSN and IR aliases of those that don't have any we can use
+        for getRequest,parseResponse in [(self.getFSDNRequest,self.parseFSDN),(self.getIRRequest,self.parseIR)]:
+            stations = [station for key,(station,phasetype,epoch) in groups.iteritems()
+                        if preferred[key] == station]
+            responses = self.callCWBServerMany([getRequest(station) for station in stations])
+            for key,(station,phasetype,epoch) in groups.iteritems():
+                if preferred[key] == station:
+                    if responses[getRequest(station)] is None:
+                        failed.add(key)
+                    preferred[key] = parseResponse(responses[getRequest(station)] or '',station)
+
+        self.cache.addNSCLs([key+(preferred[key],) for key in groups.keys() if key not in failed])
+        self.unsaved.addNSCLs([key+(preferred[key],) for key in groups.keys() if key in failed])
+        for station,phase,starttime,endtime in groups.keys():
+            self.resolved[station+'-'+phase] = preferred[(station,phase,starttime,endtime)]
+        return len(preferred)
+
 def getPrefMag(event):
     url = URLBASE.replace('[RAD]','%i' % RADIUS)
     url = url.replace('[LAT]','%.4f' % event['lat'])
@@ -321,6 +487,31 @@ def readMagnitudeLine(event,line):
         event['magnitude'] = [mag]
     return event
 
+def getPhaseTime(parts):
+    #the time of a phase, from the fields of a phase line
+    year = int(parts[5])
+    month = int(parts[6])
+    day = int(parts[7])
+    hour = int(parts[8])
+    minute = int(parts[9])
+    second = float(parts[10])
+    microsecond = int((second - int(second))*1e6)
+    second = int(second) - 1 #assumption here is that input seconds are 1 to 60
+    if second == -1: #sometimes seconds are 0 to 59, sometimes 1 to 60.  Not my problem.
+        second = 0
+    return datetime(year,month,day,hour,minute,second,microsecond)
+
+def scanPhases(lines):
+    """
+    Quickly pick out the stations of all of the phase lines in a QOM file.
+    @param lines: Lines of the file.
+    @return: Generator of (station,phasetype,phasetime) tuples, for StationTranslator.prefetch().
+    """
+    for line in lines:
+        if line.startswith('P'):
+            parts = line[1:].split()
+            yield (parts[1],parts[4],getPhaseTime(parts))
+
 def readPhaseLine(event,line,st):
     #refactoring the phase list into a phase dictionary, to handle duplicate instances of station-phase pairs.
     #We wants the *second* instance of these, which requires that I keep a dictionary of phases instead of a 
@@ -336,17 +527,7 @@ def readPhaseLine(event,line,st):
     phase['name'] = parts[4]
     phase['distance'] = float(parts[2])
     phase['azimuth'] = int(parts[3])
-    year = int(parts[5])
-    month = int(parts[6])
-    day = int(parts[7])
-    hour = int(parts[8])
-    minute = int(parts[9])
-    second = float(parts[10])
-    microsecond = int((second - int(second))*1e6)
-    second = int(second) - 1 #assumption here is that input seconds are 1 to 60
-    if second == -1: #sometimes seconds are 0 to 59, sometimes 1 to 60.  Not my problem.
-        second = 0
-    phase['time'] = datetime(year,month,day,hour,minute,second,microsecond)
+    phase['time'] = getPhaseTime(parts)
     nscl_station = st.getNSCL(station,phase['name'],phase['time'])
     phase['sta'] = nscl_station
     if nscl_station == station:
@@ -364,6 +545,40 @@ def readPhaseLine(event,line,st):
         event['phases'] = {phasekey:phase.copy()}
     return event
 
+#readers for the lines of a QOM file that add to the current event, by first character
+LINEREADERS = {'L':readLayerLine,
+               'C':readStationLine,
+               'H':readHypoLine,
+               'M':readMagnitudeLine}
+
+def readEvents(lines,st,comments=None):
+    """
+    Parse a QOM file one event at a time.
+    @param lines: Iterable of lines of the file (an open file, for example).
+    @param st: StationTranslator to find the NSCLs of phases with.
+    @param comments: List to append the text of comment lines to, or None.
+    @return: Generator of event dictionaries, each one yielded as soon as its STOP line is read.
+    """
+    readers = LINEREADERS.copy()
+    readers['P'] = lambda event,line: readPhaseLine(event,line,st)
+    event = {}
+    i = 1
+    for line in lines:
+        reader = readers.get(line[0:1])
+        if reader is not None:
+            event = reader(event,line)
+        elif line.startswith('E'):
+            event['id'] = '%08i' % i #ignore Eric's event ID fields
+        elif line.startswith('#'):
+            if comments is not None:
+                comments.append(line.strip('#'))
+        elif line.startswith('STOP'):
+            yield event
+            sys.stderr.write('Parsed event %i\n' % i)
+            i += 1
+            sys.stderr.flush()
+            event = {}
+
 def createMagTag(event):
     prefmag = None
     for mag in event['magnitude']:
@@ -627,55 +842,25 @@ def main(args):
     if not os.path.isdir(outfolder):
         os.makedirs(outfolder)
     
-    st = StationTranslator(dictionaryfile=args.dictionary)
+    host,port = args.cwbserver.split(':')
+    client = cwbclient.CWBClient(host,int(port),maxconns=args.connections,timeout=args.timeout)
+    cache = stationcache.StationCache(args.stationcache)
+    inventory = None
+    if args.inventory:
+        inventory = stationinventory.StationInventory()
+        for inventoryfile in args.inventory:
+            nchannels = inventory.load(inventoryfile)
+            sys.stderr.write('Read %i channels from %s\n' % (nchannels,inventoryfile))
+    st = StationTranslator(dictionaryfile=args.dictionary,client=client,cache=cache,inventory=inventory)
     f = open(qomfile,'rt')
-    events = []
-    event = {}
-    i = 1
-    comment = ''
-    nphases = 0
-    phaselist = []
+    if not args.lazy:
+        #look up all of the stations at once, before parsing the phases
+        nresolved = st.prefetch(scanPhases(f))
+        sys.stderr.write('Looked up %i station codes\n' % nresolved)
+        f.seek(0)
     
-    for line in f.readlines():
-        if line.startswith('L'):
-            event = readLayerLine(event,line)
-        if line.startswith('C'):
-            event = readStationLine(event,line)
-        if line.startswith('#'):
-            comment += line.strip('#')
-        if line.startswith('E'):
-            event['id'] = '%08i' % i #ignore Eric's event ID fields
-        if line.startswith('H'):
-            event = readHypoLine(event,line)
-        if line.startswith('M'):
-            event = readMagnitudeLine(event,line)
-        if line.startswith('P'):
-            #sys.stderr.write('reading phase line %i ("%s")\n' % (nphases+1,line))
-            nphases += 1
-            event = readPhaseLine(event,line,st)
-        if line.startswith('STOP'):
-            events.append(event.copy())
-            sys.stderr.write('Parsed event %i\n' % i)
-            i += 1
-            sys.stderr.flush()
-            event = {}
-    f.close()
-    print 'Read %i events' % len(events)
-
-    #try to find the best magnitude from comcat for the larger events
-    for event in events:
-        if event['magnitude'][0]['magnitude'] > MINMAG:
-            prefmag = getPrefMag(event)
-            if prefmag is not None:
-                print 'For event %s, switching magnitude M%.1f to M%.1f' % (event['time'],event['magnitude'][0]['magnitude'],prefmag)
-                event['magnitude'][0]['magnitude'] = prefmag
-    
-    dictfile = 'stationcodes.dat'
-    print 'Saving dictionary of station codes to %s' % dictfile
-    st.save(dictfile)
-    
-    #filter out non-ascii characters
-    #comment = filter(lambda x: x in string.printable, comment)
+    comments = []
+    nevents = 0
     tmin = datetime(2500,1,1)
     tmax = datetime(1900,1,1)
     latmin = 95.0
@@ -684,7 +869,16 @@ def main(args):
     lonmax = -190000.0
     magmin = 10.1
     magmax = -0.1
-    for event in events:
+    #write each event out as soon as it has been read
+    for event in readEvents(f,st,comments):
+        nevents += 1
+        #try to find the best magnitude from comcat for the larger events
+        if event['magnitude'][0]['magnitude'] > MINMAG:
+            prefmag = getPrefMag(event)
+            if prefmag is not None:
+                print 'For event %s, switching magnitude M%.1f to M%.1f' % (event['time'],event['magnitude'][0]['magnitude'],prefmag)
+                event['magnitude'][0]['magnitude'] = prefmag
+
         etag,prefmag = createEventTag(event,args.studyname)
         
         if event['time'] < tmin:
@@ -709,9 +903,19 @@ def main(args):
         xmlstr = etag.renderTag(0)
         xmlstr = xmlstr.replace('\t','')
         xmlstr = xmlstr.replace('\n','')
-        f = open(fname,'wt')
-        f.write(xmlstr)
-        f.close()
+        xmlfile = open(fname,'wt')
+        xmlfile.write(xmlstr)
+        xmlfile.close()
+    f.close()
+    comment = ''.join(comments)
+    #filter out non-ascii characters
+    #comment = filter(lambda x: x in string.printable, comment)
+    print 'Read %i events' % nevents
+
+    dictfile = 'stationcodes.dat'
+    print 'Saving dictionary of station codes to %s' % dictfile
+    st.save(dictfile)
+    st.close()
 
     # studyname = args.studyname
     # authors = args.authors.split(',')
@@ -752,5 +956,17 @@ if __name__ == '__main__':
                         help='(Optional) doi number.')
     parser.add_argument('-d','--dictionary', dest='dictionary', 
                         help='(Optional) File containing dictionary of station->NSCL codes.')
+    parser.add_argument('-c','--cwbserver', dest='cwbserver', default='%s:%i' % (CWBHOST,CWBPORT),
+                        help='(Optional) host:port of the CWB metadata server (see cwbstub.py for a local stand-in).')
+    parser.add_argument('-n','--connections', dest='connections', type=int, default=4,
+                        help='(Optional) Number of connections to the CWB server.')
+    parser.add_argument('-t','--timeout', dest='timeout', type=float, default=cwbclient.DEFAULT_TIMEOUT,
+                        help='(Optional) Seconds to wait for each answer from the CWB server.')
+    parser.add_argument('-s','--stationcache', dest='stationcache', default=STATIONCACHE,
+                        help='(Optional) File keeping the station codes looked up, shared by all runs (default %s).' % STATIONCACHE)
+    parser.add_argument('-i','--inventory', dest='inventory', action='append',
+                        help='(Optional) FDSN station text or StationXML file (channel level) to find station codes in, instead of asking the CWB server.  Can be given more than once.')
+    parser.add_argument('-l','--lazy', dest='lazy', action='store_true', default=False,
+                        help='(Optional) Look up stations one at a time as the phases are read, instead of all at once first.')
     pargs = parser.parse_args()
     main(pargs)
@@ -8,9 +8,68 @@ import optparse
 import re
 import math
 import pickle
+import mmap
+import gzip
+import bz2
 
+#third party imports
+import numpy
+
+#local imports
+import eventrecord
+import fasttime
+import fixedwidth
 
 TIMEFMT = '%Y-%m-%d %H:%M:%S'
+GZIP_MAGIC = '\x1f\x8b'
+BZ2_MAGIC = 'BZh'
+LINEWIDTH = 80 #NDK lines are 80 characters wide
+CHUNKBYTES = 4*1024*1024 #number of bytes to read at a time when parsing into arrays
+INDEXEXT = '.idx' #extension of the time index file saved next to an NDK file
+RECORDLINES = 5 #each NDK record is five lines long
+HEADERLINES = 0
+DATE_FILTERED = True #getEvents() and getEventBatches() only return events in the time window
+
+#columns of the structured arrays made by NDKReader.generateArrays(), named after the record fields
+NDKDTYPE = [('time','M8[us]'),('lat','f8'),('lon','f8'),('depth','f8'),
+            ('triggertime','M8[us]'),('triggerlat','f8'),('triggerlon','f8'),('triggerdepth','f8'),
+            ('triggersource','S4'),('origid','S16'),('mag','f8'),('moment','f8'),
+            ('tazimuth','f8'),('tplunge','f8'),('tvalue','f8'),
+            ('nazimuth','f8'),('nplunge','f8'),('nvalue','f8'),
+            ('pazimuth','f8'),('pplunge','f8'),('pvalue','f8'),
+            ('np1strike','f8'),('np1dip','f8'),('np1rake','f8'),
+            ('np2strike','f8'),('np2dip','f8'),('np2rake','f8'),
+            ('mrr','f8'),('mtt','f8'),('mpp','f8'),('mrt','f8'),('mrp','f8'),('mtp','f8'),
+            ('numbodychannels','i4'),('numbodystations','i4'),
+            ('numsurfacechannels','i4'),('numsurfacestations','i4'),
+            ('nummantlechannels','i4'),('nummantlestations','i4'),
+            ('momentratefunction','S5'),('duration','f8')]
+
+#fixed width fields of an NDK record: (field,line,start,end,type) (see fixedwidth.py)
+#the ones with NDKDTYPE names are read straight into the array, the others are converted in parseArray()
+NDKFIELDS = [('triggersource',0,0,4,str),('year',0,5,9,int),('month',0,10,12,int),('day',0,13,15,int),
+             ('hour',0,16,18,int),('minute',0,19,21,int),('seconds',0,22,26,float),
+             ('triggerlat',0,27,33,float),('triggerlon',0,34,41,float),('triggerdepthkm',0,42,47,float),
+             ('origid',1,0,16,str),
+             ('numbodystations',1,19,22,int),('numbodychannels',1,22,27,int),
+             ('numsurfacestations',1,34,37,int),('numsurfacechannels',1,37,42,int),
+             ('nummantlestations',1,49,52,int),('nummantlechannels',1,52,57,int),
+             ('momentratefunction',1,69,74,str),('halfduration',1,75,80,float),
+             ('timeshift',2,9,18,float),('lat',2,23,30,float),('lon',2,34,42,float),('depthkm',2,47,53,float),
+             ('exponent',3,0,2,float),
+             ('mrrmantissa',3,2,9,float),('mttmantissa',3,15,22,float),('mppmantissa',3,28,35,float),
+             ('mrtmantissa',3,41,48,float),('mrpmantissa',3,54,61,float),('mtpmantissa',3,67,74,float),
+             ('tmantissa',4,3,11,float),('tplunge',4,11,14,float),('tazimuth',4,14,18,float),
+             ('nmantissa',4,18,26,float),('nplunge',4,26,29,float),('nazimuth',4,29,33,float),
+             ('pmantissa',4,33,41,float),('pplunge',4,41,44,float),('pazimuth',4,44,48,float),
+             ('momentmantissa',4,49,56,float),
+             ('np1strike',4,56,60,float),('np1dip',4,60,63,float),('np1rake',4,63,68,float),
+             ('np2strike',4,68,72,float),('np2dip',4,72,75,float),('np2rake',4,75,80,float)]
+NDKSCHEMA = fixedwidth.Schema([(field,line*LINEWIDTH+start,line*LINEWIDTH+end,dtype)
+                               for field,line,start,end,dtype in NDKFIELDS])
+
+#array fields that are copied straight into records
+RECORDFIELDS = [field for field,dtype in NDKDTYPE if field not in ['triggersource','mag','momentratefunction']]
 
 class MTReader(object):
     fh = None
@@ -22,40 +81,202 @@ class MTReader(object):
         pass
 
 class NDKReader(MTReader):
-    def generateRecords(self,startdate=None,enddate=None,hasHeader=False):
-        tdict = {}
+    def openFile(self):
+        """
+        Open the NDK file for streaming, decompressing it on the fly if it is gzip or bzip2 compressed.
+        Uncompressed files are memory mapped, so the operating system pages them in as we go.
+        @return: File-like object with read(), readline(), seek() and tell() methods.
+        """
+        compression = getCompression(self.mtfile)
+        if compression == 'gzip':
+            return gzip.GzipFile(self.mtfile,'rb')
+        if compression == 'bz2':
+            return bz2.BZ2File(self.mtfile,'rb')
+        f = open(self.mtfile,'rb')
+        if not os.fstat(f.fileno()).st_size: #can't map an empty file
+            return f
+        fh = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        f.close() #the mapping stays valid after the file is closed
+        return fh
+
+    def getIndexFile(self):
+        return self.mtfile + INDEXEXT
+
+    def readIndex(self):
+        """
+        Read the time index for the NDK file, if there is one and the file hasn't changed since it was made.
+        @return: Index dictionary (see writeIndex()), or None.
+        """
+        indexfile = self.getIndexFile()
+        if getCompression(self.mtfile) is not None or not os.path.isfile(indexfile):
+            return None
+        try:
+            f = open(indexfile,'rb')
+            index = pickle.load(f)
+            f.close()
+        except Exception:
+            return None
+        fstat = os.stat(self.mtfile)
+        if index.get('mtime') != fstat.st_mtime or index.get('size') != fstat.st_size:
+            return None
+        return index
+
+    def writeIndex(self,parts,fstat):
+        """
+        Save a time index for the NDK file, next to it.  It's not an error if we can't.
+        @param parts: List of (origin times,centroid times,record start offsets,record end offsets) array tuples.
+        @param fstat: os.stat() of the NDK file from before it was read.
+        """
+        triggertimes,times,starts,ends = [numpy.concatenate(arrays) for arrays in zip(*parts)]
+        index = {'mtime':fstat.st_mtime,'size':fstat.st_size,
+                 'mintimes':numpy.minimum(triggertimes,times),'maxtimes':numpy.maximum(triggertimes,times),
+                 'starts':starts,'ends':ends}
+        try:
+            f = open(self.getIndexFile(),'wb')
+            pickle.dump(index,f,pickle.HIGHEST_PROTOCOL)
+            f.close()
+        except (IOError,OSError):
+            pass
+
+    def generateBlocks(self,start=0,end=None):
+        """
+        Read the NDK file one record at a time.  Blank lines are skipped, as is an incomplete
+        record at the end of the file.
+        @param start: File offset to start reading at, which should be the start of a record.
+        @param end: File offset to stop reading at, or None to read to the end of the file.
+        @return: Generator of lists of the five lines of each record.
+        """
         if self.fh is None:
-            self.fh = open(self.mtfile,'rt')
-        lc = 0
-        for line in self.fh.readlines():
-            if (lc+1) % 5 == 1:
-                self.parseLine1(line,tdict)
-                lc += 1
-                continue
-            if (lc+1) % 5 == 2:
-                self.parseLine2(line,tdict)
-                lc += 1
-                continue
-            if (lc+1) % 5 == 3:
-                self.parseLine3(line,tdict)
-                lc += 1
-                continue
-            if (lc+1) % 5 == 4:
-                self.parseLine4(line,tdict)
-                lc += 1
-                continue
-            if (lc+1) % 5 == 0:
-                self.parseLine5(line,tdict)
-                if startdate is not None and enddate is not None:
-                    if tdict['eventTime'] >= startdate and tdict['eventTime'] <= enddate:
-                        yield self.trimFields(tdict)
-                else:
+            self.fh = self.openFile()
+        try:
+            if start:
+                self.fh.seek(start)
+            block = []
+            for line in iter(self.fh.readline,''):
+                if not line.strip():
+                    continue
+                block.append(line)
+                if len(block) == RECORDLINES:
+                    yield block
+                    block = []
+                    if end is not None and self.fh.tell() >= end:
+                        break
+        finally:
+            self.fh.close()
+            self.fh = None
+    
+    def generateRecords(self,startdate=None,enddate=None,hasHeader=False):
+        start,end = 0,None
+        if startdate is not None or enddate is not None:
+            index = self.readIndex()
+            if index is not None:
+                byterange = getByteRange(index,startdate,enddate)
+                if byterange is None:
+                    return
+                start,end = byterange
+        for block in self.generateBlocks(start,end):
+            tdict = {}
+            self.parseLine1(block[0],tdict)
+            self.parseLine2(block[1],tdict)
+            self.parseLine3(block[2],tdict)
+            self.parseLine4(block[3],tdict)
+            self.parseLine5(block[4],tdict)
+            if startdate is not None and enddate is not None:
+                if tdict['eventTime'] >= startdate and tdict['eventTime'] <= enddate:
                     yield self.trimFields(tdict)
-                lc += 1
-                tdict = {}
-        
-        self.fh.close()
+            else:
+                yield self.trimFields(tdict)
         
+    def generateLines(self,start=0,end=None):
+        """
+        Read the NDK file in large chunks, as arrays of non-blank lines.
+        @param start: File offset to start reading at.
+        @param end: File offset to stop reading at, or None to read to the end of the file.
+        @return: Generator of (lines,starts,ends) tuples, as returned by getLines(), with file offsets.
+        """
+        if self.fh is None:
+            self.fh = self.openFile()
+        try:
+            if start:
+                self.fh.seek(start)
+            offset = start #file offset of the start of the data we haven't handed out yet
+            remainder = ''
+            while True:
+                nbytes = CHUNKBYTES
+                if end is not None:
+                    nbytes = min(nbytes,end - offset - len(remainder))
+                    if nbytes <= 0:
+                        break
+                data = self.fh.read(nbytes)
+                if not data:
+                    break
+                data = remainder + data
+                cut = data.rfind('\n') + 1 #the last line may be incomplete
+                remainder = data[cut:]
+                if cut:
+                    lines,starts,ends = getLines(data[0:cut])
+                    yield (lines,starts+offset,ends+offset)
+                    offset += cut
+            if remainder.strip():
+                lines,starts,ends = getLines(remainder+'\n')
+                yield (lines,starts+offset,ends+offset)
+        finally:
+            self.fh.close()
+            self.fh = None
+
+    def generateArrays(self,startdate=None,enddate=None):
+        """
+        Parse the NDK file a chunk at a time into numpy structured arrays, converting each field of all
+        the records in a chunk at once.  As with generateRecords(), an incomplete record at the end of
+        the file is ignored, and events are filtered on origin time if both dates are given.
+
+        When either date is given, an uncompressed file is read using its time index, so that only the
+        records from the first one in the time window to the last one are parsed.  If there is no index,
+        or the file has changed since it was made, the whole file is parsed and a new index is saved.
+        @param startdate: Earliest event time datetime, or None.
+        @param enddate: Latest event time datetime, or None.
+        @return: Generator of numpy structured arrays with NDKDTYPE fields.
+        """
+        start,end = 0,None
+        parts = None #pieces of a new index
+        if (startdate is not None or enddate is not None) and getCompression(self.mtfile) is None:
+            index = self.readIndex()
+            if index is not None:
+                byterange = getByteRange(index,startdate,enddate)
+                if byterange is None:
+                    return
+                start,end = byterange
+            else:
+                parts = []
+                fstat = os.stat(self.mtfile)
+        leftover = (numpy.zeros((0,LINEWIDTH),dtype=numpy.uint8),numpy.zeros(0,dtype=numpy.int64),
+                    numpy.zeros(0,dtype=numpy.int64))
+        for chunk in self.generateLines(start,end):
+            lines,starts,ends = [numpy.concatenate(pair) for pair in zip(leftover,chunk)]
+            nlines = (len(lines)//RECORDLINES)*RECORDLINES
+            leftover = (lines[nlines:],starts[nlines:],ends[nlines:])
+            if not nlines:
+                continue
+            events = parseArray(lines[0:nlines].reshape(-1,RECORDLINES,LINEWIDTH))
+            if parts is not None:
+                parts.append((events['triggertime'],events['time'],
+                              starts[0:nlines:RECORDLINES],ends[RECORDLINES-1:nlines:RECORDLINES]))
+            if startdate is not None and enddate is not None:
+                times = events['triggertime']
+                events = events[(times >= numpy.datetime64(startdate)) & (times <= numpy.datetime64(enddate))]
+            yield events
+        if parts:
+            self.writeIndex(parts,fstat)
+
+    def readArray(self,startdate=None,enddate=None):
+        """
+        Parse the whole NDK file into one numpy structured array (see generateArrays()).
+        """
+        arrays = list(self.generateArrays(startdate=startdate,enddate=enddate))
+        if not len(arrays):
+            return numpy.zeros(0,dtype=NDKDTYPE)
+        return numpy.concatenate(arrays)
+
     def trimFields(self,tdict):
         record = {}
         record['id'] = tdict['eventTime'].strftime('%Y%m%d%H%M%S')
@@ -264,12 +485,202 @@ class NDKReader(MTReader):
         tdict['nodalPlane2Rake'] = float(line[75:])
 
 
+def getLines(data):
+    """
+    Split a block of text into an array of fixed width lines, dropping blank ones.
+    @param data: String of complete lines.
+    @return: Tuple of Nx80 numpy uint8 array of lines, padded with spaces (or truncated) to 80 characters,
+    and arrays of the offsets of the start of each line in data, and of the end of it (after the newline).
+    """
+    chars = numpy.frombuffer(data,dtype=numpy.uint8)
+    #usually every line is exactly 80 characters, and we can just reshape
+    width = LINEWIDTH + 1
+    if len(chars) % width == 0 and (chars[LINEWIDTH::width] == ord('\n')).all() and \
+       (chars[LINEWIDTH-1::width] != ord('\r')).all():
+        lines = chars.reshape(-1,width)[:,0:LINEWIDTH]
+        keep = (lines > ord(' ')).any(axis=1)
+        starts = numpy.arange(0,len(chars),width,dtype=numpy.int64)[keep]
+        return (numpy.ascontiguousarray(lines[keep]),starts,starts+width)
+    newlines = numpy.flatnonzero(chars == ord('\n'))
+    starts = numpy.concatenate(([0],newlines[:-1]+1)).astype(numpy.int64)
+    cr = (newlines > starts) & (chars[numpy.maximum(newlines-1,0)] == ord('\r'))
+    ends = newlines - cr
+    #count the non-blank characters in each line
+    cumulative = numpy.concatenate(([0],numpy.cumsum(chars > ord(' '))))
+    keep = cumulative[ends] > cumulative[starts]
+    lengths = (ends - starts)[keep]
+    starts = starts[keep]
+    columns = numpy.arange(LINEWIDTH)
+    indices = numpy.minimum(starts[:,None] + columns,len(chars)-1)
+    lines = numpy.where(columns < lengths[:,None],chars[indices],ord(' ')).astype(numpy.uint8)
+    return (lines,starts,(newlines+1)[keep].astype(numpy.int64))
+
+def getCompression(filename):
+    #'gzip', 'bz2' or None, from the first few bytes of a file
+    f = open(filename,'rb')
+    magic = f.read(3)
+    f.close()
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic == BZ2_MAGIC:
+        return 'bz2'
+    return None
+
+def getByteRange(index,startdate=None,enddate=None):
+    """
+    Find the part of an NDK file that holds the events in a time window.
+    @param index: Index dictionary from NDKReader.readIndex().
+    @param startdate: Earliest event time datetime, or None.
+    @param enddate: Latest event time datetime, or None.
+    @return: (start,end) tuple of file offsets of the first record with an origin or centroid time
+    in the window and of the end of the last one, or None if there are no such records.  Records in
+    between are included whatever their times, so the file doesn't need to be in time order.
+    """
+    match = numpy.ones(len(index['starts']),dtype=bool)
+    if startdate is not None:
+        match &= index['maxtimes'] >= numpy.datetime64(startdate)
+    if enddate is not None:
+        match &= index['mintimes'] <= numpy.datetime64(enddate)
+    matches = numpy.flatnonzero(match)
+    if not len(matches):
+        return None
+    return (int(index['starts'][matches[0]]),int(index['ends'][matches[-1]]))
+
+def roundHalfUp(values):
+    #python 2 round(), which rounds halves away from zero - numpy rounds them to even
+    return numpy.sign(values)*numpy.floor(numpy.abs(values)+0.5)
+
+def parseArray(lines):
+    """
+    Parse NDK records into a structured array.
+    This does the same conversions as NDKReader.parseLine1-5 and trimFields(), a field at a time.
+    @param lines: Nx5x80 numpy uint8 array of records.
+    @return: Numpy structured array of N events, with NDKDTYPE fields.
+    """
+    columns = NDKSCHEMA.parseColumns(lines.reshape(len(lines),RECORDLINES*LINEWIDTH))
+    events = numpy.empty(len(lines),dtype=NDKDTYPE)
+    for field in events.dtype.names:
+        if columns.has_key(field):
+            events[field] = columns[field]
+
+    #origin time, with the seconds and microseconds clipped the same way parseLine1 does it
+    fseconds = columns['seconds']
+    seconds = numpy.minimum(fseconds.astype(int),59)
+    microseconds = numpy.minimum(((fseconds-seconds)*1e6).astype(int),999999)
+    events['triggertime'] = fasttime.getEpochTimes(columns['year'],columns['month'],columns['day'],columns['hour'],
+                                                   columns['minute'],seconds,microseconds).view('M8[us]')
+    events['triggerdepth'] = columns['triggerdepthkm']*1000
+    events['duration'] = 2*columns['halfduration']
+
+    #centroid time is relative to the origin time
+    shift = numpy.round(columns['timeshift']*1e6).astype(numpy.int64)
+    events['time'] = events['triggertime'] + shift.astype('m8[us]')
+    events['depth'] = columns['depthkm']*1000
+
+    scale = numpy.power(10.0,columns['exponent'])
+    for field in ['mrr','mtt','mpp','mrt','mrp','mtp']:
+        events[field] = columns[field+'mantissa']*scale/1e7
+    for field,axis in [('tvalue','t'),('nvalue','n'),('pvalue','p')]:
+        events[field] = columns[axis+'mantissa']*scale
+    events['moment'] = columns['momentmantissa']*scale/1e7
+    mag = (2.0/3.0) * (numpy.log10(events['moment']*1e7) - 16.1)
+    events['mag'] = roundHalfUp(mag*10.0)/10.0
+    return events
+
+def getIds(events):
+    #YYYYMMDDHHMMSS IDs from the origin times
+    return fasttime.getTimeIds(events['triggertime'].view(numpy.int64))
+
+def getTimeMask(events,startDate=None,endDate=None):
+    #which events in a structured array have centroid times in the window
+    return fasttime.getWindow(events['time'].view(numpy.int64),startDate,endDate)
+
+def getBatch(events,type=None):
+    """
+    Turn a structured array from NDKReader.generateArrays() into a batch of event columns
+    (see eventrecord.py), with the same fields and values as the records from getRecords().
+    @param events: Numpy structured array with NDKDTYPE fields.
+    @param type: Product type to put in each record.
+    @return: Dictionary of columns keyed by event field.
+    """
+    nevents = len(events)
+    batch = {}
+    for field in RECORDFIELDS:
+        batch[field] = events[field]
+    batch['origid'] = numpy.char.strip(events['origid']).tolist()
+    batch['id'] = getIds(events)
+    triggersources = numpy.char.strip(events['triggersource']).tolist()
+    batch['triggerid'] = [triggersource+eventid for triggersource,eventid in zip(triggersources,batch['id'])]
+    batch['type'] = [type]*nevents
+    magnitudes = eventrecord.getBatchRecords({'mag':events['mag'],'method':['Mwc']*nevents,
+                                              'evalstatus':['reviewed']*nevents,'evalmode':['manual']*nevents})
+    batch['magnitude'] = [[magnitude] for magnitude in magnitudes]
+    batch['evalmode'] = ['manual']*nevents
+    batch['evalstatus'] = ['reviewed']*nevents
+    istriangle = numpy.char.strip(events['momentratefunction']) == 'TRIHD'
+    batch['sourcetimetype'] = ['triangle' if triangle else 'box car' for triangle in istriangle.tolist()]
+    return batch
+
+def getRecords(events,type=None):
+    """
+    Turn a structured array from NDKReader.generateArrays() into the record dictionaries
+    made by NDKReader.generateRecords().
+    @param events: Numpy structured array with NDKDTYPE fields.
+    @param type: Product type to put in each record.
+    @return: Generator of record dictionaries.
+    """
+    columns = {}
+    for field in events.dtype.names:
+        columns[field] = events[field].tolist()
+    columns['origid'] = numpy.char.strip(events['origid']).tolist()
+    columns['triggersource'] = numpy.char.strip(events['triggersource']).tolist()
+    columns['id'] = getIds(events)
+    rows = zip(*[columns[field] for field in RECORDFIELDS])
+    for i in range(0,len(events)):
+        record = dict(zip(RECORDFIELDS,rows[i]))
+        record['id'] = columns['id'][i]
+        record['triggerid'] = columns['triggersource'][i]+columns['id'][i]
+        record['type'] = type
+        record['magnitude'] = [{'mag':columns['mag'][i],'method':'Mwc','evalstatus':'reviewed','evalmode':'manual'}]
+        record['evalmode'] = 'manual'
+        record['evalstatus'] = 'reviewed'
+        if columns['momentratefunction'][i].strip() == 'TRIHD':
+            record['sourcetimetype'] = 'triangle'
+        else:
+            record['sourcetimetype'] = 'box car'
+        yield record
+
+def parseRecords(lines,startDate=None,endDate=None):
+    """
+    Parse NDK lines into record dictionaries (see parallelparse.py), filtering them the same way getEvents() does.
+    @param lines: List of NDK lines, starting at the beginning of a record.
+    @param startDate: Earliest event time datetime, or None.
+    @param endDate: Latest event time datetime, or None.
+    @return: Generator of record dictionaries.
+    """
+    data = ''.join(lines)
+    if not data.strip():
+        return
+    if not data.endswith('\n'):
+        data += '\n'
+    lines = getLines(data)[0]
+    nlines = (len(lines)//RECORDLINES)*RECORDLINES
+    events = parseArray(lines[0:nlines].reshape(-1,RECORDLINES,LINEWIDTH))
+    keep = getTimeMask(events,startDate,endDate)
+    if startDate is not None and endDate is not None:
+        times = events['triggertime']
+        keep &= (times >= numpy.datetime64(startDate)) & (times <= numpy.datetime64(endDate))
+    for record in getRecords(events[keep]):
+        yield record
+
 #this should be a generator
 def getEvents(args,startDate=None,endDate=None):
     ndkfile = args[0]
     ndkreader = NDKReader(ndkfile)
+    records = (record for events in ndkreader.generateArrays(startdate=startDate,enddate=endDate)
+               for record in getRecords(events,ndkreader.type))
     i = -1
-    for record in ndkreader.generateRecords(startdate=startDate,enddate=endDate):
+    for record in records:
         i += 1
         if startDate is not None:
             if record['time'] < startDate:
@@ -279,6 +690,20 @@ def getEvents(args,startDate=None,endDate=None):
                 continue
         yield record
 
+def getEventBatches(args,startDate=None,endDate=None):
+    """
+    Read an NDK file as batches of event columns (see eventrecord.py), a chunk of the file at a time.
+    @param args: List with the NDK file name.
+    @param startDate: Earliest event time datetime, or None.
+    @param endDate: Latest event time datetime, or None.
+    @return: Generator of batch dictionaries, holding the same events as getEvents().
+    """
+    ndkreader = NDKReader(args[0])
+    for events in ndkreader.generateArrays(startdate=startDate,enddate=endDate):
+        events = events[getTimeMask(events,startDate,endDate)]
+        if len(events):
+            yield getBatch(events,ndkreader.type)
+
         
 if __name__ == '__main__':
     ndkfile = sys.argv[1]
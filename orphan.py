@@ -8,7 +8,7 @@ import os.path
 import json
 
 #local
-import quakeml
+import comquakeml
 
 URLBASE = 'http://comcat.cr.usgs.gov/fdsnws/event/1/query?%s'
 TIMEFMT = '%Y-%m-%d'
@@ -29,14 +29,17 @@ def getEventStr(event):
     return eventstr
 
 def main(arguments):
-    timewindow = None
-    distwindow = None
+    timewindow = 16
+    distwindow = 100
     if arguments.timeWindow is not None:
         timewindow = arguments.timeWindow
     if arguments.distanceWindow is not None:
         distwindow = arguments.distanceWindow
-    quake = quakeml.QuakeML('origin',os.getcwd(),catalog=arguments.catalog,
-                            timewindow=timewindow,distwindow=distwindow,triggersource="")
+    quake = comquakeml.QuakeML('origin',os.getcwd(),catalog=arguments.catalog,
+                               timewindow=timewindow,distwindow=distwindow,triggersource="")
+    if arguments.doAssociate and arguments.doPrefetch:
+        #candidate origins are fetched a block of time at a time, as the orphans need them
+        quake.prefetch()
     urlparams = {}
     urlparams['orderby'] = 'time-asc'
     urlparams['format'] = 'geojson'
@@ -44,6 +47,7 @@ def main(arguments):
     urlparams['format'] = 'geojson'
     urlparams['catalog'] = arguments.catalog
     starttime = datetime(1900,1,1)
+    endtime = datetime.utcnow()
     if arguments.startDate is not None:
         starttime = datetime.strptime(arguments.startDate,TIMEFMT)
     if arguments.endDate is not None:
@@ -100,14 +104,18 @@ if __name__ == '__main__':
     cmdparser.add_argument("-s", "--startDate", dest="startDate",nargs='?',
                            help="""Start date for search""", metavar="STARTDATE")
     cmdparser.add_argument("-e", "--endDate", dest="endDate",nargs='?',
-                           help="""End date for search""", metavar="ENDDATE")
+                           help="""End date for search (default today)""", metavar="ENDDATE")
     cmdparser.add_argument("-t", "--timeWindow", dest="timeWindow",nargs='?',type=int,
-                           help="""Time window in seconds""", metavar="TIMEWINDOW")
+                           help="""Time window in seconds (default 16)""", metavar="TIMEWINDOW")
     cmdparser.add_argument("-d", "--distanceWindow", dest="distanceWindow",nargs='?',type=int,
-                           help="""Distance window in km""", metavar="DISTANCE")
+                           help="""Distance window in km (default 100)""", metavar="DISTANCE")
     cmdparser.add_argument("-a", "--associate",
                            action="store_true", dest="doAssociate", default=False,
                            help="Return a list of possible associated events from other catalogs.")
+    cmdparser.add_argument("-p", "--prefetch",
+                           action="store_true", dest="doPrefetch", default=False,
+                           help="""With -a, fetch candidate origins in blocks of %i days instead of
+                           searching for each event separately.""" % comquakeml.BLOCKDAYS)
     
     
     cmdargs = cmdparser.parse_args()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+Parse large catalog files on several cores.
+
+The file is split into chunks at record boundaries, the chunks are parsed in a pool of
+processes, and the events are handed back in file order.  A catalog module can be parsed
+this way if it has a parseRecords(lines,startDate,endDate) function that parses a list of
+lines into event dictionaries, and RECORDLINES and HEADERLINES constants giving the number
+of (non-blank) lines in each record and the number of header lines at the top of the file.
+The chunks are cut from the bytes on disk, so compressed files have to be parsed serially.
+"""
+
+#stdlib imports
+import sys
+import os.path
+import importlib
+import multiprocessing
+import cPickle
+import gc
+
+#third party imports
+import numpy
+
+CHUNKBYTES = 16*1024*1024 #approximate size of the chunks handed to each process
+SCANBYTES = 16*1024*1024 #number of bytes to read at a time when looking for multi-line record boundaries
+COMPRESSED_MAGIC = ['\x1f\x8b','BZh'] #gzip and bzip2 files start with these
+
+def isCompressed(filename):
+    f = open(filename,'rb')
+    magic = f.read(3)
+    f.close()
+    return len([prefix for prefix in COMPRESSED_MAGIC if magic.startswith(prefix)]) > 0
+
+def isParallel(module,args=None):
+    """
+    Find out whether a catalog can be parsed with getEvents() below.
+    @param module: Catalog module.
+    @param args: Arguments for the module's getEvents() function, or None to only check the module.
+    @return: True if the module has parseRecords() and args (if given) is a single uncompressed
+    file, as the module getEvents() functions only read the first of their arguments.
+    """
+    if not module.__dict__.has_key('parseRecords'):
+        return False
+    if args is None:
+        return True
+    return len(args) == 1 and os.path.isfile(args[0]) and not isCompressed(args[0])
+
+def getChunks(filename,recordlines=1,headerlines=0,chunkbytes=CHUNKBYTES):
+    """
+    Split a catalog file into chunks that start at the beginning of a record.
+    @param filename: Catalog file name.
+    @param recordlines: Number of non-blank lines in each record.
+    @param headerlines: Number of lines to skip at the top of the file.
+    @param chunkbytes: Approximate size of each chunk.
+    @return: List of (start,end) file offsets of each chunk.
+    """
+    f = open(filename,'rb')
+    for i in range(0,headerlines):
+        f.readline()
+    start = f.tell()
+    size = os.fstat(f.fileno()).st_size
+    if recordlines == 1:
+        offsets = [start]
+        target = start + chunkbytes
+        while target < size:
+            f.seek(target-1) #so that we don't skip a line that starts at the target
+            f.readline()
+            if f.tell() >= size:
+                break
+            offsets.append(f.tell())
+            target = f.tell() + chunkbytes
+    else:
+        offsets = getRecordOffsets(f,start,recordlines,chunkbytes)
+    f.close()
+    offsets.append(size)
+    return zip(offsets[0:-1],offsets[1:])
+
+def getRecordOffsets(f,start,recordlines,chunkbytes):
+    """
+    Find chunk boundaries in a file of multi-line records, counting non-blank lines from the start.
+    @param f: Open file object.
+    @param start: File offset of the first record.
+    @param recordlines: Number of non-blank lines in each record.
+    @param chunkbytes: Approximate size of each chunk.
+    @return: List of file offsets of the start of each chunk.
+    """
+    offsets = [start]
+    target = start + chunkbytes
+    f.seek(start)
+    base = start #file offset of the start of data
+    nlines = 0 #number of non-blank lines before data
+    remainder = ''
+    while True:
+        data = f.read(SCANBYTES)
+        if not data:
+            break
+        data = remainder + data
+        cut = data.rfind('\n') + 1
+        remainder = data[cut:]
+        if not cut:
+            continue
+        chars = numpy.frombuffer(data,dtype=numpy.uint8,count=cut)
+        newlines = numpy.flatnonzero(chars == ord('\n'))
+        starts = numpy.concatenate(([0],newlines[0:-1]+1))
+        cumulative = numpy.concatenate(([0],numpy.cumsum(chars > ord(' '))))
+        starts = starts[cumulative[newlines] > cumulative[starts]] + base
+        recordstarts = starts[(-nlines) % recordlines::recordlines]
+        nlines += len(starts)
+        while True:
+            i = numpy.searchsorted(recordstarts,target)
+            if i == len(recordstarts):
+                break
+            offsets.append(int(recordstarts[i]))
+            target = offsets[-1] + chunkbytes
+        base += cut
+    return offsets
+
+def readChunk(task):
+    """
+    Parse one chunk of a catalog file.
+    @param task: Tuple of (module name,file name,start offset,end offset,startDate,endDate).
+    @return: List of event dictionaries.
+    """
+    modname,filename,start,end,startDate,endDate = task
+    module = importlib.import_module(modname)
+    f = open(filename,'rb')
+    f.seek(start)
+    data = f.read(end-start)
+    f.close()
+    return list(module.parseRecords(data.splitlines(True),startDate,endDate))
+
+def parseChunk(task):
+    #readChunk() in a pool process, with the events pickled for loadEvents()
+    return cPickle.dumps(readChunk(task),cPickle.HIGHEST_PROTOCOL)
+
+def loadEvents(data):
+    #unpickling is what limits how fast we can go, and it's several times faster without the
+    #garbage collector repeatedly looking through the events we've just made
+    gcenabled = gc.isenabled()
+    gc.disable()
+    try:
+        return cPickle.loads(data)
+    finally:
+        if gcenabled:
+            gc.enable()
+
+def getEvents(module,filename,startDate=None,endDate=None,nprocs=None,chunkbytes=CHUNKBYTES):
+    """
+    Parse a catalog file in parallel.
+    @param module: Catalog module with parseRecords(), RECORDLINES and HEADERLINES.
+    @param filename: Catalog file name.
+    @param startDate: Earliest event time datetime (passed on to parseRecords()).
+    @param endDate: Latest event time datetime (passed on to parseRecords()).
+    @param nprocs: Number of processes to use (defaults to the number of CPUs).
+    @param chunkbytes: Approximate number of bytes for each process to parse at a time.
+    @return: Generator of event dictionaries, in the order they are in the file.
+    """
+    if not os.path.isfile(filename):
+        raise Exception('File %s does not exist' % filename)
+    if isCompressed(filename):
+        raise Exception('File %s is compressed, and can only be parsed with the module getEvents()' % filename)
+    chunks = getChunks(filename,module.RECORDLINES,module.HEADERLINES,chunkbytes)
+    tasks = [(module.__name__,filename,start,end,startDate,endDate) for start,end in chunks]
+    if nprocs == 1 or len(tasks) == 1:
+        for task in tasks:
+            for event in readChunk(task):
+                yield event
+        return
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        for data in pool.imap(parseChunk,tasks):
+            for event in loadEvents(data):
+                yield event
+    finally:
+        pool.terminate()
+        pool.join()
+
+if __name__ == '__main__':
+    #parallelparse.py module file: print the number of events in a catalog file
+    modname = os.path.splitext(os.path.basename(sys.argv[1]))[0]
+    module = importlib.import_module(modname)
+    nevents = 0
+    for event in getEvents(module,sys.argv[2]):
+        nevents += 1
+    print '%i events in %s' % (nevents,sys.argv[2])
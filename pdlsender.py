@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+"""
+Senders that hand products to PDL.
+
+CommandSender starts a new ProductClient for every request, which is what the loaders
+have always done.  DirectorySender hands QuakeML files to long-lived ProductClients
+running EIDSInputWedge in polling mode instead:
+
+  java -jar ProductClient.jar --mainclass=gov.usgs.earthquake.eids.EIDSInputWedge
+       --configFile=... --privateKey=... --poll --polldir=DIR --oldinputdir=DIR --errordir=DIR
+
+The wedge sends each file that appears in its poll directory, then moves it to the old
+input directory, or to the error directory if it could not be sent, so the result for each
+file is read from where the file ends up.  One wedge is started for each set of arguments
+(config file, key) the requests use, the first time it is needed, and it runs until the
+sender is closed.  Other requests (deletes, trump messages, origins) start a client each.
+
+Requests are lists of ProductClient command line arguments, and pdlstub.py can stand in
+for ProductClient, in either mode, when testing.
+"""
+
+#stdlib imports
+import subprocess
+import os.path
+import shutil
+import threading
+import itertools
+import time
+
+DEFAULT_CLIENT = 'java -jar [PDLFOLDER]/ProductClient.jar'
+WEDGECLASS = '--mainclass=gov.usgs.earthquake.eids.EIDSInputWedge'
+DEFAULT_POLL_INTERVAL = 250 #milliseconds between the wedge's looks at its poll directory
+CHECK_INTERVAL = 0.1 #seconds between our looks at where the wedge put the files
+DEFAULT_TIMEOUT = 600 #seconds to wait for the wedge to finish any file before giving up
+
+def getCommandOutput(cmd):
+    """
+    Internal method for calling external command.
+    @param cmd: String command ('ls -l', etc.)
+    @return: Three-element tuple containing a boolean indicating success or failure,
+    the output from running the command, and the error output.
+    """
+    proc = subprocess.Popen(cmd,
+                            shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE
+                            )
+    output,errors = proc.communicate()
+    retcode = proc.returncode
+    if retcode == 0:
+        retcode = True
+    else:
+        retcode = False
+    return (retcode,output,errors)
+
+def getSender(config):
+    """
+    Create the sender configured in the PDL section of a config file.
+    @param config: ConfigParser object with a PDL section containing at least "folder".
+    The optional "client" option sets the command used to start ProductClient.  The optional
+    "polldir" option sets a folder for the poll directories of long-lived EIDSInputWedge
+    clients, which are then used to send QuakeML files, with the optional "pollinterval"
+    (milliseconds) and "polltimeout" (seconds) options.
+    @return: CommandSender or DirectorySender object.
+    """
+    pdlfolder = config.get('PDL','folder')
+    client = DEFAULT_CLIENT
+    if config.has_option('PDL','client'):
+        client = config.get('PDL','client')
+    client = client.replace('[PDLFOLDER]',pdlfolder)
+    if not config.has_option('PDL','polldir'):
+        return CommandSender(client)
+    interval = DEFAULT_POLL_INTERVAL
+    if config.has_option('PDL','pollinterval'):
+        interval = config.getint('PDL','pollinterval')
+    timeout = DEFAULT_TIMEOUT
+    if config.has_option('PDL','polltimeout'):
+        timeout = config.getfloat('PDL','polltimeout')
+    polldir = config.get('PDL','polldir').replace('[PDLFOLDER]',pdlfolder)
+    return DirectorySender(client,polldir,interval=interval,timeout=timeout)
+
+class CommandSender(object):
+    """
+    Send each request with its own invocation of the client.
+    """
+    def __init__(self,client):
+        self.client = client
+
+    def send(self,args):
+        """
+        Send one request.
+        @param args: List of ProductClient command line arguments.
+        @return: (success,output,errors) tuple.
+        """
+        cmd = '%s %s' % (self.client,' '.join(args))
+        return getCommandOutput(cmd)
+
+    def sendBatch(self,arglists):
+        """
+        Send a list of requests.
+        @param arglists: List of lists of ProductClient command line arguments.
+        @return: List of (success,output,errors) tuples, one for each request.
+        """
+        return [self.send(args) for args in arglists]
+
+    def close(self):
+        pass
+
+class PollingClient(object):
+    """
+    One long-lived EIDSInputWedge client and its directories.
+    """
+    def __init__(self,client,args,folder,interval):
+        """
+        @param client: Command that starts ProductClient.
+        @param args: EIDSInputWedge arguments other than the polling ones.
+        @param folder: Folder to keep the client's directories and log in.
+        @param interval: Milliseconds between the client's looks at its poll directory.
+        """
+        self.client = client
+        self.args = args
+        self.indir = os.path.join(folder,'input')
+        self.olddir = os.path.join(folder,'oldinput')
+        self.errordir = os.path.join(folder,'error')
+        self.stagedir = os.path.join(folder,'staging') #files are copied here, then renamed into indir
+        self.logfile = os.path.join(folder,'client.log')
+        self.interval = interval
+        self.proc = None
+
+    def isRunning(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        #start the client, or start it again if it has stopped
+        if self.isRunning():
+            return
+        for folder in [self.indir,self.olddir,self.errordir,self.stagedir]:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        #exec, so that closing the client stops ProductClient rather than the shell
+        cmd = 'exec %s %s --poll --polldir=%s --oldinputdir=%s --errordir=%s --pollInterval=%i' % (self.client,
+              ' '.join(self.args),self.indir,self.olddir,self.errordir,self.interval)
+        log = open(self.logfile,'at')
+        self.proc = subprocess.Popen(cmd,shell=True,stdout=log,stderr=subprocess.STDOUT)
+        log.close()
+
+    def drop(self,filename,name):
+        """
+        Hand a file to the client.
+        @param filename: File to send.
+        @param name: Name to give the client's copy, unique to this request.
+        """
+        staged = os.path.join(self.stagedir,name)
+        shutil.copyfile(filename,staged)
+        os.rename(staged,os.path.join(self.indir,name))
+
+    def getFinished(self):
+        #names of the files the client has sent and failed to send
+        return (set(os.listdir(self.olddir)),set(os.listdir(self.errordir)))
+
+    def close(self):
+        if self.isRunning():
+            self.proc.terminate()
+            self.proc.wait()
+
+class DirectorySender(CommandSender):
+    """
+    Send QuakeML files through the poll directories of long-lived EIDSInputWedge clients,
+    and any other request with its own invocation of the client.
+    """
+    def __init__(self,client,polldir,interval=DEFAULT_POLL_INTERVAL,timeout=DEFAULT_TIMEOUT):
+        """
+        @param client: Command that starts ProductClient.
+        @param polldir: Folder for the clients' directories.
+        @param interval: Milliseconds between each client's looks at its poll directory.
+        @param timeout: Seconds to wait without any file being finished before giving up.
+        """
+        CommandSender.__init__(self,client)
+        self.polldir = polldir
+        self.interval = interval
+        self.timeout = timeout
+        self.clients = {} #tuple of wedge arguments: PollingClient
+        self.lock = threading.Lock()
+        #names that can't be confused with files left over from another run
+        self.prefix = '%x_%x_' % (int(time.time()),os.getpid())
+        self.count = itertools.count()
+
+    def splitRequest(self,args):
+        #(wedge arguments,file name) of a request a polling client can take, or (None,None)
+        if WEDGECLASS not in args:
+            return (None,None)
+        files = [arg for arg in args if arg.startswith('--file=')]
+        if len(files) != 1:
+            return (None,None)
+        return ([arg for arg in args if not arg.startswith('--file=')],files[0][len('--file='):])
+
+    def getClient(self,args):
+        self.lock.acquire()
+        try:
+            key = tuple(args)
+            if not self.clients.has_key(key):
+                folder = os.path.join(self.polldir,'wedge%i' % len(self.clients))
+                self.clients[key] = PollingClient(self.client,args,folder,self.interval)
+            pclient = self.clients[key]
+            pclient.start()
+            return pclient
+        finally:
+            self.lock.release()
+
+    def send(self,args):
+        return self.sendBatch([args])[0]
+
+    def sendBatch(self,arglists):
+        """
+        Send a list of requests, handing all of the QuakeML files to the polling clients at once.
+        @param arglists: List of lists of ProductClient command line arguments.
+        @return: List of (success,output,errors) tuples, one for each request.
+        """
+        results = [None] * len(arglists)
+        pending = [] #(index,client,name,filename) of the files handed to clients
+        for i in range(0,len(arglists)):
+            args,filename = self.splitRequest(arglists[i])
+            if args is None:
+                results[i] = CommandSender.send(self,arglists[i])
+                continue
+            name = '%s%i_%s' % (self.prefix,self.count.next(),os.path.basename(filename))
+            try:
+                pclient = self.getClient(args)
+                pclient.drop(filename,name)
+            except (IOError,OSError),msg:
+                results[i] = (False,'','Could not hand %s to ProductClient: %s' % (filename,str(msg)))
+                continue
+            pending.append((i,pclient,name,filename))
+
+        deadline = time.time() + self.timeout
+        while len(pending):
+            time.sleep(CHECK_INTERVAL)
+            finished = {}
+            for i,pclient,name,filename in pending:
+                if not finished.has_key(pclient):
+                    finished[pclient] = pclient.getFinished()
+            stillpending = []
+            for i,pclient,name,filename in pending:
+                sent,failed = finished[pclient]
+                if name in sent:
+                    os.remove(os.path.join(pclient.olddir,name))
+                    results[i] = (True,'Sent file %s' % filename,'')
+                elif name in failed:
+                    results[i] = (False,'','ProductClient could not send %s (see %s and %s)' % (filename,
+                                  os.path.join(pclient.errordir,name),pclient.logfile))
+                elif not pclient.isRunning():
+                    results[i] = (False,'','ProductClient stopped before sending %s (see %s)' % (filename,
+                                  pclient.logfile))
+                else:
+                    stillpending.append((i,pclient,name,filename))
+            if len(stillpending) < len(pending):
+                deadline = time.time() + self.timeout
+            elif time.time() > deadline:
+                for i,pclient,name,filename in stillpending:
+                    #take back files the client hasn't picked up, so a retry doesn't send them twice
+                    try:
+                        os.remove(os.path.join(pclient.indir,name))
+                    except OSError:
+                        pass
+                    results[i] =(False,'','ProductClient did not send %s within %s seconds' % (filename,
+                                  self.timeout))
+                break
+            pending = stillpending
+        return results
+
+    def close(self):
+        self.lock.acquire()
+        for pclient in self.clients.values():
+            pclient.close()
+        self.clients = {}
+        self.lock.release()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+Stand-in for ProductClient, for testing and benchmarking the loaders without a PDL hub.
+
+Run with ProductClient arguments it pretends to send the product and exits.  Run with the
+EIDSInputWedge polling arguments (--poll --polldir=... --oldinputdir=... --errordir=...) it
+keeps running, and pretends to send each file that appears in the poll directory, moving it
+to the old input or error directory afterwards as the wedge does.  To use it, set this in
+the PDL section of config.ini:
+
+  client = python /path/to/pdlstub.py
+"""
+
+#stdlib imports
+import sys
+import time
+import argparse
+import os.path
+import shutil
+
+POLLARGS = ['--poll','--polldir=','--oldinputdir=','--errordir=','--pollInterval=']
+
+def handleRequest(args,options):
+    if options.delay:
+        time.sleep(options.delay)
+    if options.log is not None:
+        f = open(options.log,'at')
+        f.write(' '.join(args)+'\n')
+        f.close()
+    if options.fail is not None and ' '.join(args).find(options.fail) > -1:
+        return (1,'','Simulated failure for arguments %s' % ' '.join(args))
+    for arg in args:
+        if arg.startswith('--file='):
+            fname = arg[len('--file='):]
+            if not os.path.isfile(fname):
+                return (1,'','File %s does not exist' % fname)
+            return (0,'Sent file %s' % fname,'')
+    return (0,'Sent product','')
+
+def getArgument(args,prefix,default=None):
+    for arg in args:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return default
+
+def poll(args,options):
+    #send the files that show up in the poll directory, until we're killed
+    polldir = getArgument(args,'--polldir=')
+    olddir = getArgument(args,'--oldinputdir=')
+    errordir = getArgument(args,'--errordir=')
+    interval = int(getArgument(args,'--pollInterval=','1000'))/1000.0
+    reqargs = [arg for arg in args if not [prefix for prefix in POLLARGS if arg.startswith(prefix)]]
+    while True:
+        for name in sorted(os.listdir(polldir)):
+            fname = os.path.join(polldir,name)
+            retcode,output,errors = handleRequest(reqargs+['--file=%s' % fname],options)
+            sys.stdout.write(output+errors+'\n')
+            sys.stdout.flush()
+            if retcode:
+                shutil.move(fname,os.path.join(errordir,name))
+            else:
+                shutil.move(fname,os.path.join(olddir,name))
+        time.sleep(interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pretend to be ProductClient.')
+    parser.add_argument('--stub-log', dest='log',
+                        help='Append the arguments of each request to this file')
+    parser.add_argument('--stub-fail', dest='fail',
+                        help='Fail requests whose arguments contain this string')
+    parser.add_argument('--stub-delay', dest='delay',type=float,default=0.0,
+                        help='Seconds to wait before answering each request')
+    options,args = parser.parse_known_args()
+    if '--poll' in args:
+        poll(args,options)
+    retcode,output,errors = handleRequest(args,options)
+    sys.stdout.write(output+'\n')
+    sys.stderr.write(errors)
+    sys.exit(retcode)
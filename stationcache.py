@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+Persistent cache of station NSCL resolutions, by time.
+
+A station's network and channels can change from one epoch to the next, so each NSCL that
+mloc.py resolves is stored with the time interval it holds for (see
+StationTranslator.getValidity()).  Intervals are kept in an SQLite table indexed by station,
+phase type and start time, so a lookup is one index search for the last interval starting
+before the phase time.  Each resolution is committed as soon as it is added, and the database
+is in write-ahead log mode, so a crash loses nothing and several mloc processes can share
+the same cache file.
+
+Stations the server had no usable channels for are stored as the bare station code.  Those
+entries are only trusted for NEGATIVE_DAYS after they were added, so that stations whose
+metadata shows up later get looked up again.
+"""
+
+#stdlib imports
+import sqlite3
+import datetime
+
+#local imports
+import fasttime
+
+MINTIME = -2**63 #open ended intervals start or end at these
+MAXTIME = 2**63-1
+TIMEOUT = 60 #seconds to wait for another process to finish writing
+NEGATIVE_DAYS = 30 #days to trust an entry that didn't resolve to an NSCL
+
+class StationCache(object):
+    """
+    SQLite database of NSCLs, each valid over a time interval.
+    """
+    def __init__(self,filename):
+        """
+        @param filename: Database file name, or ':memory:' for a cache that isn't kept.
+        """
+        self.filename = filename
+        self.db = sqlite3.connect(filename,timeout=TIMEOUT)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS nscls (station TEXT, phase TEXT, starttime INTEGER,
+                           endtime INTEGER, nscl TEXT, added TEXT)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS nsclidx ON nscls (station, phase, starttime)')
+        self.db.commit()
+
+    def getNSCL(self,station,phase,phasetime):
+        """
+        Look up the NSCL of a station at a given time.
+        @param station: Station code.
+        @param phase: Phase type letter ('P' or 'S').
+        @param phasetime: Datetime of the phase.
+        @return: NSCL string, or None if it isn't cached for that time (or is an unresolved
+        station code older than NEGATIVE_DAYS).
+        """
+        epoch = fasttime.toEpoch(phasetime)
+        row = self.db.execute('''SELECT endtime,nscl,added FROM nscls WHERE station=? AND phase=? AND starttime<?
+                                 ORDER BY starttime DESC LIMIT 1''',(station,phase,epoch)).fetchone()
+        if row is None or row[0] <= epoch:
+            return None
+        endtime,nscl,added = row
+        if nscl == station:
+            oldest = datetime.datetime.utcnow() - datetime.timedelta(days=NEGATIVE_DAYS)
+            if added < oldest.isoformat():
+                return None
+        return nscl
+
+    def addNSCLs(self,nscls):
+        """
+        Store NSCLs, replacing any that are stored for overlapping intervals.
+        @param nscls: Sequence of (station,phase,starttime,endtime,nscl) tuples, where starttime and
+        endtime are microseconds since 1970 (see fasttime.py) bounding the open interval the NSCL
+        holds for.
+        """
+        added = datetime.datetime.utcnow().isoformat()
+        for station,phase,starttime,endtime,nscl in nscls:
+            self.db.execute('DELETE FROM nscls WHERE station=? AND phase=? AND starttime<? AND endtime>?',
+                            (station,phase,endtime,starttime))
+            self.db.execute('INSERT INTO nscls VALUES (?,?,?,?,?,?)',(station,phase,starttime,endtime,nscl,added))
+        self.db.commit()
+
+    def addNSCL(self,station,phase,starttime,endtime,nscl):
+        self.addNSCLs([(station,phase,starttime,endtime,nscl)])
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
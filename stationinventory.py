@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""
+Local station inventory, so that mloc.py can find NSCLs without asking the CWB server.
+
+An inventory is loaded from FDSN station web service output at channel level, either text
+(format=text) or StationXML, for example from
+
+  http://service.iris.edu/fdsnws/station/1/query?level=channel&format=text
+
+The channel epochs of each station are kept in numpy arrays of start and end times
+(microseconds since 1970, see fasttime.py) alongside the channel codes, in file order, so
+that StationTranslator can apply the same rules to them that it applies to CWB answers.
+"""
+
+#stdlib imports
+import datetime
+from xml.etree import cElementTree
+
+#third party imports
+import numpy
+
+#local imports
+import fasttime
+
+OPENEND = datetime.datetime(2599,12,31) #end of epochs that haven't ended, as the CWB server shows them
+TEXTCOLUMNS = ['network','station','location','channel','starttime','endtime']
+
+def getLocalName(tag):
+    #element name without the {namespace}
+    return tag.split('}')[-1]
+
+class StationInventory(object):
+    """
+    Channel epochs of a set of stations, indexed by station code.
+    """
+    def __init__(self):
+        self.stations = {} #station code: (starttimes,endtimes,[(network,location,channel),...])
+
+    def load(self,filename):
+        """
+        Add the channels in an inventory file to the inventory.
+        @param filename: FDSN station text or StationXML file, at channel level.
+        @return: Number of channel epochs read.
+        """
+        f = open(filename,'rt')
+        start = f.read(1024).lstrip()
+        f.close()
+        if start.startswith('<'):
+            rows = self.readStationXML(filename)
+        else:
+            rows = self.readText(filename)
+        return self.addChannels(rows)
+
+    def readText(self,filename):
+        #rows of (network,station,location,channel,starttime,endtime) strings from a text file
+        columns = None
+        rows = []
+        f = open(filename,'rt')
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            parts = [part.strip() for part in line.split('|')]
+            if line.startswith('#'):
+                names = [part.lower() for part in parts]
+                names[0] = names[0].lstrip('#').strip()
+                columns = [names.index(name) for name in TEXTCOLUMNS]
+                continue
+            if columns is None:
+                raise Exception,'No header line in %s' % filename
+            rows.append(tuple([parts[i] for i in columns]))
+        f.close()
+        return rows
+
+    def readStationXML(self,filename):
+        #rows of (network,station,location,channel,starttime,endtime) strings from a StationXML file
+        rows = []
+        network = None
+        station = None
+        for event,element in cElementTree.iterparse(filename,events=('start','end')):
+            name = getLocalName(element.tag)
+            if event == 'start':
+                if name == 'Network':
+                    network = element.get('code')
+                elif name == 'Station':
+                    station = element.get('code')
+                continue
+            if name == 'Channel':
+                rows.append((network,station,element.get('locationCode',''),element.get('code'),
+                             element.get('startDate',''),element.get('endDate','')))
+                element.clear()
+            elif name == 'Station':
+                element.clear()
+        return rows
+
+    def addChannels(self,rows):
+        """
+        Add channel epochs to the inventory.
+        @param rows: List of (network,station,location,channel,starttime,endtime) tuples, with times
+        as ISO 8601 strings (empty for epochs that haven't ended).
+        @return: Number of channel epochs added.
+        """
+        if not len(rows):
+            return 0
+        starttimes = fasttime.parseTimestamps([row[4].rstrip('Z') for row in rows])
+        endstrs = [row[5].rstrip('Z') for row in rows]
+        openend = numpy.array([not endstr for endstr in endstrs])
+        endstrs = [endstr or OPENEND.isoformat() for endstr in endstrs]
+        endtimes = fasttime.parseTimestamps(endstrs)
+        endtimes[openend] = fasttime.toEpoch(OPENEND)
+        indices = {}
+        for i in range(0,len(rows)):
+            indices.setdefault(rows[i][1],[]).append(i)
+        for station,rowindices in indices.iteritems():
+            codes = [(rows[i][0],rows[i][2],rows[i][3]) for i in rowindices]
+            if self.stations.has_key(station):
+                oldstarts,oldends,oldcodes = self.stations[station]
+                self.stations[station] = (numpy.concatenate([oldstarts,starttimes[rowindices]]),
+                                          numpy.concatenate([oldends,endtimes[rowindices]]),oldcodes+codes)
+            else:
+                self.stations[station] = (starttimes[rowindices],endtimes[rowindices],codes)
+        return len(rows)
+
+    def getEpochs(self,station):
+        """
+        Get the channel epochs of a station, like StationTranslator.parseEpochs() does from the CWB server.
+        @param station: Station code.
+        @return: List of (start,end) datetimes.
+        """
+        if not self.stations.has_key(station):
+            return []
+        starttimes,endtimes,codes = self.stations[station]
+        return zip(fasttime.toDatetimes(starttimes),fasttime.toDatetimes(endtimes))
+
+    def getChannels(self,station,date):
+        """
+        Get the channels a station had on a date.
+        @param station: Station code.
+        @param date: Datetime.
+        @return: List of (network,station,location,channel) tuples.
+        """
+        if not self.stations.has_key(station):
+            return []
+        starttimes,endtimes,codes = self.stations[station]
+        epoch = fasttime.toEpoch(date)
+        indices = numpy.flatnonzero((starttimes <= epoch) & (endtimes > epoch))
+        return [(codes[i][0],station,codes[i][1],codes[i][2]) for i in indices]
@@ -6,34 +6,44 @@ import re
 import sys
 import csv
 
+#third party imports
+import numpy
+
+#local imports
+import fasttime
+
 def getEvents(args,startDate=None,endDate=None):
     f = open(args[0],'rt')
     csvreader = csv.reader(f,dialect='excel')
     csvreader.next()
+    rows = []
+    dates = []
     for parts in csvreader:
-        record = {}
         try:
             mstr,dstr,ystr = parts[0].split('/')
         except:
             continue
-        year = int(ystr)
-        month = int(mstr)
-        day = int(dstr)
         if parts[1].strip() == '':
-            hour = 0
-            minute = 0
-            second = 0
+            hstr,minstr,sstr = 0,0,0
         else:
-            hstr,mstr,sstr = parts[1].split(':')
-            hour = int(hstr)
-            minute = int(mstr)
-            second = int(sstr)
-        record['time'] = datetime.datetime(year,month,day,hour,minute,second)
-        if record['time'] < datetime.datetime(1976,1,1):
-            continue
-        record['id'] = record['time'].strftime('%Y%m%d%H%M%S')
+            hstr,minstr,sstr = parts[1].split(':')
+        dates.append((int(ystr),int(mstr),int(dstr),int(hstr),int(minstr),int(sstr)))
+        rows.append(parts)
+    f.close()
+    #make all of the times at once (see fasttime.py)
+    dates = numpy.array(dates,dtype=numpy.int64).reshape(-1,6)
+    times = fasttime.getEpochTimes(*dates.T)
+    keep = times >= fasttime.toEpoch(datetime.datetime(1976,1,1))
+    indices = numpy.flatnonzero(keep).tolist()
+    etimes = fasttime.toDatetimes(times[keep])
+    ids = fasttime.getTimeIds(times[keep])
+    for i in range(0,len(indices)):
+        parts = rows[indices[i]]
         if parts[3].strip() == '': #what are we supposed to do without location?
             continue
+        record = {}
+        record['time'] = etimes[i]
+        record['id'] = ids[i]
         record['lat'] = float(parts[3])
         record['lon'] = float(parts[4])
         record['depth'] = 0.0
@@ -43,7 +53,6 @@ def getEvents(args,startDate=None,endDate=None):
             pass
                 
         yield record
-    f.close()
 
 if __name__ == '__main__':
     fname = sys.argv[1]
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+"""
+Check that associating events with prefetched origins (QuakeML.prefetch()) finds the same
+origins, in the same order, as asking the FDSN event service about each event.  A local
+HTTP server stands in for the event service.
+"""
+
+#stdlib imports
+import sys
+import os.path
+import unittest
+import threading
+import BaseHTTPServer
+import urlparse
+import json
+import random
+import datetime
+import tempfile
+import shutil
+
+HOMEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,HOMEDIR)
+
+#local imports
+import comquakeml
+import fasttime
+
+CONFIG = '''[PDL]
+folder = %(folder)s
+[OUTPUT]
+folder = %(folder)s
+[FDSN]
+url = %(url)s
+'''
+
+NEVENTS = 200
+NORIGINS = 3000
+START = datetime.datetime(2010,1,1)
+NDAYS = 20
+
+def makeOrigins(rand):
+    #(milliseconds,lat,lon,id) for random origins, and events that are near some of them
+    origins = []
+    for i in range(0,NORIGINS):
+        ms = (fasttime.toEpoch(START) + rand.randint(0,NDAYS*86400*1000000))//1000
+        origins.append((ms,rand.uniform(-89,89),rand.uniform(-180,180),'us%05i' % i))
+    events = []
+    for i in range(0,NEVENTS):
+        ms,lat,lon,originid = rand.choice(origins)
+        if rand.random() < 0.2:
+            #near the date line, where the search box wraps
+            lon = rand.choice([179.9,-179.9])
+        for j in range(0,rand.randint(0,3)):
+            origins.append((ms+rand.randint(-5000,5000),lat+rand.uniform(-0.5,0.5),lon+rand.uniform(-0.5,0.5),
+                            'ci%05i%i' % (i,j)))
+        etime = comquakeml.parseTime(ms) + datetime.timedelta(seconds=rand.uniform(-10,10))
+        events.append({'id':'e%05i' % i,'lat':lat+rand.uniform(-0.3,0.3),'lon':lon,'depth':10.0,'time':etime,
+                       'magnitude':[{'mag':5.0}]})
+    return (origins,events)
+
+def makeHandler(origins,requests):
+    class FDSNHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        #the parts of the FDSN event service that associate2() and OriginCache use
+        def log_message(self,*args):
+            pass
+
+        def do_GET(self):
+            requests.append(self.path)
+            query = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+            starttime = datetime.datetime.strptime(query['starttime'],comquakeml.APITIMEFMT)
+            endtime = datetime.datetime.strptime(query['endtime'],comquakeml.APITIMEFMT)
+            found = []
+            for ms,lat,lon,originid in origins:
+                otime = comquakeml.parseTime(ms)
+                if otime < starttime or otime > endtime:
+                    continue
+                if query.has_key('minlatitude'):
+                    if lat < float(query['minlatitude']) or lat > float(query['maxlatitude']):
+                        continue
+                    minlon = float(query['minlongitude'])
+                    maxlon = float(query['maxlongitude'])
+                    if not [elon for elon in (lon,lon+360,lon-360) if elon >= minlon and elon <= maxlon]:
+                        continue
+                found.append((ms,lat,lon,originid))
+            found.sort(key=lambda origin: origin[0],reverse=query.get('orderby','time') == 'time')
+            offset = int(query.get('offset',1))-1
+            found = found[offset:offset+int(query.get('limit',20000))]
+            features = [{'id':originid,'geometry':{'coordinates':[lon,lat,10.0]},
+                         'properties':{'mag':5.0,'time':ms,'ids':',%s,' % originid}}
+                        for ms,lat,lon,originid in found]
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(json.dumps({'features':features}))
+    return FDSNHandler
+
+class PrefetchTest(unittest.TestCase):
+    def setUp(self):
+        origins,self.events = makeOrigins(random.Random(5))
+        self.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1',0),makeHandler(origins,self.requests))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.folder = tempfile.mkdtemp()
+        configfile = os.path.join(self.folder,'config.ini')
+        f = open(configfile,'wt')
+        f.write(CONFIG % {'folder':self.folder,'url':'http://127.0.0.1:%i/query?%%s' % self.server.server_address[1]})
+        f.close()
+        self.quake = comquakeml.QuakeML(comquakeml.ORIGIN,'test',method='Mw',triggersource='us',
+                                        configfile=configfile)
+        self.quake.addEvents(self.events)
+        self.pagesize = comquakeml.PAGESIZE
+        #small pages, so that fetching a block takes several requests
+        comquakeml.PAGESIZE = 500
+
+    def tearDown(self):
+        comquakeml.PAGESIZE = self.pagesize
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def getAssociations(self):
+        return [[(origin['id'],origin['time'],origin['lat'],origin['lon'],origin['distance']) for origin in
+                 self.quake.associate2(event)] for event in self.quake.EventList]
+
+    def testPrefetch(self):
+        direct = self.getAssociations()
+        ndirect = len(self.requests)
+        self.assertEqual(ndirect,len(self.quake.EventList))
+        #make sure there's something to get wrong
+        self.assertTrue(len([origins for origins in direct if len(origins) > 1]) > 10)
+        self.assertTrue(len([origins for origins in direct if not len(origins)]) > 0)
+        self.quake.prefetch(blockdays=4)
+        prefetched = self.getAssociations()
+        self.assertEqual(direct,prefetched)
+        self.assertTrue(len(self.requests) - ndirect < ndirect)
+
+    def testFetchOnDemand(self):
+        #blocks the events don't cover are fetched when an event needs them
+        direct = self.getAssociations()
+        self.quake.prefetch(blockdays=2)
+        self.quake.Origins.Blocks = {}
+        self.assertEqual(direct,self.getAssociations())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Check that StationTranslator.prefetch() followed by getNSCL() gives the same NSCLs as
+getNSCL() looking each station up as it goes, using cwbstub.py in place of the CWB metadata
+server, with stations that change networks, stations only known by an IR alias and stations
+the server knows nothing about.
+"""
+
+#stdlib imports
+import sys
+import os.path
+import unittest
+import threading
+import argparse
+import random
+import datetime
+import tempfile
+import shutil
+
+HOMEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,HOMEDIR)
+
+#local imports
+import cwbstub
+import cwbclient
+import mloc
+
+#S00-S04 move from network XX to YY in the middle of 2005
+STATIONS = ['S%02i' % i for i in range(0,10)] + ['UNK%02i' % i for i in range(0,3)] + ['MIS%02i' % i for i in range(0,2)]
+PHASETYPES = ['P','Pn','PKP','S','Sg','Lg']
+#phase times either side of the network change, and inside the days around it where both epochs match
+TIMES = [datetime.datetime(1995,3,1),datetime.datetime(2005,5,29,12),datetime.datetime(2005,6,3),
+         datetime.datetime(2012,7,1)]
+NPHASES = 300
+
+def getPhases(rand):
+    #(station,phasetype,phasetime) tuples, many of them in the same validity interval
+    phases = []
+    for i in range(0,NPHASES):
+        phasetime = rand.choice(TIMES) + datetime.timedelta(seconds=rand.randint(0,86400))
+        phases.append((rand.choice(STATIONS),rand.choice(PHASETYPES),phasetime))
+    return phases
+
+class PrefetchTest(unittest.TestCase):
+    def startServer(self,close=False):
+        options = argparse.Namespace(log=self.logfile,delay=0.0,close=close,
+                                     unknown='^UNK',missing='^MIS',moved='^S0[0-4]')
+        self.server = cwbstub.CWBServer(('127.0.0.1',0),cwbstub.CWBHandler)
+        self.server.options = options
+        self.server.lock = threading.Lock()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.folder,'requests.log')
+        self.phases = getPhases(random.Random(22))
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def getTranslator(self):
+        client = cwbclient.CWBClient('127.0.0.1',self.server.server_address[1])
+        return mloc.StationTranslator(client=client)
+
+    def getRequestCount(self):
+        if not os.path.isfile(self.logfile):
+            return 0
+        return len(open(self.logfile,'rt').readlines())
+
+    def checkPrefetch(self):
+        lazy = self.getTranslator()
+        expected = [lazy.getNSCL(station,phasetype,phasetime) for station,phasetype,phasetime in self.phases]
+        lazy.close()
+        #make sure each kind of station turned up
+        self.assertTrue([nscl for nscl in expected if nscl.startswith('XX.S0')])
+        self.assertTrue([nscl for nscl in expected if nscl.startswith('YY.S0')])
+        self.assertTrue([nscl for nscl in expected if nscl.startswith('IR.UNK')])
+        self.assertTrue([nscl for nscl in expected if nscl.startswith('MIS')])
+
+        prefetched = self.getTranslator()
+        nrequests = self.getRequestCount()
+        self.assertTrue(prefetched.prefetch(self.phases) > 0)
+        self.assertTrue(self.getRequestCount() > nrequests)
+        nrequests = self.getRequestCount()
+        nscls = [prefetched.getNSCL(station,phasetype,phasetime) for station,phasetype,phasetime in self.phases]
+        #everything should have come from the cache
+        self.assertEqual(self.getRequestCount(),nrequests)
+        self.assertEqual(nscls,expected)
+        prefetched.close()
+
+    def testPrefetch(self):
+        self.startServer()
+        self.checkPrefetch()
+
+    def testClosingServer(self):
+        #a server that closes the connection after every answer
+        self.startServer(close=True)
+        self.checkPrefetch()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+Check that getMomentTensorAnglesBatch() gets the same principal axes and nodal planes as the
+obspy beachball functions it replaced (MT2Axes, MT2Plane and AuxPlane, which newer obspy
+versions call mt2axes, mt2plane and aux_plane), on a fixed set of moment tensors.
+"""
+
+#stdlib imports
+import sys
+import os.path
+import unittest
+import random
+
+HOMEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,HOMEDIR)
+
+#third party imports
+import numpy
+try:
+    from obspy.imaging import beachball
+except ImportError:
+    beachball = None
+
+#local imports
+import comquakeml
+
+def getObspyFunction(*names):
+    for name in names:
+        if beachball is not None and hasattr(beachball,name):
+            return getattr(beachball,name)
+    return None
+
+MT2Axes = getObspyFunction('MT2Axes','mt2axes')
+MT2Plane = getObspyFunction('MT2Plane','mt2plane')
+AuxPlane = getObspyFunction('AuxPlane','aux_plane')
+
+ANGLETOLERANCE = 1e-4 #degrees
+VALUETOLERANCE = 1e-9 #relative to the largest tensor component
+
+#mrr,mtt,mpp,mrt,mrp,mtp: GCMT solutions, then double couples with vertical, 45 degree and flat planes
+TENSORS = [(1.040e27,-0.427e27,-0.613e27,2.130e27,-0.838e27,0.100e27),
+           (-3.630e25,1.240e25,2.390e25,-0.940e25,2.660e25,-1.860e25),
+           (8.081e26,0.093e26,-4.320e26,5.065e26,2.344e26,-4.940e26),
+           (1.930e24,-0.930e24,-1.000e24,0.220e24,-0.180e24,1.470e24),
+           (-2.110e25,-0.540e25,2.650e25,0.310e25,-1.020e25,-0.760e25),
+           (0.0,1.0,-1.0,0.0,0.0,0.0),
+           (0.0,0.0,0.0,0.0,0.0,1.0),
+           (1.0,-1.0,0.0,0.0,0.0,0.0),
+           (-1.0,0.0,1.0,0.0,0.0,0.0),
+           (0.0,0.0,0.0,1.0,0.0,0.0),
+           (0.0,0.0,0.0,0.0,1.0,0.0),
+           (0.5,-1.0,0.5,0.3,-0.2,0.7)]
+NRANDOM = 500
+
+def getTensors():
+    #the tensors above, and random ones that are the same every time
+    rand = random.Random(6)
+    tensors = list(TENSORS)
+    for i in range(0,NRANDOM):
+        scale = 10**rand.uniform(17,29)
+        tensors.append(tuple([rand.uniform(-1,1)*scale for j in range(0,6)]))
+    return tensors
+
+def getObspyAngles(tensor):
+    #the angles getMomentTensorAngles() used to get from obspy, one tensor at a time
+    mt = beachball.MomentTensor(*(list(tensor)+[1]))
+    taxis,naxis,paxis = MT2Axes(mt)
+    plane1 = MT2Plane(mt)
+    plane2 = AuxPlane(plane1.strike,plane1.dip,plane1.rake)
+    angles = {}
+    for axis,name in [(taxis,'t'),(naxis,'n'),(paxis,'p')]:
+        angles[name+'azimuth'] = axis.strike
+        angles[name+'plunge'] = axis.dip
+        angles[name+'value'] = axis.val
+    angles['np1strike'] = plane1.strike
+    angles['np1dip'] = plane1.dip
+    angles['np1rake'] = plane1.rake
+    angles['np2strike'] = plane2[0]
+    angles['np2dip'] = plane2[1]
+    angles['np2rake'] = plane2[2]
+    return angles
+
+def getAngleDifference(angle1,angle2):
+    #difference between two angles in degrees, so that 0 and 360 (or -180 and 180) are the same
+    return abs((angle1 - angle2 + 180.0) % 360.0 - 180.0)
+
+@unittest.skipIf(MT2Axes is None or MT2Plane is None or AuxPlane is None,'obspy beachball functions not available')
+class TensorAnglesTest(unittest.TestCase):
+    def checkAngles(self,angles,tensor,label):
+        expected = getObspyAngles(tensor)
+        scale = max([abs(component) for component in tensor])
+        for key in comquakeml.ANGLEKEYS:
+            value = angles[key]
+            message = '%s %s: %s, obspy gives %s' % (label,key,value,expected[key])
+            if numpy.isnan(expected[key]):
+                self.assertTrue(numpy.isnan(value),message)
+            elif key.endswith('value'):
+                self.assertTrue(abs(value - expected[key]) <= VALUETOLERANCE*scale,message)
+            else:
+                self.assertTrue(getAngleDifference(value,expected[key]) <= ANGLETOLERANCE,message)
+
+    def testBatch(self):
+        tensors = getTensors()
+        columns = [numpy.array(column,dtype=float) for column in zip(*tensors)]
+        batch = comquakeml.getMomentTensorAnglesBatch(*columns)
+        self.assertEqual(sorted(batch.keys()),sorted(comquakeml.ANGLEKEYS))
+        for i in range(0,len(tensors)):
+            angles = dict([(key,batch[key][i]) for key in comquakeml.ANGLEKEYS])
+            self.checkAngles(angles,tensors[i],'tensor %i' % i)
+
+    def testEvent(self):
+        #getMomentTensorAngles() goes through the batch version with one tensor
+        keys = ['mrr','mtt','mpp','mrt','mrp','mtp']
+        for i in range(0,len(TENSORS)):
+            event = comquakeml.getMomentTensorAngles(dict(zip(keys,TENSORS[i])))
+            self.checkAngles(event,TENSORS[i],'event %i' % i)
+
+if __name__ == '__main__':
+    unittest.main()
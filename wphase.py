@@ -2,11 +2,19 @@
 
 #stdlib imports
 import sys
-import datetime
 import optparse
 import os.path
 
+#third party imports
+import numpy
+
+#local imports
+import fasttime
+
 TIMEFMT = '%Y-%m-%d %H:%M:%S'
+RECORDLINES = 1 #one event per line, after a header line
+HEADERLINES = 1
+DATE_FILTERED = True #getEvents() only returns events in the time window
 
 #this should be a generator
 def getEvents(args,startDate=None,endDate=None):
@@ -18,21 +26,28 @@ def getEvents(args,startDate=None,endDate=None):
     f.readline()
     lines = f.readlines()
     f.close()
-    for line in lines:
+    return parseRecords(lines,startDate,endDate)
+
+def parseRecords(lines,startDate=None,endDate=None):
+    """
+    Parse catalog lines (after the header) into event dictionaries (see parallelparse.py).
+    @param lines: List of catalog lines.
+    @param startDate: Earliest event time datetime, or None.
+    @param endDate: Latest event time datetime, or None.
+    @return: Generator of event dictionaries.
+    """
+    rows = [line.strip().split() for line in lines]
+    #the times of all of the events, at once (see fasttime.py)
+    times = fasttime.parseTimestamps(['%s %s' % (parts[1],parts[2]) for parts in rows],TIMEFMT)
+    keep = fasttime.getWindow(times,startDate,endDate)
+    indices = numpy.flatnonzero(keep).tolist()
+    etimes = fasttime.toDatetimes(times[keep])
+    for i in range(0,len(indices)):
         event = {}
-        parts = line.strip().split()
+        parts = rows[indices[i]]
         event['id'] = parts[0]
         event['triggerid'] = event['id']
-        date = parts[1]
-        time = parts[2]
-        dtime = '%s %s' % (date,time)
-        event['time'] = datetime.datetime.strptime(dtime,TIMEFMT)
-        if startDate is not None:
-            if event['time'] < startDate:
-                continue
-        if endDate is not None:
-            if event['time'] > endDate:
-                continue
+        event['time'] = etimes[i]
         #parts[3] is the GCMT magnitude - we don't care about that here
         event['magnitude'] = [{'mag':float(parts[4]),'method':'Mww','evalstatus':'final','evalmode':'manual'}]
         event['mag'] = float(parts[4])
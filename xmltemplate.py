@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import re
+from xml.etree import ElementTree
+
+MACROPATTERN = r'\[([^]]*)\]'
+MAGNITUDES = 'MAGNITUDES'
+SLOTTAG = 'magnitudeslot'
+
+#the opening tag we always want on the output, namespaces and all
+QUAKEMLTAG = """<q:quakeml xmlns="http://quakeml.org/xmlns/bed/1.2" xmlns:catalog="http://anss.org/xmlns/catalog/0.1" xmlns:q="http://quakeml.org/xmlns/quakeml/1.2">"""
+
+#cache of compiled templates, keyed by template text
+_TEMPLATES = {}
+
+def fixNamespaces(xmltext):
+    """
+    Undo what ElementTree serialization does to our namespaces.
+    @param xmltext: Serialized XML text with ElementTree "nsX:" prefixes.
+    @return: Text with the prefixes removed and the q: and catalog: qualifiers restored.
+    """
+    xmltext = re.sub('ns[0-9]*:','',xmltext)
+    xmltext = xmltext.replace('<quakeml','<q:quakeml')
+    xmltext = xmltext.replace('</quakeml','</q:quakeml')
+    xmltext = xmltext.replace('eventid','catalog:eventid')
+    xmltext = xmltext.replace('eventsource','catalog:eventsource')
+    xmltext = xmltext.replace('datasource','catalog:datasource')
+    xmltext = xmltext.replace('dataid','catalog:dataid')
+    return xmltext
+
+def stripWhitespace(xmltext):
+    return xmltext.replace('\n','').replace('\t','')
+
+def _toAscii(text):
+    #the XML parser decodes input as utf-8, and the serializer writes us-ascii with character references
+    if isinstance(text,unicode):
+        return text.encode('us-ascii','xmlcharrefreplace')
+    try:
+        text.decode('us-ascii')
+        return text
+    except UnicodeDecodeError:
+        return text.decode('utf-8').encode('us-ascii','xmlcharrefreplace')
+
+def escapeText(text):
+    #element text as the parser would read it and ElementTree would write it back out
+    text = text.replace('\r\n','\n').replace('\r','\n')
+    text = text.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
+    return _toAscii(text)
+
+def escapeAttribute(text):
+    #attribute values have their whitespace normalized by the parser
+    text = text.replace('\r\n',' ').replace('\r',' ').replace('\n',' ').replace('\t',' ')
+    text = text.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;').replace('"','&quot;')
+    return _toAscii(text)
+
+def splitMacros(text):
+    """
+    Split a string into static text and macro pieces.
+    @param text: String possibly containing [MACRO] strings.
+    @return: List of (ismacro,string) tuples, where string is the macro name for macro pieces.
+    """
+    pieces = []
+    if text is None:
+        return pieces
+    pos = 0
+    for match in re.finditer(MACROPATTERN,text):
+        if match.start() > pos:
+            pieces.append((False,text[pos:match.start()]))
+        pieces.append((True,match.group(1)))
+        pos = match.end()
+    if pos < len(text):
+        pieces.append((False,text[pos:]))
+    return pieces
+
+def _qname(name):
+    #ElementTree writes namespaced names as nsX:name
+    if name.startswith('{'):
+        return 'ns0:'+name[name.index('}')+1:]
+    return name
+
+def _localName(name):
+    if name.startswith('{'):
+        return name[name.index('}')+1:]
+    return name
+
+class _Text(object):
+    """
+    Compiled character data (element text or tail).
+    """
+    def __init__(self,text):
+        pieces = splitMacros(text)
+        self.Pieces = []
+        self.HasStatic = False #would the parser have seen non-empty text here?
+        self.Macros = set()
+        for ismacro,piece in pieces:
+            if ismacro:
+                self.Macros.add(piece)
+                self.Pieces.append((True,piece))
+            else:
+                if len(piece):
+                    self.HasStatic = True
+                self.Pieces.append((False,stripWhitespace(fixNamespaces(escapeText(piece)))))
+
+    def render(self,values,out):
+        #return True if the text the parser would see is non-empty
+        nonempty = self.HasStatic
+        for ismacro,piece in self.Pieces:
+            if not ismacro:
+                out.append(piece)
+                continue
+            if values.has_key(piece):
+                value = escapeText(values[piece])
+            else:
+                value = '[%s]' % piece
+            if len(value):
+                nonempty = True
+            out.append(stripWhitespace(fixNamespaces(value)))
+        return nonempty
+
+class _Element(object):
+    """
+    Compiled element, rendered only when all of the macros in its attributes and text are filled.
+    """
+    def __init__(self,element,isroot=False):
+        self.Tag = _localName(element.tag)
+        self.Macros = set()
+        if isroot:
+            self.Open = QUAKEMLTAG[:-1]
+            self.Attributes = []
+        else:
+            self.Open = fixNamespaces('<'+_qname(element.tag))
+            self.Attributes = []
+            for key,value in sorted(element.items()):
+                pieces = []
+                for ismacro,piece in splitMacros(value):
+                    if ismacro:
+                        self.Macros.add(piece)
+                        pieces.append((True,piece,piece))
+                    else:
+                        pieces.append((False,fixNamespaces(escapeAttribute(piece)),piece))
+                self.Attributes.append((_localName(key),fixNamespaces(' %s="' % _qname(key)),pieces))
+        self.Close = stripWhitespace(fixNamespaces('</%s>' % _qname(element.tag)))
+        self.Text = _Text(element.text)
+        self.Macros = self.Macros.union(self.Text.Macros)
+        self.Children = []
+        for child in element:
+            if _localName(child.tag) == SLOTTAG:
+                self.Children.append(_Slot(child))
+            else:
+                self.Children.append(_Element(child))
+        self.Tail = _Text(element.tail)
+
+    def isFilled(self,values):
+        for macro in self.Macros:
+            if not values.has_key(macro):
+                return False
+        return True
+
+    def getAttribute(self,name,values):
+        #attribute value as a DOM parser would report it, macros and all
+        for key,prefix,pieces in self.Attributes:
+            if key != name:
+                continue
+            value = ''
+            for ismacro,piece,raw in pieces:
+                if not ismacro:
+                    value += raw
+                elif values.has_key(piece):
+                    value += re.sub('\r\n|[\r\n\t]',' ',values[piece])
+                else:
+                    value += '[%s]' % piece
+            return value
+        return ''
+
+    def findElements(self,tag,values,magnitudes,found):
+        if self.Tag == tag:
+            found.append((self,values))
+        for child in self.Children:
+            child.findElements(tag,values,magnitudes,found)
+
+    def render(self,values,magnitudes,out):
+        """
+        Render this element and its tail.
+        @return: True if the element was rendered, False if it was left out because of unfilled macros.
+        """
+        if not self.isFilled(values):
+            return False
+        out.append(self.Open)
+        for key,prefix,pieces in self.Attributes:
+            out.append(prefix)
+            for ismacro,piece,raw in pieces:
+                if ismacro:
+                    out.append(stripWhitespace(fixNamespaces(escapeAttribute(values[piece]))))
+                else:
+                    out.append(piece)
+            out.append('"')
+        inner = []
+        hastext = self.Text.render(values,inner)
+        nchildren = 0
+        for child in self.Children:
+            nchildren += child.render(values,magnitudes,inner)
+        if hastext or nchildren:
+            out.append('>')
+            out += inner
+            out.append(self.Close)
+        else:
+            out.append(' />')
+        self.Tail.render(values,out)
+        return True
+
+class _Slot(object):
+    """
+    Place holder for the list of magnitudes rendered from the magnitude template.
+    """
+    def __init__(self,element):
+        self.Tail = _Text(element.tail)
+
+    def findElements(self,tag,values,magnitudes,found):
+        for template,magvalues in magnitudes:
+            template.Root.findElements(tag,magvalues,[],found)
+
+    def render(self,values,magnitudes,out):
+        #each magnitude's tail runs up to the next one, the last one's tail includes our own
+        nrendered = 0
+        nmags = len(magnitudes)
+        for i in range(0,nmags):
+            template,magvalues = magnitudes[i]
+            if i == 0:
+                out.append(template.Lead)
+            if not template.Root.render(magvalues,[],out):
+                continue
+            nrendered += 1
+            out.append(template.Trail)
+            if i < nmags-1:
+                out.append(template.Lead)
+            else:
+                self.Tail.render(values,out)
+        return nrendered
+
+class CompiledTemplate(object):
+    """
+    QuakeML template compiled into a tree of static strings and macro slots.
+
+    Rendering fills in the macros and leaves out any element with an unfilled macro in
+    its text or attributes, in a single pass over the compiled template.  The output is
+    the same as substituting the macros into the template text, removing the unfilled
+    elements with ElementTree, restoring the namespaces and stripping newlines and tabs.
+    """
+    def __init__(self,xmltext,isfragment=False):
+        self.xml = xmltext
+        if isfragment:
+            self.Lead = stripWhitespace(xmltext[0:xmltext.index('<')])
+            self.Trail = stripWhitespace(xmltext[xmltext.rindex('>')+1:])
+            self.Root = _Element(ElementTree.fromstring(xmltext))
+        else:
+            xmltext = xmltext.replace('[%s]' % MAGNITUDES,'<%s/>' % SLOTTAG)
+            self.Root = _Element(ElementTree.fromstring(xmltext),isroot=True)
+
+    def getAttributes(self,tag,attribute,values,magnitudes=[]):
+        """
+        Get the values of an attribute of all elements with a given tag, in document order.
+        @param tag: Element tag name (no namespace).
+        @param attribute: Attribute name.
+        @param values: Dictionary of macro names (upper case) and their string values.
+        @param magnitudes: List of (CompiledTemplate,values) tuples, one for each magnitude.
+        @return: List of attribute values.
+        """
+        found = []
+        self.Root.findElements(tag,values,magnitudes,found)
+        return [element.getAttribute(attribute,evalues) for element,evalues in found]
+
+    def render(self,values,magnitudes=[]):
+        """
+        Render the template.
+        @param values: Dictionary of macro names (upper case) and their string values.
+        @param magnitudes: List of (CompiledTemplate,values) tuples, one for each magnitude.
+        @return: Rendered XML string.
+        """
+        out = []
+        self.Root.render(values,magnitudes,out)
+        return ''.join(out)
+
+def compileTemplate(xmltext,isfragment=False):
+    """
+    Compile a template, or get it from the cache if it has been compiled already.
+    @param xmltext: Template XML text.
+    @param isfragment: True for the magnitude template, which is inserted into the others.
+    @return: CompiledTemplate object.
+    """
+    key = (xmltext,isfragment)
+    if not _TEMPLATES.has_key(key):
+        _TEMPLATES[key] = CompiledTemplate(xmltext,isfragment=isfragment)
+    return _TEMPLATES[key]